@@ -14,19 +14,41 @@
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-from .base import Module, Processor
-from .caption import Captioning
-from .config import Config
-from .faces import FaceDetection, KnownFaces
-from .image import ImageFile
-from .revgeo import ReverseGeocoding
+import importlib
+
+# The classes are imported from their submodules only when accessed, so that
+# importing recallery does not pull in heavy dependencies (like dlib) that
+# may not even be needed.
+_EXPORTS = {
+  "Captioning": "caption",
+  "Config": "config",
+  "FaceDetection": "faces",
+  "KnownFaces": "faces",
+  "ImageData": "image",
+  "ImageFile": "image",
+  "Module": "base",
+  "Pipeline": "pipeline",
+  "Processor": "base",
+  "ReverseGeocoding": "revgeo",
+  "SearchIndex": "search",
+}
 
 __all__ = [
   "Captioning",
+  "Config",
   "FaceDetection",
   "KnownFaces",
+  "ImageData",
   "ImageFile",
   "Module",
+  "Pipeline",
   "Processor",
   "ReverseGeocoding",
+  "SearchIndex",
 ]
+
+def __getattr__ (name):
+  if name not in _EXPORTS:
+    raise AttributeError (f"module {__name__!r} has no attribute {name!r}")
+  module = importlib.import_module (f".{_EXPORTS[name]}", __name__)
+  return getattr (module, name)
@@ -14,6 +14,18 @@
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+from .image import ImageFile
+from .stats import NO_STATS
+
+import concurrent.futures
+import queue
+import threading
+
+# Time in seconds that processing waits for the modules running in the
+# background after all others are done, so that their values can still
+# be written together with the others in a single XMP update.
+DEFERRED_WAIT = 1.0
+
 class Module:
   """This is a base class (mostly an interface) that defines a recallery
   module.  Modules are in charge of a particular aspect of metadata processing
@@ -37,16 +49,108 @@ class Module:
     no data known."""
     raise RuntimeError ("not implemented: process")
 
+  def submit (self, img):
+    """Starts the processing of img in the background, for modules that
+    mostly wait (e.g. on the rate limit of a server).  Returns a Future for
+    the value, or None if the module does not support this (which is the
+    default), in which case process is called instead."""
+    return None
+
+  def cached (self, img, val):
+    """Called instead of process when the result val for img has been
+    taken from the cache.  The default implementation does nothing."""
+    pass
+
+  def cache_key (self, img):
+    """Returns a string that identifies everything (apart from the image
+    content itself) that the result of processing img depends on, like
+    the module's configuration.  Results are then cached by this key and
+    the content hash.  Returns None if the results should not be cached,
+    which is the default."""
+    return None
+
+  @property
+  def input_pixels (self):
+    """Returns the size (in pixels) of the image rendition that this
+    module works on, or None if it needs the image at full resolution."""
+    return None
+
+  @property
+  def concurrency (self):
+    """Returns how many files this module can usefully process at the
+    same time by default (e.g. because it sends requests to multiple
+    servers).  This is used as its limit unless configured otherwise."""
+    return 1
+
+  @property
+  def summary (self):
+    """May return a human-readable string with statistics (e.g. about
+    caching) to print at the end of a run, or None."""
+    return None
+
+  @property
+  def cpu_bound (self):
+    """Returns true if processing with this module is mostly CPU-bound
+    (rather than waiting on the network), so that it benefits from running
+    in a separate process when multiple files are processed at once."""
+    return False
+
+  def use_executor (self, executor):
+    """Tells the module to run its heavy computation through the given
+    concurrent.futures executor (typically a process pool).  The default
+    implementation ignores it."""
+    pass
+
 class Processor:
   """This class bundles multiple modules together, representing the full
   recallery pipeline for processing an image in various ways (e.g. process it,
-  store metadata to XMP, clear metadata, read metadata)."""
+  store metadata to XMP, clear metadata, read metadata).  If a SearchIndex
+  is passed, it is kept up-to-date with the metadata written to files.
+  If a ResultCache is passed, module results are looked up there before
+  processing an image.  If sidecar is set, files opened by the processor
+  itself (i.e. for writing deferred values) use XMP sidecars."""
 
-  def __init__ (self):
+  def __init__ (self, index=None, cache=None, stats=NO_STATS, sidecar=False):
     self._modules = []
+    self._limits = {}
+    self.index = index
+    self.cache = cache
+    self.stats = stats
+    self.sidecar = sidecar
+
+    self._deferred_cond = threading.Condition ()
+    self._deferred_count = 0
+    self._writes = queue.Queue ()
+    self._writer = None
+    self.deferred_errors = []
 
-  def add_module (self, m):
+  def add_module (self, m, limit=None):
+    """Adds a module to the pipeline.  If limit is given, at most that many
+    threads may run the module's processing at the same time (when multiple
+    files are processed concurrently)."""
     self._modules.append (m)
+    if limit is not None:
+      self._limits[m.name] = threading.BoundedSemaphore (limit)
+
+  def open_file (self, filename):
+    """Returns an ImageFile for the given file, with the processor's
+    stats and sidecar mode."""
+    return ImageFile (filename, self.stats, self.sidecar)
+
+  @property
+  def modules (self):
+    """Returns the list of all modules."""
+    return list (self._modules)
+
+  @property
+  def xmp_attributes (self):
+    """Returns the list of XMP properties handled by all modules."""
+    return [m.xmp_attribute for m in self._modules]
+
+  def use_executor (self, executor):
+    """Passes the executor for CPU-bound work on to all modules."""
+    for m in self._modules:
+      m.use_executor (executor)
 
   def get_metadata (self, img):
     """Reads all existing metadata tags on the given image (for all modules)
@@ -62,19 +166,180 @@ class Processor:
 
   def clear_metadata (self, img):
     """Removes the metadata (if it exists on the file) for all modules."""
-    for m in self._modules:
-      img.set_custom_property (m.xmp_attribute, None)
+    with img.metadata_session ():
+      for m in self._modules:
+        img.set_custom_property (m.xmp_attribute, None)
+    self._update_index (img, {})
 
   def process (self, img, force):
     """Processes all modules, calculating their data, and stores all the
-    data into the image metadata."""
+    data into the image metadata.  This may be called for different images
+    from multiple threads at the same time.
 
-    for m in self._modules:
-      if not force:
-        existing = img.get_custom_property (m.xmp_attribute)
-        if existing is not None:
-          continue
-      val = m.process (img)
-      # Even if val is None, we want to write the metadata attribute, in that
-      # case clearing it.
-      img.set_custom_property (m.xmp_attribute, val)
+    Modules that support it are started in the background first.  Those
+    that are not done shortly (DEFERRED_WAIT) after all others are, are
+    returned as a list of (module, future) tuples.  Their values have not
+    been written yet; pass the list to complete_deferred for that."""
+
+    self.stats.count ("processed_files")
+    values = {}
+    deferred = []
+    with img.metadata_session ():
+      todo = []
+      for m in self._modules:
+        if not force:
+          existing = img.get_custom_property (m.xmp_attribute)
+          if existing is not None:
+            values[m.xmp_attribute] = existing
+            self.stats.count (f"skipped:{m.name}")
+            continue
+        todo.append (m)
+
+      # Let the image data know which renditions the modules will use, so
+      # that it can derive the smaller ones from the larger.
+      img.plan_renditions ([m.input_pixels for m in todo])
+
+      submitted = [(m, m.submit (img)) for m in todo]
+      for m, future in submitted:
+        if future is None:
+          self._set_value (img, values, m, self._process_module (m, img))
+
+      background = [(m, f) for m, f in submitted if f is not None]
+      if background:
+        with self.stats.timer ("wait_background"):
+          concurrent.futures.wait ([f for _, f in background],
+                                   timeout=DEFERRED_WAIT)
+      for m, future in background:
+        if future.done ():
+          self._set_value (img, values, m, future.result ())
+        else:
+          deferred.append ((m, future))
+
+    self._update_index (img, values)
+    return deferred
+
+  def _set_value (self, img, values, m, val):
+    """Sets the XMP property of module m to the computed value."""
+    # Even if val is None, we want to write the metadata attribute, in
+    # that case clearing it.
+    img.set_custom_property (m.xmp_attribute, val)
+    values[m.xmp_attribute] = val
+
+  def complete_deferred (self, filename, deferred, callback=None):
+    """Writes the values of modules still running in the background (as
+    returned by process) to the file when they are done.  The writes are
+    done by a separate writer thread, with all values of a file in a single
+    update.  After each write, callback (if given) is called with the
+    filename and the list of XMP properties written."""
+
+    if not deferred:
+      return
+
+    with self._deferred_cond:
+      self._deferred_count += len (deferred)
+      if self._writer is None:
+        self._writer = threading.Thread (target=self._run_writer,
+                                         daemon=True)
+        self._writer.start ()
+    self._writes.put ((filename, deferred, callback))
+
+  def _run_writer (self):
+    while True:
+      filename, deferred, callback = self._writes.get ()
+      try:
+        self._write_deferred (filename, deferred, callback)
+      finally:
+        with self._deferred_cond:
+          self._deferred_count -= len (deferred)
+          self._deferred_cond.notify_all ()
+
+  def _write_deferred (self, filename, deferred, callback):
+    concurrent.futures.wait ([f for _, f in deferred])
+
+    values = {}
+    for m, future in deferred:
+      try:
+        values[m.xmp_attribute] = future.result ()
+      except Exception as e:
+        with self._deferred_cond:
+          self.deferred_errors.append ((filename, m.name, e))
+    if not values:
+      return
+
+    try:
+      with self.open_file (filename) as img:
+        self.update_metadata (img, values)
+      if callback is not None:
+        callback (filename, list (values))
+    except Exception as e:
+      with self._deferred_cond:
+        for m, _ in deferred:
+          if m.xmp_attribute in values:
+            self.deferred_errors.append ((filename, m.name, e))
+
+  @property
+  def deferred_count (self):
+    """Returns the number of background values not yet written."""
+    with self._deferred_cond:
+      return self._deferred_count
+
+  def wait_deferred (self):
+    """Waits until all values from complete_deferred have been written."""
+    with self._deferred_cond:
+      while self._deferred_count > 0:
+        self._deferred_cond.wait ()
+
+  def _process_module (self, m, img):
+    """Runs the processing of a single module on the image, or takes
+    the result from the cache if possible."""
+
+    key = None
+    if self.cache is not None:
+      module_key = m.cache_key (img)
+      if module_key is not None:
+        key = self.cache.make_key (img.data.pixel_hash, module_key)
+        found, val = self.cache.get (key)
+        if found:
+          self.stats.count (f"cache_hit:{m.name}")
+          m.cached (img, val)
+          return val
+
+    limit = self._limits.get (m.name)
+    if limit is not None:
+      with self.stats.timer (f"wait:{m.name}"):
+        limit.acquire ()
+    try:
+      with self.stats.timer (f"module:{m.name}"):
+        val = m.process (img)
+    finally:
+      if limit is not None:
+        limit.release ()
+
+    if key is not None:
+      self.cache.put (key, val)
+    return val
+
+  def update_metadata (self, img, values):
+    """Writes the given dict of XMP property values (computed outside of
+    the normal processing) to the image, and updates the index."""
+
+    with img.metadata_session ():
+      for nm, val in values.items ():
+        img.set_custom_property (nm, val)
+    self._update_index (img, values)
+
+  def _update_index (self, img, values):
+    """Updates the search index (if any) for the image, based on the
+    given values of properties that have just been written.  All other
+    indexed properties are read from the file."""
+
+    if self.index is None:
+      return
+
+    props = {}
+    for p in self.index.properties:
+      if p in values:
+        props[p] = values[p]
+      else:
+        props[p] = img.get_custom_property (p)
+    self.index.update (img.filename, props)
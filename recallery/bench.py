@@ -0,0 +1,389 @@
+#    recallery - image metadata indexing and search
+#    Copyright (C) 2025  Daniel Kraft <d@domob.eu>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from .base import Module, Processor
+from .config import Config
+from .pipeline import Pipeline
+from .registry import enabled_modules
+from .stats import Stats
+
+import concurrent.futures
+import contextlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import multiprocessing
+import os
+from pathlib import Path
+import platform
+import random
+import resource
+import shutil
+import sys
+import threading
+import time
+
+CORPUS_SIZE = (1600, 1200)
+
+def make_corpus (outdir, count, seed=0, face_images=None):
+  """Generates count JPEG files in outdir, deterministically for the
+  given seed.  Each has GPS coordinates (some of them sharing a place)
+  and a JPEG comment on every other file.  If face_images is a list of
+  image paths, one of them is pasted into every other file."""
+
+  from PIL import Image, ImageDraw
+
+  outdir = Path(outdir)
+  outdir.mkdir(parents=True, exist_ok=True)
+  rng = random.Random(seed)
+  faces = [Image.open(p).convert("RGB") for p in (face_images or [])]
+  places = [(rng.uniform(-60, 70), rng.uniform(-180, 180))
+            for _ in range(max(1, count // 4))]
+
+  res = []
+  for i in range(count):
+    img = Image.new("RGB", CORPUS_SIZE,
+                    tuple(rng.randrange(256) for _ in range(3)))
+    draw = ImageDraw.Draw(img)
+    for _ in range(20):
+      x, y = rng.randrange(CORPUS_SIZE[0]), rng.randrange(CORPUS_SIZE[1])
+      draw.ellipse((x, y, x + rng.randrange(20, 400), y + rng.randrange(20, 400)),
+                   fill=tuple(rng.randrange(256) for _ in range(3)))
+    if faces and i % 2 == 0:
+      face = faces[i // 2 % len(faces)].copy()
+      face.thumbnail((CORPUS_SIZE[0] // 2, CORPUS_SIZE[1] // 2))
+      img.paste(face, (rng.randrange(CORPUS_SIZE[0] - face.width),
+                       rng.randrange(CORPUS_SIZE[1] - face.height)))
+
+    lat, lon = rng.choice(places)
+    exif = Image.Exif()
+    exif.get_ifd(0x8825).update({
+      1: "N" if lat >= 0 else "S",
+      2: _to_dms(abs(lat)),
+      3: "E" if lon >= 0 else "W",
+      4: _to_dms(abs(lon)),
+    })
+
+    path = outdir / f"bench-{i:05d}.jpg"
+    kwargs = {}
+    if i % 2 == 1:
+      kwargs["comment"] = f"Benchmark image {i}".encode("utf-8")
+    img.save(path, format="JPEG", quality=90, exif=exif, **kwargs)
+    res.append(path)
+
+  return res
+
+def _to_dms (value):
+  degrees = int(value)
+  minutes = int((value - degrees) * 60)
+  seconds = round(((value - degrees) * 60 - minutes) * 60, 4)
+  return (float(degrees), float(minutes), seconds)
+
+class StubServer:
+  """HTTP server in a background thread standing in for Nominatim (the
+  /reverse endpoint) and Ollama (/api/chat), answering every request after
+  the given latency in seconds."""
+
+  def __init__ (self, latency):
+    self.latency = latency
+    self.requests = 0
+    lock = threading.Lock()
+    server = self
+
+    class Handler (BaseHTTPRequestHandler):
+      def log_message (self, *args):
+        pass
+
+      def _reply (self, data):
+        with lock:
+          server.requests += 1
+        time.sleep(server.latency)
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+      def do_GET (self):
+        self._reply({
+          "place_id": 1,
+          "lat": "0", "lon": "0",
+          "display_name": "Benchmark Street 1, Benchmark City",
+          "address": {"city": "Benchmark City"},
+        })
+
+      def do_POST (self):
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length) or b"{}")
+        self._reply({
+          "model": request.get("model", ""),
+          "created_at": "2025-01-01T00:00:00Z",
+          "message": {
+            "role": "assistant",
+            "content": "A benchmark picture with colourful shapes.",
+          },
+          "done": True,
+        })
+
+    self._httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    self._httpd.daemon_threads = True
+    self._thread = threading.Thread(target=self._httpd.serve_forever,
+                                    daemon=True)
+    self._thread.start()
+
+  @property
+  def address (self):
+    host, port = self._httpd.server_address
+    return f"{host}:{port}"
+
+  def close (self):
+    self._httpd.shutdown()
+    self._httpd.server_close()
+
+class _TimedModule (Module):
+  """Wraps a module to record the duration of each of its calls."""
+
+  def __init__ (self, inner):
+    self.inner = inner
+    self.durations = []
+    self._lock = threading.Lock()
+
+  @property
+  def name (self):
+    return self.inner.name
+
+  @property
+  def xmp_attribute (self):
+    return self.inner.xmp_attribute
+
+  @property
+  def summary (self):
+    return self.inner.summary
+
+  @property
+  def concurrency (self):
+    return self.inner.concurrency
+
+  @property
+  def cpu_bound (self):
+    return self.inner.cpu_bound
+
+  def use_executor (self, executor):
+    self.inner.use_executor(executor)
+
+  def _record (self, start):
+    duration = time.perf_counter() - start
+    with self._lock:
+      self.durations.append(duration)
+
+  def submit (self, img):
+    start = time.perf_counter()
+    future = self.inner.submit(img)
+    if future is not None:
+      future.add_done_callback(lambda _: self._record(start))
+    return future
+
+  def process (self, img):
+    start = time.perf_counter()
+    try:
+      return self.inner.process(img)
+    finally:
+      self._record(start)
+
+def _percentiles (values):
+  """Returns a dict with count, mean, p50 and p99 of the values (in ms)."""
+  if not values:
+    return {"count": 0}
+  values = sorted(values)
+  def pct(p):
+    return 1000 * values[min(len(values) - 1, int(p / 100 * len(values)))]
+  return {
+    "count": len(values),
+    "mean_ms": 1000 * sum(values) / len(values),
+    "p50_ms": pct(50),
+    "p99_ms": pct(99),
+  }
+
+def _peak_rss_mb ():
+  """Returns the peak resident set size of this process and its (waited
+  for) children in MB."""
+  # ru_maxrss is in bytes on macOS, but in kilobytes elsewhere.
+  scale = 1 if sys.platform == "darwin" else 1024
+  own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+  return max(own, children) * scale / (1024 * 1024)
+
+def run (corpus, workdir, jobs=1, nominatim_latency=0.05,
+         ollama_latency=0.5, known_faces=None, caption=True, sidecar=False):
+  """Runs the benchmark on a copy of the corpus files in workdir (since
+  processing modifies the files), and returns the results as dict.
+  Processing is set up like recallery-cli does with the given number of
+  jobs, using stand-in servers with the given latencies (in seconds).
+  Face detection runs if a directory with encoded known faces is given.
+  If sidecar is set, metadata is written to XMP sidecars."""
+
+  workdir = Path(workdir)
+  if workdir.exists():
+    shutil.rmtree(workdir)
+  datadir = workdir / "data"
+  images = workdir / "images"
+  datadir.mkdir(parents=True)
+  images.mkdir()
+  files = []
+  for f in sorted(Path(corpus).glob("*.jpg")):
+    shutil.copy(f, images / f.name)
+    files.append(str(images / f.name))
+
+  nominatim = StubServer(nominatim_latency)
+  ollama = StubServer(ollama_latency)
+  try:
+    with open(datadir / "recallery.conf", "w") as f:
+      f.write("[revgeo]\n")
+      f.write(f"nominatim = {nominatim.address}\n")
+      f.write("scheme = http\n")
+      f.write("delay = 0\n")
+      f.write("cache = false\n")
+      if caption:
+        f.write("[caption]\n")
+        f.write(f"ollama = http://{ollama.address}\n")
+        f.write("model = benchmark\n")
+      f.write("[xmp]\n")
+      f.write(f"sidecar = {'true' if sidecar else 'false'}\n")
+    if known_faces is not None:
+      shutil.copytree(known_faces, datadir / "known_faces")
+
+    config = Config(datadir)
+    stats = Stats()
+    processor = Processor(stats=stats, sidecar=sidecar)
+    modules = []
+    cpu_jobs = 1
+    for spec in enabled_modules(config):
+      m = _TimedModule(spec.load(config))
+      modules.append(m)
+      if m.cpu_bound:
+        limit = min(jobs, os.cpu_count())
+        cpu_jobs = max(cpu_jobs, limit)
+      else:
+        limit = m.concurrency
+      processor.add_module(m, limit)
+
+    latencies = []
+    def process_file(filename):
+      start = time.perf_counter()
+      with processor.open_file(filename) as img:
+        deferred = processor.process(img, False)
+      latencies.append(time.perf_counter() - start)
+      processor.complete_deferred(filename, deferred)
+
+    executor = contextlib.nullcontext()
+    if jobs > 1:
+      ctx = multiprocessing.get_context("spawn")
+      executor = concurrent.futures.ProcessPoolExecutor(max_workers=cpu_jobs,
+                                                        mp_context=ctx)
+
+    errors = 0
+    start = time.perf_counter()
+    with executor:
+      if jobs > 1:
+        processor.use_executor(executor)
+      for filename, _, error in Pipeline(jobs).map(process_file, files):
+        if error is not None:
+          print(f"Error processing {filename}: {error}", file=sys.stderr)
+          errors += 1
+      processor.wait_deferred()
+    errors += len(processor.deferred_errors)
+    total = time.perf_counter() - start
+  finally:
+    nominatim.close()
+    ollama.close()
+
+  res = {
+    "machine": {
+      "python": platform.python_version(),
+      "platform": platform.platform(),
+      "cpus": os.cpu_count(),
+    },
+    "settings": {
+      "images": len(files),
+      "jobs": jobs,
+      "nominatim_latency": nominatim_latency,
+      "ollama_latency": ollama_latency,
+      "sidecar": sidecar,
+    },
+    "total_seconds": total,
+    "images_per_second": len(files) / total if total > 0 else None,
+    "errors": errors,
+    "latency": _percentiles(latencies),
+    "modules": {},
+    # Every actual write of a file (or sidecar) is timed as xmp_write,
+    # including those of values completed in the background.
+    "xmp_writes": stats.as_dict()["timers"].get("xmp_write",
+                                                {"calls": 0})["calls"],
+    "phases": stats.as_dict(),
+    "peak_rss_mb": _peak_rss_mb(),
+    "server_requests": {
+      "nominatim": nominatim.requests,
+      "ollama": ollama.requests,
+    },
+  }
+  for m in modules:
+    busy = sum(m.durations)
+    entry = _percentiles(m.durations)
+    entry["images_per_second"] = len(m.durations) / busy if busy > 0 else None
+    res["modules"][m.name] = entry
+
+  return res
+
+def format_report (res, baseline=None):
+  """Returns the benchmark results as human-readable text, with the
+  relative change to the baseline results (if given) for the main
+  figures."""
+
+  def delta(new, old):
+    if baseline is None or old is None or new is None or old == 0:
+      return ""
+    return f" ({100 * (new - old) / old:+.1f}%)"
+
+  def get(data, *keys):
+    for k in keys:
+      if data is None or k not in data:
+        return None
+      data = data[k]
+    return data
+
+  lines = []
+  ips = res["images_per_second"]
+  lines.append(f"Images: {res['settings']['images']}"
+               f", jobs: {res['settings']['jobs']}"
+               f", errors: {res['errors']}")
+  lines.append(f"End-to-end: {ips or 0:.2f} images/s"
+               + delta(ips, get(baseline, "images_per_second")))
+  for p in ["p50_ms", "p99_ms"]:
+    value = res["latency"].get(p)
+    if value is not None:
+      lines.append(f"  latency {p[:3]}: {value:.1f} ms"
+                   + delta(value, get(baseline, "latency", p)))
+  for name, m in res["modules"].items():
+    if m["count"] == 0:
+      continue
+    lines.append(f"{name}: {m['images_per_second']:.2f} images/s"
+                 + delta(m["images_per_second"],
+                         get(baseline, "modules", name, "images_per_second"))
+                 + f", p50 {m['p50_ms']:.1f} ms, p99 {m['p99_ms']:.1f} ms")
+  lines.append(f"XMP writes: {res['xmp_writes']}")
+  lines.append(f"Peak RSS: {res['peak_rss_mb']:.1f} MB"
+               + delta(res["peak_rss_mb"], get(baseline, "peak_rss_mb")))
+  return "\n".join(lines)
@@ -14,11 +14,12 @@
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+from .base import Module
+from .ollamapool import EndpointPool
+
 import base64
+import json
 import re
-from ollama import Client
-
-from .base import Module
 
 PROMPT = """
 Describe in a brief paragraph what this image depicts.  The description
@@ -32,15 +33,26 @@ The user explicitly provided a comment for this file:
 
 THINKING = False
 
+# Default size (in pixels) of the image rendition sent to the model.
+# Vision models scale the image down to about this size anyway.
+DEFAULT_MAX_PIXELS = 1_000_000
+
 class Captioning (Module):
   """A module that creates image captions / descriptions using a multimodal
   AI model running in Ollama."""
 
-  def __init__ (self, ollama, model):
+  def __init__ (self, ollama, model, max_pixels=DEFAULT_MAX_PIXELS,
+                per_host=1, keep_alive=None):
     """Initialises the captioning module based on the ollama endpoint
-    and model name to use."""
-    self.client = Client(host=ollama)
+    (or a list of endpoints serving the same model) and model name to use.
+    Images are scaled down to max_pixels before sending them to the model,
+    unless it is None.  per_host is the maximum number of requests
+    running on each endpoint at the same time."""
+    if isinstance(ollama, str):
+      ollama = [ollama]
+    self.client = EndpointPool(ollama, per_host, keep_alive)
     self.model = model
+    self.max_pixels = max_pixels
 
   @property
   def name (self):
@@ -50,8 +62,28 @@ class Captioning (Module):
   def xmp_attribute (self):
     return "AICaption"
 
+  @property
+  def input_pixels (self):
+    return self.max_pixels
+
+  @property
+  def concurrency (self):
+    return len(self.client.hosts) * self.client.per_host
+
+  def cache_key (self, img):
+    # The endpoints are not part of the key, since they all serve the
+    # same model.
+    return json.dumps ([
+      "caption", self.model, PROMPT, PROMPT_COMMENT, THINKING,
+      self.max_pixels, img.user_comment,
+    ])
+
   def process (self, img):
-    image_data = base64.b64encode(img.raw_data).decode('ascii')
+    if self.input_pixels is None:
+      raw = img.raw_data
+    else:
+      raw = img.data.rendition_jpeg(self.input_pixels)
+    image_data = base64.b64encode(raw).decode('ascii')
 
     prompt = PROMPT
     comment = img.user_comment
@@ -72,3 +104,31 @@ class Captioning (Module):
     
     caption = response['message']['content']
     return caption if caption else None
+
+def from_config (config):
+  """Creates the captioning module for the [caption] section of the
+  given Config."""
+
+  model = config.get("caption", "model")
+
+  # Multiple endpoints can be given, separated by commas or whitespace.
+  ollama = config.get("caption", "ollama")
+  if ollama is None:
+    ollama = "http://localhost:11434"
+  hosts = re.split(r"[\s,]+", ollama.strip())
+
+  per_host = config.get("caption", "per_host")
+  per_host = 1 if per_host is None else max(1, int(per_host))
+
+  keep_alive = config.get("caption", "keep_alive")
+  if keep_alive is None:
+    keep_alive = "30m"
+
+  # Setting max_pixels to 0 sends the original file.
+  max_pixels = config.get("caption", "max_pixels")
+  if max_pixels is None:
+    max_pixels = DEFAULT_MAX_PIXELS
+  else:
+    max_pixels = int(max_pixels) or None
+
+  return Captioning(hosts, model, max_pixels, per_host, keep_alive)
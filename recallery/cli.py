@@ -14,19 +14,33 @@
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import time
+_IMPORT_START = time.perf_counter()
+
+# Only lightweight modules are imported here.  The backends for processing
+# (with their heavy dependencies like dlib) are loaded through the registry
+# when needed.
 from .base import Processor
-from .caption import Captioning
 from .config import Config
-from .faces import FaceDetection, KnownFaces, processFaces
-from .image import ImageFile
-from .revgeo import ReverseGeocoding
+from .pipeline import Pipeline
+from .registry import IMPORT_TIMES, enabled_modules
+from .resultcache import ResultCache
+from .scan import Manifest, hash_file, iter_files
+from .search import SearchIndex
+from .stats import NO_STATS, Stats
 
 import argparse
 import concurrent.futures
+import contextlib
+import json
+import multiprocessing
 import os
-import pickle
 from pathlib import Path
+import socket
 import sys
+import threading
+
+_IMPORT_TIME = time.perf_counter() - _IMPORT_START
 
 def main ():
   parser = argparse.ArgumentParser(description="Process image metadata")
@@ -34,73 +48,165 @@ def main ():
                       help="Data directory (defaults to ~/.recallery)")
   parser.add_argument("-f", "--force", action="store_true",
                       help="Force reprocessing of all metadata")
+  parser.add_argument("-j", "--jobs", type=int, default=1,
+                      help="Number of files to process in parallel")
+  parser.add_argument("-n", "--limit", type=int, default=None,
+                      help="Maximum number of search results")
+  parser.add_argument("--no-cache", action="store_true",
+                      help="Do not use cached module results")
+  parser.add_argument("--import-times", action="store_true",
+                      help="Print the time spent on importing modules")
+  parser.add_argument("--stats", action="store_true",
+                      help="Print timings and counters of the processing")
+  parser.add_argument("--stats-file", default=None,
+                      help="Write timings and counters to this file (in"
+                           " Prometheus format for .prom, JSON otherwise)")
   parser.add_argument("command", nargs="?", default="process",
-                      help="Command to execute (clear, show, or process)")
-  parser.add_argument("files", nargs="*", help="Image files to process")
+                      help="Command to execute (clear, show, process, search,"
+                           " rematch, cluster, watch, enqueue, worker"
+                           " or queue)")
+  parser.add_argument("files", nargs="*",
+                      help="Image files or directories to process"
+                           " (or the search query, or the output directory"
+                           " for cluster, or the directories to watch)")
+  parser.add_argument("--retry-failed", action="store_true",
+                      help="With queue, put failed jobs back into the"
+                           " queue")
 
   args = parser.parse_args()
 
-  if args.command in ["clear", "show", "process"]:
+  if args.command in ["clear", "show", "process", "search", "rematch",
+                      "cluster", "watch", "enqueue", "worker", "queue"]:
     command = args.command
     files = args.files
   else:
     command = "process"
     files = [args.command] + args.files
 
-  if not files:
+  if command == "search":
+    if not files:
+      parser.error("a search query must be specified")
+  elif not files and command not in ["rematch", "cluster", "watch", "worker",
+                                     "queue"]:
     parser.error("at least one file must be specified")
+  if args.jobs < 1:
+    parser.error("--jobs must be at least 1")
 
   # Load configuration
   config = Config(args.datadir)
+  index = SearchIndex(config.search_index_file)
+
+  if command == "search":
+    for path in index.search(" ".join(files), args.limit):
+      print(path)
+    return
+
+  if command == "rematch":
+    sys.exit(_rematch(config, index))
+  if command == "cluster":
+    sys.exit(_cluster(config, files))
+  if command == "queue":
+    sys.exit(_show_queue(config, args))
+  if command == "watch" and not files:
+    files = _split_list(config.get("watch", "paths"))
+    if not files:
+      parser.error("no directories to watch given or configured")
   
-  # Get reverse geocoding configuration with defaults
-  nominatim_url = config.get("revgeo", "nominatim")
-  if nominatim_url is None:
-    nominatim_url = "nominatim.openstreetmap.org"
-  
-  nominatim_delay = config.get("revgeo", "delay")
-  if nominatim_delay is None:
-    nominatim_delay = 5
-  else:
-    nominatim_delay = int(nominatim_delay)
-
-  # Get caption configuration
-  caption_model = config.get("caption", "model")
-  if caption_model is not None:
-    caption_ollama = config.get("caption", "ollama")
-    if caption_ollama is None:
-      caption_ollama = "http://localhost:11434"
-
-  # Get face recognition configuration
-  faces_model = config.get("faces", "model")
-  if faces_model is None:
-    faces_model = "cnn"
-
-  faces_tolerance = config.get("faces", "tolerance")
-  if faces_tolerance is None:
-    faces_tolerance = 0.5
-  else:
-    faces_tolerance = float(faces_tolerance)
-
-  known_faces = None
-  if config.encoded_faces_file.exists():
-    with open(config.encoded_faces_file, "rb") as f:
-      known_faces = pickle.load(f)
-  
-  processor = Processor()
-  processor.add_module(ReverseGeocoding(nominatim_url, nominatim_delay))
-  if caption_model is not None:
-    processor.add_module(Captioning(caption_ollama, caption_model))
-  if known_faces is not None:
-    processor.add_module(FaceDetection(faces_model, faces_tolerance, known_faces))
+  # Only load the implementations of the enabled modules, and only if
+  # we actually process files.  For the other commands, the module specs
+  # are enough.
+  # Module results are cached by image content (up to [cache] max_size
+  # megabytes), so that e.g. renamed files or --force runs do not need
+  # to process everything again.
+  processing = command in ["process", "watch", "worker"]
+  cache = None
+  if (processing and not args.no_cache
+        and config.get_boolean("cache", "enabled", True)):
+    max_size = config.get("cache", "max_size")
+    max_size = 256 if max_size is None else float(max_size)
+    cache = ResultCache(config.result_cache_file, int(max_size * 1024 * 1024))
+
+  stats = NO_STATS
+  if args.stats or args.stats_file is not None:
+    stats = Stats()
+
+  # In sidecar mode, the metadata is written to <file>.xmp next to each
+  # image, and the images themselves are left untouched.
+  sidecar = config.get_boolean("xmp", "sidecar", False)
+  processor = Processor(index, cache, stats, sidecar)
+  cpu_jobs = 1
+  for spec in enabled_modules(config):
+    if not processing:
+      processor.add_module(spec)
+      continue
 
+    try:
+      m = spec.load(config)
+    except RuntimeError as e:
+      print(f"Error: {e}", file=sys.stderr)
+      sys.exit(1)
+
+    # Concurrency limits for each module, when processing multiple
+    # files in parallel.  By default, network-bound modules send one
+    # request at a time to each server, while CPU-bound modules use
+    # all CPUs.
+    if m.cpu_bound:
+      limit = _get_jobs(config, spec.section, min(args.jobs, os.cpu_count()))
+      cpu_jobs = max(cpu_jobs, limit)
+    else:
+      limit = _get_jobs(config, spec.section, m.concurrency)
+    processor.add_module(m, limit)
+
+  if args.import_times:
+    _print_import_times()
+
+  # Directories are scanned recursively, and files that are unchanged
+  # since they were last processed (according to the manifest) are
+  # skipped without opening them.
+  manifest = Manifest(config.manifest_file,
+                      config.get_boolean("scan", "hash", False))
+  if command == "watch":
+    sys.exit(_watch(config, processor, manifest, files, args, cpu_jobs))
+  if command == "worker":
+    sys.exit(_worker(config, processor, manifest, args, cpu_jobs))
+  files = iter_files(files)
+  skipped = 0
+  def changed_files(files):
+    nonlocal skipped
+    for filename in files:
+      if manifest.is_current(filename, processor.xmp_attributes):
+        skipped += 1
+        stats.count("unchanged_files")
+      else:
+        yield filename
+  if command in ["process", "enqueue"] and not args.force:
+    files = changed_files(files)
+
+  if command == "enqueue":
+    queue = _open_job_queue(config)
+    count = queue.enqueue(files, args.force)
+    print(f"Queued {count} files ({skipped} unchanged)", file=sys.stderr)
+    return
+
+  if command == "process" and args.jobs > 1:
+    status = _process_parallel(processor, manifest, files, args, cpu_jobs)
+    if not _wait_deferred(processor):
+      status = 1
+    _print_summary(processor, skipped)
+    _report_stats(stats, args)
+    sys.exit(status)
+
+  deferred = []
   for i, filename in enumerate(files):
-    with ImageFile(filename) as f:
+    if command == "show" and i > 0:
+      print("=" * 80)
+      print()
+    with processor.open_file(filename) as f:
       if command == "clear":
         processor.clear_metadata(f)
       elif command == "process":
         print(f"Processing {filename}...", file=sys.stderr)
-        processor.process(f, args.force)
+        deferred = processor.process(f, args.force)
       elif command == "show":
         metadata = processor.get_metadata(f)
         print(f"{filename}:")
@@ -109,11 +215,438 @@ def main ():
           print(f"{module_name}:")
           print(value)
           print()
-        if i < len(files) - 1:
-          print("=" * 80)
-          print()
+    if command == "clear":
+      manifest.remove(filename)
+    elif command == "process":
+      _record_processed(processor, manifest, filename, deferred)
+
+  status = 0
+  if command == "process":
+    if not _wait_deferred(processor):
+      status = 1
+    _print_summary(processor, skipped)
+  _report_stats(stats, args)
+  if status != 0:
+    sys.exit(status)
+
+def _record_processed (processor, manifest, filename, deferred,
+                       callback=None):
+  """Records a processed file in the manifest.  The XMP properties that are
+  still computed in the background (deferred as returned by the processor)
+  are marked as complete only once they have been written.  If callback
+  is given, it is called with the filename and list of properties whenever
+  some of them are complete."""
+
+  pending = {m.xmp_attribute for m, _ in deferred}
+  complete = [a for a in processor.xmp_attributes if a not in pending]
+  manifest.record(filename, complete)
+  if callback is not None:
+    callback(filename, complete)
+
+  def written(fn, attributes):
+    manifest.refresh(fn, attributes)
+    if callback is not None:
+      callback(fn, attributes)
+  if deferred:
+    processor.complete_deferred(filename, deferred, written)
+
+def _wait_deferred (processor):
+  """Waits for all values still computed in the background to be written,
+  and reports errors.  Returns false if there were any."""
+
+  count = processor.deferred_count
+  if count > 0:
+    print(f"Waiting for {count} background results...", file=sys.stderr)
+  processor.wait_deferred()
+  for filename, module, error in processor.deferred_errors:
+    print(f"Error processing {filename} ({module}): {error}", file=sys.stderr)
+  return not processor.deferred_errors
+
+def _print_summary (processor, skipped):
+  """Prints statistics at the end of processing."""
+  if skipped > 0:
+    print(f"Skipped {skipped} unchanged files", file=sys.stderr)
+  for m in processor.modules:
+    if m.summary is not None:
+      print(m.summary, file=sys.stderr)
+  if processor.cache is not None:
+    print(processor.cache.summary, file=sys.stderr)
+
+def _report_stats (stats, args):
+  """Prints and/or writes the collected statistics as requested."""
+  if args.stats:
+    print(stats.report(), file=sys.stderr)
+  if args.stats_file is not None:
+    stats.write(args.stats_file)
+
+def _print_import_times ():
+  """Prints the time spent on importing recallery itself and the
+  backends of all loaded modules, to keep an eye on startup time."""
+  print(f"Import time recallery.cli: {_IMPORT_TIME * 1000:.1f} ms",
+        file=sys.stderr)
+  for impl, duration in IMPORT_TIMES.items():
+    print(f"Import time {impl}: {duration * 1000:.1f} ms", file=sys.stderr)
+
+def _load_face_store_module (config):
+  """Loads the face detection module for commands that work on its face
+  store.  Prints an error and returns None if that is not possible."""
+
+  specs = [s for s in enabled_modules(config) if s.section == "faces"]
+  if not specs:
+    print("Error: face detection is not enabled", file=sys.stderr)
+    return None
+  try:
+    m = specs[0].load(config)
+  except RuntimeError as e:
+    print(f"Error: {e}", file=sys.stderr)
+    return None
+  if m.store is None:
+    print("Error: the face store is disabled", file=sys.stderr)
+    return None
+  return m
+
+def _rematch (config, index):
+  """Matches all faces in the face store against the current known faces
+  and updates DetectedPersons of the files accordingly, without running
+  face detection again.  Returns the exit code."""
+
+  m = _load_face_store_module(config)
+  if m is None:
+    return 1
+
+  processor = Processor(index,
+                        sidecar=config.get_boolean("xmp", "sidecar", False))
+  processor.add_module(m)
+  manifest = Manifest(config.manifest_file,
+                      config.get_boolean("scan", "hash", False))
+
+  total = 0
+  updated = 0
+  for path, _, value in m.rematch():
+    if not os.path.exists(path):
+      continue
+    total += 1
+    with processor.open_file(path) as f:
+      if f.get_custom_property(m.xmp_attribute) == value:
+        continue
+      print(f"Updating {path}...", file=sys.stderr)
+      processor.update_metadata(f, {m.xmp_attribute: value})
+    manifest.refresh(path)
+    updated += 1
+
+  print(f"Updated {updated} of {total} files", file=sys.stderr)
+  return 0
+
+def _cluster (config, args):
+  """Groups the faces in the face store that do not match any known person
+  into clusters of likely the same person, and exports a crop of a
+  representative face for each cluster (and the list of all its faces)
+  to the output directory.  Returns the exit code."""
+
+  from .cluster import cluster, representative, save_crop
+
+  if len(args) > 1:
+    print("Error: at most one output directory can be given", file=sys.stderr)
+    return 1
+  outdir = Path(args[0]) if args else config.datadir / "clusters"
+
+  m = _load_face_store_module(config)
+  if m is None:
+    return 1
+
+  radius = config.get("faces", "cluster_radius")
+  radius = 0.45 if radius is None else float(radius)
+  min_size = config.get("faces", "cluster_min_size")
+  min_size = 3 if min_size is None else int(min_size)
+
+  # Only faces in images that still exist are clustered, since their crops
+  # could not be exported otherwise.
+  paths = {}
+  for path, content_hash in m.store.files():
+    if content_hash not in paths and os.path.exists(path):
+      paths[content_hash] = path
+  faces, encodings = m.unknown_faces()
+  present = [i for i, f in enumerate(faces) if f[1] in paths]
+  faces = [faces[i] for i in present]
+  encodings = encodings[present]
+
+  print(f"Clustering {len(faces)} unknown faces...", file=sys.stderr)
+  clusters = cluster(encodings, radius, min_size)
+
+  outdir.mkdir(parents=True, exist_ok=True)
+  result = []
+  for i, members in enumerate(clusters):
+    crop = f"cluster-{i + 1:04d}.jpg"
+    _, content_hash, location = faces[representative(encodings, members)]
+    try:
+      save_crop(paths[content_hash], location, outdir / crop)
+    except OSError as e:
+      print(f"Warning: could not export {crop}: {e}", file=sys.stderr)
+    result.append({
+      "crop": crop,
+      "faces": [{"path": paths[faces[j][1]], "location": faces[j][2]}
+                for j in members],
+    })
+
+  with open(outdir / "clusters.json", "w", encoding="utf-8") as f:
+    json.dump(result, f, indent=1)
+
+  print(f"Found {len(clusters)} clusters and saved them to {outdir}",
+        file=sys.stderr)
+  return 0
+
+def _get_jobs (config, section, default):
+  """Returns the concurrency limit configured as "jobs" in the given
+  section, or the default."""
+  jobs = config.get(section, "jobs")
+  if jobs is None:
+    return default
+  return max(1, int(jobs))
+
+def _process_parallel (processor, manifest, files, args, cpu_jobs):
+  """Processes all files with up to args.jobs of them at the same time,
+  running CPU-bound modules in a process pool.  Progress and errors are
+  reported in the order of the files, and the return value is the exit
+  code (non-zero if any of the files failed)."""
+
+  def process_file(filename):
+    with processor.open_file(filename) as f:
+      deferred = processor.process(f, args.force)
+    _record_processed(processor, manifest, filename, deferred)
+
+  # The worker processes are started on demand from the pipeline's
+  # threads, so avoid forking a multi-threaded process.
+  ctx = multiprocessing.get_context("spawn")
+  failed = False
+  with concurrent.futures.ProcessPoolExecutor(max_workers=cpu_jobs,
+                                              mp_context=ctx) as executor:
+    processor.use_executor(executor)
+    for filename, _, error in Pipeline(args.jobs).map(process_file, files):
+      print(f"Processing {filename}...", file=sys.stderr)
+      if error is not None:
+        print(f"Error processing {filename}: {error}", file=sys.stderr)
+        failed = True
+
+  return 1 if failed else 0
+
+def _split_list (value):
+  """Splits a config value with a list of entries separated by commas or
+  newlines into a list."""
+  if value is None:
+    return []
+  return [v.strip() for v in value.replace("\n", ",").split(",") if v.strip()]
+
+def _watch (config, processor, manifest, paths, args, cpu_jobs):
+  """Runs as daemon that watches the given directories, and processes
+  image files as they are added or changed (once they have not changed
+  for [watch] settle seconds).  All modules (with their models and
+  connections) are loaded only once.  Files waiting for processing are
+  kept in a backlog in the data directory, which is picked up again
+  after a restart.  Runs until interrupted."""
+
+  from .watch import Backlog, Debouncer, DirectoryWatcher, is_image_file
+
+  settle = config.get("watch", "settle")
+  settle = 2.0 if settle is None else float(settle)
+  poll_interval = config.get("watch", "poll_interval")
+  poll_interval = 10.0 if poll_interval is None else float(poll_interval)
+
+  backlog = Backlog(config.watch_backlog_file)
+  debouncer = Debouncer(settle)
+  watcher = DirectoryWatcher(paths, poll_interval)
+
+  # Files that arrived while the daemon was not running.
+  backlog.add(f for f in iter_files(paths)
+              if is_image_file(f)
+                and not manifest.is_current(f, processor.xmp_attributes))
+  print(f"Watching {', '.join(paths)} ({len(backlog)} files in backlog)",
+        file=sys.stderr)
+
+  # Writing the metadata triggers another event for the file.  The size
+  # and mtime after each of our writes are remembered, so that these events
+  # are skipped also with --force (where the manifest is not checked).
+  own_writes = {}
+  own_writes_lock = threading.Lock()
+  def written(filename, attributes):
+    try:
+      st = os.stat(filename)
+    except FileNotFoundError:
+      return
+    with own_writes_lock:
+      own_writes[filename] = (st.st_size, st.st_mtime_ns)
+
+  def process_file(filename):
+    try:
+      st = os.stat(filename)
+    except FileNotFoundError:
+      return
+    with own_writes_lock:
+      if own_writes.get(filename) == (st.st_size, st.st_mtime_ns):
+        return
+    if not args.force and manifest.is_current(filename,
+                                              processor.xmp_attributes):
+      return
+    print(f"Processing {filename}...", file=sys.stderr)
+    with processor.open_file(filename) as f:
+      deferred = processor.process(f, args.force)
+    _record_processed(processor, manifest, filename, deferred, written)
+
+  executor = contextlib.nullcontext()
+  if args.jobs > 1:
+    ctx = multiprocessing.get_context("spawn")
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers=cpu_jobs,
+                                                      mp_context=ctx)
+
+  running = {}
+  try:
+    with executor, concurrent.futures.ThreadPoolExecutor(args.jobs) as pool:
+      if args.jobs > 1:
+        processor.use_executor(executor)
+      while True:
+        for filename in watcher.read(0.5):
+          debouncer.add(filename)
+        ready = debouncer.ready()
+        if ready:
+          backlog.add(ready)
+
+        for future in [f for f in running if f.done()]:
+          filename = running.pop(future)
+          error = future.exception()
+          if error is None:
+            backlog.remove(filename)
+          else:
+            attempts = backlog.fail(filename)
+            print(f"Error processing {filename} (attempt {attempts},"
+                  f" will retry): {error}", file=sys.stderr)
+
+        free = args.jobs - len(running)
+        if free > 0:
+          for filename in backlog.oldest(free, set(running.values())):
+            running[pool.submit(process_file, filename)] = filename
+  except KeyboardInterrupt:
+    print("Stopping, files in progress stay in the backlog", file=sys.stderr)
+    for future in running:
+      future.cancel()
+  finally:
+    watcher.close()
+
+  status = 0
+  if not _wait_deferred(processor):
+    status = 1
+  _print_summary(processor, 0)
+  _report_stats(processor.stats, args)
+  return status
+
+def _open_job_queue (config):
+  """Opens the job queue in the data directory with the settings from
+  the [queue] section."""
+
+  from .jobqueue import JobQueue
+
+  journal_mode = config.get("queue", "journal_mode")
+  if journal_mode is None:
+    journal_mode = "wal"
+  max_attempts = config.get("queue", "max_attempts")
+  max_attempts = 3 if max_attempts is None else int(max_attempts)
+  return JobQueue(config.job_queue_file, journal_mode, max_attempts)
+
+def _show_queue (config, args):
+  """Prints the state of the job queue.  Returns the exit code."""
+
+  queue = _open_job_queue(config)
+  if args.retry_failed:
+    count = queue.enqueue([path for path, _ in queue.failures()], True)
+    print(f"Queued {count} failed files again", file=sys.stderr)
+
+  counts = queue.counts()
+  for state in ["pending", "running", "done", "failed"]:
+    print(f"{state}: {counts.get(state, 0)}")
+  for path, error in queue.failures():
+    print(f"Failed: {path}: {error}")
+  return 0
+
+def _worker (config, processor, manifest, args, cpu_jobs):
+  """Processes files from the job queue until there are none left to
+  claim.  Any number of workers can run at the same time (also on
+  different hosts sharing the data directory), and each claims batches
+  of jobs with a lease that is renewed while the worker is alive.
+  Returns the exit code."""
+
+  queue = _open_job_queue(config)
+  lease = config.get("queue", "lease")
+  lease = 600.0 if lease is None else float(lease)
+  owner = f"{socket.gethostname()}:{os.getpid()}"
+  attributes = processor.xmp_attributes
+
+  # Jobs claimed and not yet done, whose leases are renewed periodically.
+  held = set()
+  held_lock = threading.Lock()
+  stop = threading.Event()
+  def heartbeat():
+    while not stop.wait(lease / 3):
+      with held_lock:
+        paths = list(held)
+      if paths:
+        queue.renew(owner, paths, lease)
+  threading.Thread(target=heartbeat, daemon=True).start()
+
+  def completed(filename, complete):
+    if queue.module_done(owner, filename, complete):
+      with held_lock:
+        held.discard(os.path.abspath(filename))
+
+  def process_file(filename):
+    with processor.open_file(filename) as f:
+      deferred = processor.process(f, args.force)
+    _record_processed(processor, manifest, filename, deferred, completed)
+
+  executor = contextlib.nullcontext()
+  if args.jobs > 1:
+    ctx = multiprocessing.get_context("spawn")
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers=cpu_jobs,
+                                                      mp_context=ctx)
+
+  processed = 0
+  failed = 0
+  try:
+    with executor:
+      if args.jobs > 1:
+        processor.use_executor(executor)
+      while True:
+        batch = queue.claim(owner, 4 * args.jobs, lease, attributes)
+        if not batch:
+          break
+        with held_lock:
+          held.update(batch)
+        for filename, _, error in Pipeline(args.jobs).map(process_file, batch):
+          print(f"Processing {filename}...", file=sys.stderr)
+          processed += 1
+          if error is not None:
+            print(f"Error processing {filename}: {error}", file=sys.stderr)
+            queue.fail(owner, filename, error)
+            failed += 1
+            with held_lock:
+              held.discard(filename)
+
+    _wait_deferred(processor)
+    for filename, _, error in processor.deferred_errors:
+      queue.fail(owner, filename, error)
+      failed += 1
+  except KeyboardInterrupt:
+    print("Stopping, unfinished jobs are released", file=sys.stderr)
+  finally:
+    stop.set()
+    with held_lock:
+      queue.release(owner, list(held))
+
+  print(f"Processed {processed} files ({failed} failed)", file=sys.stderr)
+  _print_summary(processor, 0)
+  _report_stats(processor.stats, args)
+  return 1 if failed else 0
 
 def _encode_face_image (task):
+  from .faces import processFaces
+
   person_name, image_path, model = task
   with open(image_path, "rb") as f:
     image_data = f.read()
@@ -133,13 +666,19 @@ def mainEncodeFaces ():
                       help="Data directory (defaults to ~/.recallery)")
   parser.add_argument("--faces", default=None,
                       help="Directory containing known faces")
+  parser.add_argument("--full", action="store_true",
+                      help="Encode all faces again, not only changed ones")
   args = parser.parse_args()
 
+  from .faces import KnownFaces
+
   config = Config(args.datadir)
 
   # Get face model configuration with default
+  # Reference images are always encoded with the full detector, also when
+  # images are screened first.
   model = config.get("faces", "model")
-  if model is None:
+  if model is None or model == "cascade":
     model = "cnn"
 
   if args.faces is None:
@@ -151,6 +690,27 @@ def mainEncodeFaces ():
     print(f"Error: Faces directory {faces_dir} does not exist", file=sys.stderr)
     sys.exit(1)
 
+  # Reference images that are unchanged since the last run (by stat data
+  # or content hash) keep their encoding, and only new or modified ones
+  # are encoded again.  Images that no longer exist are dropped.
+  previous = None
+  if not args.full:
+    try:
+      previous = KnownFaces.load(config.known_faces_dir)
+    except FileNotFoundError:
+      pass
+    if previous is not None and previous.model != model:
+      print(f"Model changed to {model}, encoding all faces", file=sys.stderr)
+      previous = None
+  by_path = {}
+  by_hash = {}
+  if previous is not None:
+    for i, source in enumerate(previous.sources):
+      if source is not None:
+        by_path[source["path"]] = i
+        by_hash[source["hash"]] = i
+
+  entries = []
   tasks = []
   for person_dir in sorted(faces_dir.iterdir()):
     if not person_dir.is_dir():
@@ -164,15 +724,37 @@ def mainEncodeFaces ():
       continue
 
     for image_path in image_files:
-      tasks.append((person_name, image_path, model))
-
-  known_faces = KnownFaces()
-
+      rel = f"{person_name}/{image_path.name}"
+      st = image_path.stat()
+      source = {"path": rel, "size": st.st_size, "mtime": st.st_mtime_ns}
+
+      row = by_path.get(rel)
+      if row is not None:
+        old = previous.sources[row]
+        if (old["size"], old["mtime"]) != (st.st_size, st.st_mtime_ns):
+          row = None
+        else:
+          source["hash"] = old["hash"]
+      if row is None:
+        source["hash"] = hash_file(image_path)
+        row = by_hash.get(source["hash"])
+      if (row is not None
+            and previous.names[previous.labels[row]] != person_name):
+        row = None
+
+      if row is None:
+        tasks.append((person_name, image_path, model))
+        entries.append((person_name, source, len(tasks) - 1, None))
+      else:
+        entries.append((person_name, source, None, row))
+
+  encoded = {}
   with concurrent.futures.ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
-    futures = {executor.submit(_encode_face_image, task): task for task in tasks}
+    futures = {executor.submit(_encode_face_image, task): i
+               for i, task in enumerate(tasks)}
     for future in concurrent.futures.as_completed(futures):
-      task = futures[future]
-      person_name, image_path, _ = task
+      i = futures[future]
+      person_name, image_path, _ = tasks[i]
       print(f"  {person_name}/{image_path.name}", end=" ... ", flush=True)
 
       result, error = future.result()
@@ -180,12 +762,102 @@ def mainEncodeFaces ():
         print(error, file=sys.stderr)
         sys.exit(1)
 
-      encoding, name, _ = result
-      known_faces.add(name, encoding)
+      encoding, _, _ = result
+      encoded[i] = encoding
 
       print("ok")
 
-  with open(config.encoded_faces_file, "wb") as f:
-    pickle.dump(known_faces, f)
+  # The rows are added in the order of the reference images, independent
+  # of which of them were encoded in this run.
+  known_faces = KnownFaces()
+  known_faces.model = model
+  for person_name, source, task, row in entries:
+    if task is not None:
+      encoding = encoded[task]
+    else:
+      encoding = previous.encodings[row]
+    known_faces.add(person_name, encoding, source)
+  known_faces.save(config.known_faces_dir)
+
+  kept = len(entries) - len(tasks)
+  removed = len(set(by_path) - {source["path"] for _, source, _, _ in entries})
+  print(f"\nEncoded {len(tasks)} faces, kept {kept} and removed {removed};"
+        f" saved {len(known_faces)} faces to {config.known_faces_dir}")
+
+def mainBuildGazetteer ():
+  parser = argparse.ArgumentParser(
+      description="Build the offline reverse geocoding index")
+  parser.add_argument("--datadir", default=None,
+                      help="Data directory (defaults to ~/.recallery)")
+  parser.add_argument("--format", choices=["geonames", "csv"],
+                      default="geonames",
+                      help="Format of the gazetteer dump")
+  parser.add_argument("--feature-classes", default="P",
+                      help="GeoNames feature classes to index (default: P)")
+  parser.add_argument("source", help="Gazetteer dump to index")
+  args = parser.parse_args()
+
+  from .gazetteer import build_index
+
+  config = Config(args.datadir)
+  outdir = config.gazetteer_dir
+
+  print(f"Indexing {args.source}...", file=sys.stderr)
+  count = build_index(args.source, outdir, args.format, args.feature_classes)
+  print(f"Indexed {count} places into {outdir}")
+
+def mainBenchmark ():
+  parser = argparse.ArgumentParser(
+      description="Benchmark processing with stand-in servers")
+  parser.add_argument("--corpus", default="bench-corpus",
+                      help="Directory of the benchmark corpus (generated"
+                           " if it does not exist)")
+  parser.add_argument("--images", type=int, default=50,
+                      help="Number of images when generating the corpus")
+  parser.add_argument("--face-images", default=None,
+                      help="Directory with JPEG faces to put into the"
+                           " generated corpus")
+  parser.add_argument("--known-faces", default=None,
+                      help="Encoded known faces directory (enables face"
+                           " detection)")
+  parser.add_argument("--workdir", default="bench-work",
+                      help="Scratch directory for the run")
+  parser.add_argument("-j", "--jobs", type=int, default=1,
+                      help="Number of files to process in parallel")
+  parser.add_argument("--nominatim-latency", type=float, default=0.05,
+                      help="Latency of the Nominatim stand-in in seconds")
+  parser.add_argument("--ollama-latency", type=float, default=0.5,
+                      help="Latency of the Ollama stand-in in seconds")
+  parser.add_argument("--no-caption", action="store_true",
+                      help="Do not run captioning")
+  parser.add_argument("--sidecar", action="store_true",
+                      help="Write metadata to XMP sidecar files")
+  parser.add_argument("--save", default=None,
+                      help="Save the results as JSON baseline to this file")
+  parser.add_argument("--compare", default=None,
+                      help="Compare against the JSON baseline in this file")
+  args = parser.parse_args()
 
-  print(f"\nEncoded {len(known_faces.persons)} faces and saved to {config.encoded_faces_file}")
+  from . import bench
+
+  corpus = Path(args.corpus)
+  if not corpus.exists():
+    face_images = None
+    if args.face_images is not None:
+      face_images = sorted(Path(args.face_images).glob("*.jpg"))
+    print(f"Generating {args.images} images in {corpus}...", file=sys.stderr)
+    bench.make_corpus(corpus, args.images, face_images=face_images)
+
+  res = bench.run(corpus, args.workdir, args.jobs, args.nominatim_latency,
+                  args.ollama_latency, args.known_faces,
+                  not args.no_caption, args.sidecar)
+
+  baseline = None
+  if args.compare is not None:
+    with open(args.compare) as f:
+      baseline = json.load(f)
+  print(bench.format_report(res, baseline))
+
+  if args.save is not None:
+    with open(args.save, "w") as f:
+      json.dump(res, f, indent=2)
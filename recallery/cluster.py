@@ -0,0 +1,196 @@
+#    recallery - image metadata indexing and search
+#    Copyright (C) 2025  Daniel Kraft <d@domob.eu>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from .image import ImageFile
+
+import numpy as np
+
+# Number of k-means iterations when building the index, and the maximum
+# number of points that are used for training the cell centroids.
+KMEANS_ITERATIONS = 10
+KMEANS_SAMPLE = 50_000
+
+# Upper bound on the number of elements of the temporary distance matrix
+# when assigning points to cells.
+ASSIGN_CHUNK_ELEMENTS = 16_000_000
+
+def _squared_norms (x):
+  return np.einsum("ij,ij->i", x, x)
+
+def _nearest (x, centroids):
+  """Returns the index of the nearest centroid for each row of x,
+  computed in chunks through matrix products."""
+
+  c_sq = _squared_norms(centroids)
+  res = np.empty(len(x), dtype=np.intp)
+  step = max(1, ASSIGN_CHUNK_ELEMENTS // max(1, len(centroids)))
+  for i in range(0, len(x), step):
+    # The squared norm of x is the same for all centroids, so it does
+    # not change the argmin.
+    d = c_sq[np.newaxis, :] - 2 * (x[i:i + step] @ centroids.T)
+    res[i:i + step] = np.argmin(d, axis=1)
+  return res
+
+class NeighbourIndex:
+  """Approximate nearest-neighbour index over a set of vectors (e.g. face
+  encodings).  The vectors are partitioned into cells by k-means, and
+  neighbours of the points in one cell are only searched in the cells with
+  the closest centroids.  All distance computations are done in blocks
+  as single-precision matrix products, so that building the index and
+  finding all close pairs is fast also for hundreds of thousands of
+  points."""
+
+  def __init__ (self, data, cells=None, probes=8, seed=0):
+    """Builds the index for the rows of data.  By default, the number of
+    cells is about the square root of the number of points.  probes is the
+    number of (closest) cells searched for the neighbours of each cell."""
+
+    self.data = np.ascontiguousarray(data, dtype=np.float32)
+    n = len(self.data)
+    if cells is None:
+      cells = int(np.sqrt(n))
+    cells = max(1, min(cells, n))
+    self.probes = min(probes, cells)
+
+    rng = np.random.default_rng(seed)
+    sample = self.data
+    if n > KMEANS_SAMPLE:
+      sample = self.data[rng.choice(n, KMEANS_SAMPLE, replace=False)]
+    centroids = sample[rng.choice(len(sample), cells, replace=False)].copy()
+    for _ in range(KMEANS_ITERATIONS):
+      assignment = _nearest(sample, centroids)
+      counts = np.bincount(assignment, minlength=cells)
+      sums = np.zeros_like(centroids)
+      np.add.at(sums, assignment, sample)
+      # Empty cells keep their previous centroid.
+      nonempty = counts > 0
+      centroids[nonempty] = sums[nonempty] / counts[nonempty, np.newaxis]
+    self.centroids = centroids
+
+    assignment = _nearest(self.data, centroids)
+    order = np.argsort(assignment, kind="stable")
+    bounds = np.searchsorted(assignment[order],
+                             np.arange(cells + 1))
+    self.cells = [order[bounds[c]:bounds[c + 1]] for c in range(cells)]
+
+  def neighbours (self, radius, k):
+    """Finds for each point up to k of its nearest neighbours that are
+    within radius.  Returns arrays of point pairs (i, j) with i != j."""
+
+    near_cells = _nearest_cells(self.centroids, self.probes)
+    sq_norms = _squared_norms(self.data)
+    sources = []
+    targets = []
+    for c, members in enumerate(self.cells):
+      if len(members) == 0:
+        continue
+      candidates = np.concatenate([self.cells[o] for o in near_cells[c]])
+      cand_data = self.data[candidates]
+      cand_sq = sq_norms[candidates]
+      # Each point is among its own candidates, so look for one more.
+      kk = min(k + 1, len(candidates))
+      step = max(1, ASSIGN_CHUNK_ELEMENTS // len(candidates))
+      for i in range(0, len(members), step):
+        block = members[i:i + step]
+        sq = self.data[block] @ cand_data.T
+        sq *= -2
+        sq += sq_norms[block, np.newaxis]
+        sq += cand_sq[np.newaxis, :]
+
+        best = np.argpartition(sq, kk - 1, axis=1)[:, :kk]
+        best_sq = np.take_along_axis(sq, best, axis=1)
+        rows = np.broadcast_to(block[:, np.newaxis], best.shape)
+        cols = candidates[best]
+        within = (best_sq <= radius * radius) & (rows != cols)
+        sources.append(rows[within])
+        targets.append(cols[within])
+
+    if not sources:
+      return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp)
+    return np.concatenate(sources), np.concatenate(targets)
+
+def _nearest_cells (centroids, probes):
+  """Returns for each centroid the indices of the probes closest ones
+  (including itself)."""
+  sq = _squared_norms(centroids)
+  d = sq[:, np.newaxis] + sq[np.newaxis, :] - 2 * (centroids @ centroids.T)
+  return np.argsort(d, axis=1)[:, :probes]
+
+def _components (n, sources, targets):
+  """Returns the connected component label of each of n nodes in the
+  graph with the given edges, by union-find with path halving."""
+
+  parent = list(range(n))
+  def find(x):
+    while parent[x] != x:
+      parent[x] = parent[parent[x]]
+      x = parent[x]
+    return x
+
+  for a, b in zip(sources.tolist(), targets.tolist()):
+    ra = find(a)
+    rb = find(b)
+    if ra != rb:
+      parent[max(ra, rb)] = min(ra, rb)
+  return np.array([find(x) for x in range(n)], dtype=np.intp)
+
+def cluster (encodings, radius, min_size=2, k=10, probes=8):
+  """Groups the given encodings into clusters of faces that are likely
+  the same person.  Each face is linked to up to k of its nearest
+  neighbours within radius, and clusters are the connected components
+  of that graph.  Returns a list of index arrays (one per cluster with
+  at least min_size faces), largest cluster first."""
+
+  n = len(encodings)
+  if n == 0:
+    return []
+
+  index = NeighbourIndex(encodings, probes=probes)
+  sources, targets = index.neighbours(radius, k)
+  labels = _components(n, sources, targets)
+
+  order = np.argsort(labels, kind="stable")
+  _, starts, counts = np.unique(labels[order], return_index=True,
+                                return_counts=True)
+  clusters = [order[s:s + c] for s, c in zip(starts, counts) if c >= min_size]
+  clusters.sort(key=lambda c: (-len(c), c[0]))
+  return clusters
+
+def representative (encodings, members):
+  """Returns the index (from members) of the face closest to the mean
+  encoding of the cluster."""
+  x = np.asarray(encodings[members], dtype=np.float32)
+  d = _squared_norms(x - x.mean(axis=0))
+  return members[np.argmin(d)]
+
+def save_crop (path, location, outfile, margin=0.4, max_size=256):
+  """Saves the face at the given location (top, right, bottom, left) of
+  the image file (or its embedded preview, in which the faces have been
+  detected), with a relative margin around it, as JPEG."""
+
+  with ImageFile(path) as f:
+    img = f.data.decoded
+  top, right, bottom, left = location
+  mx = int((right - left) * margin)
+  my = int((bottom - top) * margin)
+  box = (max(0, left - mx), max(0, top - my),
+         min(img.width, right + mx), min(img.height, bottom + my))
+
+  crop = img.crop(box)
+  if crop.mode not in ("RGB", "L"):
+    crop = crop.convert("RGB")
+  crop.thumbnail((max_size, max_size))
+  crop.save(outfile, format="JPEG", quality=90)
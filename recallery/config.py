@@ -41,12 +41,70 @@ class Config:
     if self.config_file.exists():
       self.config.read(self.config_file)
 
+  @property
+  def known_faces_dir (self):
+    """Returns the directory inside the data directory for the encoded
+    known faces."""
+    return self.datadir / "known_faces"
+
   @property
   def encoded_faces_file (self):
     """Returns the file inside the data directory for the encoded
-    face recognition data."""
+    face recognition data, as pickled by older versions."""
     return self.datadir / "face_encodings.pkl"
 
+  @property
+  def revgeo_cache_file (self):
+    """Returns the file inside the data directory for the cache of
+    reverse geocoding results."""
+    return self.datadir / "revgeo_cache.sqlite"
+
+  @property
+  def search_index_file (self):
+    """Returns the file inside the data directory for the full-text
+    search index."""
+    return self.datadir / "search.sqlite"
+
+  @property
+  def result_cache_file (self):
+    """Returns the file inside the data directory for the cache of
+    module results by image content."""
+    return self.datadir / "results.sqlite"
+
+  @property
+  def face_store_dir (self):
+    """Returns the directory inside the data directory for the store
+    of detected faces."""
+    return self.datadir / "facestore"
+
+  @property
+  def manifest_file (self):
+    """Returns the file inside the data directory for the manifest
+    of processed files."""
+    return self.datadir / "manifest.sqlite"
+
+  @property
+  def watch_backlog_file (self):
+    """Returns the file inside the data directory for the backlog of
+    files waiting for the watch daemon."""
+    return self.datadir / "watch.sqlite"
+
+  @property
+  def job_queue_file (self):
+    """Returns the file inside the data directory for the queue of
+    files to process by workers."""
+    return self.datadir / "jobs.sqlite"
+
+  @property
+  def gazetteer_dir (self):
+    """Returns the directory for the offline reverse geocoding index,
+    which can be set as [revgeo] gazetteer or is inside the data
+    directory by default."""
+    path = self.get("revgeo", "gazetteer")
+    if path is not None:
+      return Path(path)
+    return self.datadir / "gazetteer"
+
   def get (self, cat, nm):
     """Returns the configuration key for a given category and name.  Returns
     None if it is not defined."""
@@ -54,3 +112,12 @@ class Config:
       return self.config.get(cat, nm)
     except (configparser.NoSectionError, configparser.NoOptionError):
       return None
+
+  def get_boolean (self, cat, nm, default):
+    """Returns the configuration key for a given category and name
+    interpreted as boolean (e.g. "yes" or "off"), or the default if it
+    is not defined."""
+    try:
+      return self.config.getboolean(cat, nm)
+    except (configparser.NoSectionError, configparser.NoOptionError):
+      return default
@@ -15,42 +15,80 @@
 #    along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 from .base import Module
+from .facestore import FaceStore
+from .image import ImageData
 
 import face_recognition
-import io
+import hashlib
+import json
 import numpy as np
-from PIL import Image
+import os
+from pathlib import Path
+import pickle
+import threading
 
 DOWNSCALING_TARGET_PIXELS = 2_000_000
 
+# In tiled detection, the fraction by which neighbouring tiles overlap,
+# and the fraction of the smaller of two face boxes that they must overlap
+# to be merged as duplicates.
+TILE_OVERLAP = 0.25
+DUPLICATE_OVERLAP = 0.5
+
+# Margin (relative to the face size) around faces that is cropped for
+# computing the encodings in tiled detection.
+ENCODING_CROP_MARGIN = 0.5
+
+# Approximate memory (in bytes) needed per pixel of a decoded image.
+BYTES_PER_PIXEL = 3
+
+# Upper bound on the number of elements in the temporary array of
+# differences when matching faces against the known encodings.
+MATCHING_CHUNK_ELEMENTS = 16_000_000
+
+# Number of stored faces that are matched at once when rematching.
+REMATCH_CHUNK_FACES = 4096
+
+# Files of the known faces inside their directory: the encodings as matrix
+# in NumPy format, and the table of names and the source of each row.
+KNOWN_ENCODINGS_FILE = "encodings.npy"
+KNOWN_TABLE_FILE = "names.json"
+
 def processFaces (data, model):
   """Processes all faces (locates them and computes their encodings)
-  in the given image, which is passed in-memory as a bytes string.
-  Returns an array of face encodings.
+  in the given image, which is passed in-memory as a bytes string or
+  as ImageData instance (whose decoded pixels are reused).
+  Returns an array of face encodings."""
+  return detectFaces(data, model)[1]
+
+def detectFaces (data, model):
+  """Locates all faces in the given image (bytes or ImageData) and computes
+  their encodings.  Returns a tuple of the list of face locations (as
+  top, right, bottom, left) and the list of encodings.
   
   Uses a hybrid approach for performance:
   - Face detection runs on a downscaled image
   - Face encoding uses the full resolution image for quality
   """
-  img = Image.open(io.BytesIO(data))
-  img_array = np.array(img)
-  
+  if not isinstance(data, ImageData):
+    data = ImageData(data)
+
   # Get original dimensions
-  height, width = img_array.shape[:2]
+  width, height = data.size
   original_pixels = height * width
   
   # Calculate scale factor if downscaling is needed
   if original_pixels > DOWNSCALING_TARGET_PIXELS:
     scale_factor = np.sqrt(DOWNSCALING_TARGET_PIXELS / original_pixels)
     
-    # Downscale for face detection using PIL
-    new_width = int(width * scale_factor)
-    new_height = int(height * scale_factor)
-    img_small_pil = img.resize((new_width, new_height), Image.LANCZOS)
-    img_small = np.array(img_small_pil)
-    
-    # Detect faces on downscaled image
+    # Detect faces on a downscaled rendition, which is decoded at reduced
+    # size already for JPEG files
+    img_small = np.array(data.rendition(DOWNSCALING_TARGET_PIXELS))
     face_locations_small = face_recognition.face_locations(img_small, model=model)
+
+    # Without any faces, there is no need to decode the full image at all
+    if not face_locations_small:
+      return [], []
     
     # Scale face locations back to original image coordinates
     face_locations = []
@@ -63,31 +101,361 @@ def processFaces (data, model):
       ))
   else:
     # Image is already small enough, no downscaling needed
-    face_locations = face_recognition.face_locations(img_array, model=model)
+    face_locations = face_recognition.face_locations(data.pixels, model=model)
   
   # Extract encodings from FULL resolution image for quality
-  face_encodings = face_recognition.face_encodings(img_array, face_locations)
-  return face_encodings
+  face_encodings = face_recognition.face_encodings(data.pixels, face_locations)
+  return face_locations, face_encodings
+
+def _tiles (width, height, size):
+  """Returns the boxes (left, top, right, bottom) of overlapping tiles of
+  at most size x size pixels that cover an image of the given size."""
+
+  step = max(1, int(size * (1 - TILE_OVERLAP)))
+  def starts(n):
+    if n <= size:
+      return [0]
+    return list(range(0, n - size, step)) + [n - size]
+
+  return [(x, y, min(width, x + size), min(height, y + size))
+          for y in starts(height) for x in starts(width)]
+
+def _box_area (loc):
+  top, right, bottom, left = loc
+  return max(0, right - left) * max(0, bottom - top)
+
+def _merge_duplicates (locations):
+  """Merges face locations (top, right, bottom, left) that overlap by more
+  than DUPLICATE_OVERLAP of the smaller one (e.g. the same face found in
+  two tiles or passes), keeping the largest box of each."""
+
+  res = []
+  for loc in sorted(locations, key=_box_area, reverse=True):
+    top, right, bottom, left = loc
+    for t, r, b, l in res:
+      inter = (max(0, min(right, r) - max(left, l))
+                * max(0, min(bottom, b) - max(top, t)))
+      if inter > DUPLICATE_OVERLAP * _box_area(loc):
+        break
+    else:
+      res.append(loc)
+  return res
+
+def _scale_locations (locations, factor, offset=(0, 0)):
+  """Maps face locations found on a part (at offset x, y) of an image scaled
+  by factor back to the coordinates of the full image."""
+  x, y = offset
+  return [(int((top + y) / factor), int((right + x) / factor),
+           int((bottom + y) / factor), int((left + x) / factor))
+          for (top, right, bottom, left) in locations]
+
+def detectFacesTiled (data, model, tile_size, tile_pixels, max_memory):
+  """Locates all faces in the given image (bytes or ImageData) and computes
+  their encodings like detectFaces, but with bounded memory and better
+  detection of small faces in very large images.
+
+  Large faces are detected on a rendition of DOWNSCALING_TARGET_PIXELS,
+  and small ones in overlapping tiles of tile_size pixels square of a
+  rendition with up to tile_pixels.  Duplicates between tiles and passes
+  are merged.  For the encodings, the image is decoded at the highest
+  resolution that fits into max_memory bytes (the full one unless the
+  image is very large), and only crops around the faces are kept of it.
+
+  For JPEG files, no decoded image is ever larger than max_memory (up to
+  the 1/8 scaling of the decoder).  Other formats are decoded in full."""
+
+  if not isinstance(data, ImageData):
+    data = ImageData(data)
+
+  width, height = data.size
+  max_pixels = max(DOWNSCALING_TARGET_PIXELS, max_memory // BYTES_PER_PIXEL)
+  tile_pixels = min(tile_pixels, max_pixels)
+
+  img = data.rendition(DOWNSCALING_TARGET_PIXELS)
+  locations = _scale_locations(
+      face_recognition.face_locations(np.array(img), model=model),
+      img.width / width)
+
+  if width * height > DOWNSCALING_TARGET_PIXELS:
+    img = data.decode_scaled(tile_pixels)
+    if img.width * img.height > DOWNSCALING_TARGET_PIXELS:
+      pixels = np.asarray(img)
+      for left, top, right, bottom in _tiles(img.width, img.height, tile_size):
+        tile = np.ascontiguousarray(pixels[top:bottom, left:right])
+        found = face_recognition.face_locations(tile, model=model)
+        locations.extend(_scale_locations(found, img.width / width,
+                                          (left, top)))
+      del pixels
+    del img
+
+  locations = _merge_duplicates(locations)
+  if not locations:
+    return [], []
+
+  # Cut out the faces (with some margin) from the decoded image, and then
+  # release it before computing the encodings.
+  img = data.decode_scaled(max_pixels)
+  factor = img.width / width
+  crops = []
+  for (top, right, bottom, left) in _scale_locations(locations, 1 / factor):
+    mx = int((right - left) * ENCODING_CROP_MARGIN)
+    my = int((bottom - top) * ENCODING_CROP_MARGIN)
+    box = (max(0, left - mx), max(0, top - my),
+           min(img.width, right + mx), min(img.height, bottom + my))
+    crop = img.crop(box)
+    if crop.mode != "RGB":
+      crop = crop.convert("RGB")
+    crops.append((np.array(crop), (top - box[1], right - box[0],
+                                   bottom - box[1], left - box[0])))
+  del img
+
+  encodings = [face_recognition.face_encodings(crop, [loc])[0]
+               for crop, loc in crops]
+  return locations, encodings
+
+def screenFaces (data, model, max_pixels):
+  """Runs a cheap detection pass with the given model on a rendition of
+  the image with at most max_pixels pixels.  Returns true if any face
+  was found, i.e. if the full detection should be run."""
+  if not isinstance(data, ImageData):
+    data = ImageData(data)
+
+  width, height = data.size
+  if width * height > max_pixels:
+    pixels = np.array(data.rendition(max_pixels))
+  else:
+    pixels = data.pixels
+  return len(face_recognition.face_locations(pixels, model=model)) > 0
 
 class KnownFaces:
-  """This class represents all known faces."""
+  """This class represents all known faces.  The encodings are held as rows
+  of a contiguous matrix, together with an index of the person each row
+  belongs to, so that faces can be matched against all of them at once.
+  For each row, the reference image it was encoded from can be recorded
+  as source (a dict with its path, size, mtime and hash), which allows
+  updating the known faces incrementally."""
 
   def __init__ (self):
-    self.persons = []
+    self.names = []
+    self.sources = []
+    self.model = None
+    self._name_index = {}
+    self._labels = []
+    self._label_array = np.empty(0, dtype=np.intp)
+    self._rows = []
+    self._encodings = None
+    self._known32 = None
+    self._fingerprint = None
+
+  def __len__ (self):
+    return len(self._labels)
+
+  def __getstate__ (self):
+    return {"names": self.names, "labels": self.labels,
+            "encodings": self.encodings}
+
+  def __setstate__ (self, state):
+    self.__init__ ()
+    if "persons" in state:
+      # Data pickled by older versions, with a list of dicts.
+      for p in state["persons"]:
+        self.add (p["name"], p["encoding"])
+      return
+
+    for name in state["names"]:
+      self._name_index[name] = len(self.names)
+      self.names.append(name)
+    self._labels = list(state["labels"])
+    self._encodings = state["encodings"]
+    self.sources = [None] * len(self._labels)
+
+  @classmethod
+  def load (cls, directory):
+    """Loads the known faces saved to the given directory.  The encodings
+    are memory-mapped rather than read.  Raises FileNotFoundError if
+    there are no known faces saved there."""
+
+    directory = Path(directory)
+    with open(directory / KNOWN_TABLE_FILE, "r", encoding="utf-8") as f:
+      table = json.load(f)
+    encodings = np.load(directory / KNOWN_ENCODINGS_FILE, mmap_mode="r")
+    if encodings.shape != (len(table["labels"]), 128):
+      raise RuntimeError(f"known faces in {directory} are inconsistent")
+
+    res = cls()
+    for name in table["names"]:
+      res._name_index[name] = len(res.names)
+      res.names.append(name)
+    res._labels = list(table["labels"])
+    res._encodings = encodings
+    res.sources = table["sources"]
+    res.model = table.get("model")
+    return res
+
+  def save (self, directory):
+    """Saves the known faces to the given directory, in the format read
+    by load.  Each file is replaced atomically, and the table (which is
+    checked against the encodings when loading) is written last."""
+
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+
+    tmp = directory / (KNOWN_ENCODINGS_FILE + ".tmp")
+    with open(tmp, "wb") as f:
+      np.save(f, np.asarray(self.encodings, dtype=np.float64))
+    os.replace(tmp, directory / KNOWN_ENCODINGS_FILE)
+
+    table = {
+      "model": self.model,
+      "names": self.names,
+      "labels": [int(l) for l in self._labels],
+      "sources": self.sources,
+    }
+    tmp = directory / (KNOWN_TABLE_FILE + ".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+      json.dump(table, f, indent=1)
+    os.replace(tmp, directory / KNOWN_TABLE_FILE)
+
+  def add (self, name, encoding, source=None):
+    if name not in self._name_index:
+      self._name_index[name] = len(self.names)
+      self.names.append(name)
+    self._labels.append (self._name_index[name])
+    self._rows.append (np.asarray(encoding))
+    self.sources.append (source)
+
+  @property
+  def fingerprint (self):
+    """Returns a hash of all known names and encodings, which changes
+    whenever the known faces change."""
+    if self._fingerprint is None or self._fingerprint[0] != len(self):
+      h = hashlib.sha256()
+      h.update(json.dumps(self.names).encode("utf-8"))
+      h.update(self.labels.tobytes())
+      h.update(np.ascontiguousarray(self.encodings).tobytes())
+      self._fingerprint = (len(self), h.hexdigest())
+    return self._fingerprint[1]
+
+  @property
+  def labels (self):
+    """Returns an array that has, for each known encoding, the index
+    of the person's name in names."""
+    if len(self._label_array) != len(self._labels):
+      self._label_array = np.array(self._labels, dtype=np.intp)
+    return self._label_array
+
+  @property
+  def encodings (self):
+    """Returns the matrix of all known encodings (one per row)."""
+    if self._rows:
+      parts = [] if self._encodings is None else [self._encodings]
+      self._encodings = np.vstack(parts + self._rows)
+      self._rows = []
+    if self._encodings is None:
+      return np.empty((0, 128))
+    return self._encodings
+
+  def distances (self, faces):
+    """Returns the matrix of Euclidean distances between each of the
+    given face encodings (rows) and each of the known encodings (columns).
+    The computation is batched, with the temporary difference array
+    bounded in size."""
+
+    faces = np.asarray(faces)
+    known = self.encodings
+    res = np.empty((len(faces), len(known)))
+    step = max(1, MATCHING_CHUNK_ELEMENTS // max(1, known.size))
+    for i in range(0, len(faces), step):
+      diff = faces[i:i + step, np.newaxis, :] - known[np.newaxis, :, :]
+      res[i:i + step] = np.linalg.norm(diff, axis=2)
+    return res
 
-  def add (self, name, encoding):
-    self.persons.append ({"name": name, "encoding": encoding})
+  def fast_distances (self, faces):
+    """Returns the same as distances, but computed in single precision
+    through a matrix product (i.e. in BLAS).  This is much faster for many
+    faces, but the results may differ slightly from the exact ones."""
+
+    if self._known32 is None or len(self._known32[0]) != len(self):
+      known = np.asarray(self.encodings, dtype=np.float32)
+      self._known32 = (known, np.einsum("ij,ij->i", known, known))
+    known, known_sq = self._known32
+
+    faces = np.asarray(faces, dtype=np.float32)
+    faces_sq = np.einsum("ij,ij->i", faces, faces)
+    sq = faces_sq[:, np.newaxis] + known_sq[np.newaxis, :] - 2 * (faces @ known.T)
+    return np.sqrt(np.maximum(sq, 0))
+
+  def best_matches (self, faces, fast=False):
+    """Finds the closest known encoding for each of the given faces.
+    Returns arrays of the index into names of the best-matching person
+    and the distance for each face.  If fast is set, the distances are
+    computed with fast_distances."""
+
+    dist = self.fast_distances(faces) if fast else self.distances(faces)
+    best = np.argmin(dist, axis=1)
+    return self.labels[best], dist[np.arange(len(best)), best]
+
+  def names_within (self, labels, dists, tolerance):
+    """Returns the names for the best matches of faces (as returned by
+    best_matches) that are within the tolerance, ordered by increasing
+    distance and without duplicates."""
+
+    order = np.argsort(dists, kind="stable")
+    order = order[dists[order] <= tolerance]
+    labels = labels[order]
+
+    _, first = np.unique(labels, return_index=True)
+    return [self.names[l] for l in labels[np.sort(first)]]
+
+  def match (self, faces, tolerance):
+    """Matches the given face encodings against all known faces.  Returns
+    the names of the persons best matching each of the faces within the
+    tolerance, ordered by increasing distance and without duplicates."""
+
+    if len(faces) == 0 or len(self) == 0:
+      return []
+
+    labels, dists = self.best_matches(faces)
+    return self.names_within(labels, dists, tolerance)
 
 class FaceDetection (Module):
   """Module that detects known faces in pictures."""
 
-  def __init__ (self, model, tolerance, known):
+  def __init__ (self, model, tolerance, known, store=None, screen=None,
+                tiling=None):
     """Initialises the module with the model to use and the KnownFaces
-    instance that we use as ground truth."""
+    instance that we use as ground truth.  If a FaceStore is given,
+    detected faces are saved to it and reused from it.  screen can be
+    a tuple of a cheaper model and a pixel count, in which case images
+    are first screened with it (see screenFaces), and only those where
+    it finds faces are passed on to the full detection.  tiling can be
+    a tuple of the tile size, tile rendition pixels and memory cap (in
+    bytes) for detectFacesTiled, which is then used for detection."""
 
     self.model = model
     self.tolerance = tolerance
     self.known = known
+    self.store = store
+    self.screen = screen
+    self.tiling = tiling
+    self.executor = None
+
+    self._lock = threading.Lock()
+    self._screened = 0
+    self._escalated = 0
+
+  @property
+  def detector (self):
+    """Returns a string describing the face detection settings, which
+    determine the detected locations and encodings."""
+    res = f"{self.model}:{DOWNSCALING_TARGET_PIXELS}"
+    if self.tiling is not None:
+      tile_size, tile_pixels, max_memory = self.tiling
+      res = f"{res}+tiled:{tile_size}:{tile_pixels}:{max_memory}"
+    if self.screen is not None:
+      screen_model, screen_pixels = self.screen
+      res = f"{screen_model}:{screen_pixels}>{res}"
+    return res
 
   @property
   def name (self):
@@ -97,35 +465,203 @@ class FaceDetection (Module):
   def xmp_attribute (self):
     return "DetectedPersons"
 
-  def process (self, img):
-    encodings = processFaces(img.raw_data, self.model)
-    if not encodings:
+  @property
+  def input_pixels (self):
+    return DOWNSCALING_TARGET_PIXELS
+
+  @property
+  def cpu_bound (self):
+    return True
+
+  def use_executor (self, executor):
+    self.executor = executor
+
+  @property
+  def summary (self):
+    if self.screen is None or self._screened == 0:
       return None
+    percent = 100 * self._escalated / self._screened
+    return (f"Face screening: {self._escalated} of {self._screened} images"
+            f" ({percent:.1f}%) needed the full {self.model} detection")
 
-    matches = []
-    for encoding in encodings:
-      best_name = None
-      best_distance = float('inf')
-
-      for person in self.known.persons:
-        distance = face_recognition.face_distance([person["encoding"]], encoding)[0]
-        if distance < best_distance:
-          best_distance = distance
-          best_name = person["name"]
-
-      if best_name is not None:
-        matches.append((best_name, best_distance))
-
-    matches.sort(key=lambda x: x[1])
-    seen = set()
-    names = []
-    for name, dist in matches:
-      if dist > self.tolerance:
-        break
-      if name not in seen:
-        names.append(name)
-        seen.add(name)
+  def cache_key (self, img):
+    return json.dumps ([
+      "faces", self.detector, self.tolerance, self.known.fingerprint,
+    ])
+
+  def _run (self, fcn, *args):
+    """Runs the given function in the executor, if there is one."""
+    if self.executor is None:
+      return fcn(*args)
+    return self.executor.submit(fcn, *args).result()
+
+  def _detect (self, data):
+    """Runs face detection (including screening) on the ImageData.
+    Returns the face locations and encodings."""
+
+    if self.screen is not None:
+      found = self._run(screenFaces, data, *self.screen)
+      with self._lock:
+        self._screened += 1
+        if found:
+          self._escalated += 1
+      if not found:
+        return [], []
+
+    if self.tiling is not None:
+      return self._run(detectFacesTiled, data, self.model, *self.tiling)
+    return self._run(detectFaces, data, self.model)
+
+  def process (self, img):
+    stored = None
+    if self.store is not None:
+      content_hash = img.data.pixel_hash
+      stored = self.store.get(content_hash, self.detector)
+
+    if stored is not None:
+      _, encodings = stored
+    else:
+      locations, encodings = self._detect(img.data)
+      if self.store is not None:
+        self.store.put(content_hash, self.detector, locations, encodings)
+        # Match with the precision of the store, so that the result is the
+        # same as when the faces are taken from it (or rematched) later.
+        encodings = np.asarray(encodings, dtype=np.float32).astype(np.float64)
 
+    if self.store is not None:
+      self.store.link(img.filename, content_hash)
+
+    if len(encodings) == 0:
+      return None
+
+    names = self.known.match(encodings, self.tolerance)
     if names:
       return ", ".join (names)
     return None
+
+  def cached (self, img, val):
+    if self.store is not None:
+      self.store.link(img.filename, img.data.pixel_hash)
+
+  def _match_stored (self, faces, fast=False):
+    """Finds the best-matching known person for each of the given faces
+    from the store (as returned by its faces method), in chunks.  Returns
+    arrays of the labels and distances.  The distances are exact (as when
+    processing files) unless fast is set."""
+
+    ids = np.array([f[0] for f in faces], dtype=np.intp)
+    labels = np.empty(len(ids), dtype=np.intp)
+    dists = np.full(len(ids), np.inf)
+    if len(self.known) == 0:
+      return labels, dists
+
+    encodings = self.store.encodings()
+    for i in range(0, len(ids), REMATCH_CHUNK_FACES):
+      chunk = encodings[ids[i:i + REMATCH_CHUNK_FACES]]
+      if not fast:
+        chunk = np.asarray(chunk, dtype=np.float64)
+      labels[i:i + REMATCH_CHUNK_FACES], dists[i:i + REMATCH_CHUNK_FACES] \
+          = self.known.best_matches(chunk, fast=fast)
+    return labels, dists
+
+  def unknown_faces (self):
+    """Returns all faces in the store that do not match any known person
+    within the tolerance, as a list of (face ID, content hash, location)
+    tuples and the matrix of their encodings."""
+
+    # Faces close to the tolerance do not matter much for clustering, so
+    # the faster single-precision distances are good enough here.
+    faces = self.store.faces()
+    _, dists = self._match_stored(faces, fast=True)
+    unknown = np.flatnonzero(dists > self.tolerance)
+    ids = np.array([faces[i][0] for i in unknown], dtype=np.intp)
+    return [faces[i] for i in unknown], self.store.encodings()[ids]
+
+  def rematch (self):
+    """Matches all faces in the store against the known faces again, without
+    running face detection.  Yields tuples (path, content hash, value) for
+    all files in the store, where value is the new DetectedPersons value."""
+
+    faces = self.store.faces()
+    labels, dists = self._match_stored(faces)
+
+    # Faces are ordered by ID, and thus by image in detection order.
+    by_hash = {}
+    for i, (_, content_hash, _) in enumerate(faces):
+      by_hash.setdefault(content_hash, []).append(i)
+
+    values = {}
+    for path, content_hash in self.store.files():
+      if content_hash not in values:
+        names = []
+        indices = by_hash.get(content_hash)
+        if indices is not None:
+          names = self.known.names_within(labels[indices], dists[indices],
+                                          self.tolerance)
+        values[content_hash] = ", ".join(names) if names else None
+      yield path, content_hash, values[content_hash]
+
+def load_known_faces (config):
+  """Loads the known faces for the given Config, either saved by
+  recallery-encode-faces to the data directory or from the pickle file
+  written by older versions.  Raises FileNotFoundError if neither
+  exists."""
+
+  try:
+    return KnownFaces.load(config.known_faces_dir)
+  except FileNotFoundError:
+    with open(config.encoded_faces_file, "rb") as f:
+      return pickle.load(f)
+
+def from_config (config):
+  """Creates the face detection module for the [faces] section of the
+  given Config, using the known faces encoded in the data directory."""
+
+  model = config.get("faces", "model")
+  if model is None:
+    model = "cnn"
+
+  # In cascade mode, images are screened with a cheap detector (HOG by
+  # default, or CNN on a small rendition), and only images where it finds
+  # faces go through the full CNN detection.
+  screen = None
+  if model == "cascade":
+    model = "cnn"
+    screen_model = config.get("faces", "screen_model")
+    if screen_model is None:
+      screen_model = "hog"
+    screen_pixels = config.get("faces", "screen_pixels")
+    if screen_pixels is None:
+      screen_pixels = DOWNSCALING_TARGET_PIXELS
+    else:
+      screen_pixels = int(screen_pixels)
+    screen = (screen_model, screen_pixels)
+
+  # In tiled mode, large images are searched for faces in tiles of a
+  # higher-resolution rendition, and decoded images are kept below
+  # max_memory megabytes (see detectFacesTiled).
+  tiling = None
+  if config.get_boolean("faces", "tiled", False):
+    tile_size = config.get("faces", "tile_size")
+    tile_size = 1024 if tile_size is None else int(tile_size)
+    tile_pixels = config.get("faces", "tile_pixels")
+    tile_pixels = 16_000_000 if tile_pixels is None else int(tile_pixels)
+    max_memory = config.get("faces", "max_memory")
+    max_memory = 128 if max_memory is None else float(max_memory)
+    tiling = (tile_size, tile_pixels, int(max_memory * 1024 * 1024))
+
+  tolerance = config.get("faces", "tolerance")
+  if tolerance is None:
+    tolerance = 0.5
+  else:
+    tolerance = float(tolerance)
+
+  known_faces = load_known_faces(config)
+
+  # Detected faces are stored by default, so that changes to the known
+  # faces or tolerance do not require detecting them again.
+  store = None
+  if config.get_boolean("faces", "store", True):
+    store = FaceStore(config.face_store_dir)
+
+  return FaceDetection(model, tolerance, known_faces, store, screen, tiling)
@@ -0,0 +1,183 @@
+#    recallery - image metadata indexing and search
+#    Copyright (C) 2025  Daniel Kraft <d@domob.eu>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import contextlib
+import os
+import sqlite3
+import threading
+from pathlib import Path
+
+import numpy as np
+
+# Number of values in a face encoding, and size of its row in the file.
+ENCODING_SIZE = 128
+ROW_BYTES = ENCODING_SIZE * 4
+
+class FaceStore:
+  """Persistent store of the faces detected in images, keyed by the image
+  content hash.  The encodings are appended as float32 rows to a flat file
+  that is memory-mapped for reading, while an SQLite database indexes them
+  by image and face box, and maps file paths to content hashes.  This allows
+  matching all faces of the library again without running detection.
+
+  The store can be shared by multiple processes (e.g. workers): face IDs
+  are allocated in a database transaction, and each face is written at
+  the fixed offset of its ID in the encodings file."""
+
+  def __init__ (self, directory):
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    self._encodings_file = directory / "encodings.f32"
+
+    self._lock = threading.Lock()
+    self._db = sqlite3.connect(directory / "faces.sqlite", timeout=60,
+                               isolation_level=None, check_same_thread=False)
+    self._db.execute("""
+      CREATE TABLE IF NOT EXISTS `images` (
+        `hash` TEXT PRIMARY KEY,
+        `detector` TEXT NOT NULL
+      )
+    """)
+    self._db.execute("""
+      CREATE TABLE IF NOT EXISTS `faces` (
+        `id` INTEGER PRIMARY KEY,
+        `hash` TEXT NOT NULL,
+        `top` INTEGER NOT NULL,
+        `right` INTEGER NOT NULL,
+        `bottom` INTEGER NOT NULL,
+        `left` INTEGER NOT NULL
+      )
+    """)
+    self._db.execute("""
+      CREATE INDEX IF NOT EXISTS `faces_hash` ON `faces` (`hash`)
+    """)
+    self._db.execute("""
+      CREATE TABLE IF NOT EXISTS `files` (
+        `path` TEXT PRIMARY KEY,
+        `hash` TEXT NOT NULL
+      )
+    """)
+
+  def close (self):
+    with self._lock:
+      self._db.close()
+
+  @contextlib.contextmanager
+  def _transaction (self):
+    """Runs a write transaction, which takes the database lock right away
+    so that concurrent processes are serialised."""
+    with self._lock:
+      self._db.execute("BEGIN IMMEDIATE")
+      try:
+        yield
+      except BaseException:
+        self._db.execute("ROLLBACK")
+        raise
+      self._db.execute("COMMIT")
+
+  def encodings (self):
+    """Returns all stored encodings as memory-mapped float32 matrix,
+    indexed by face ID."""
+    try:
+      rows = os.path.getsize(self._encodings_file) // ROW_BYTES
+    except FileNotFoundError:
+      rows = 0
+    if rows == 0:
+      return np.empty((0, ENCODING_SIZE), dtype=np.float32)
+    return np.memmap(self._encodings_file, dtype=np.float32, mode="r",
+                     shape=(rows, ENCODING_SIZE))
+
+  def get (self, content_hash, detector):
+    """Returns the stored face locations and encodings for the image with
+    the given content hash as tuple, or None if it has not been processed
+    with the given detector (a string describing the model and settings)."""
+
+    with self._lock:
+      row = self._db.execute("""
+        SELECT `detector` FROM `images` WHERE `hash` = ?
+      """, (content_hash,)).fetchone()
+      if row is None or row[0] != detector:
+        return None
+      rows = self._db.execute("""
+        SELECT `id`, `top`, `right`, `bottom`, `left`
+          FROM `faces`
+          WHERE `hash` = ?
+          ORDER BY `id`
+      """, (content_hash,)).fetchall()
+
+    ids = [r[0] for r in rows]
+    locations = [tuple(r[1:]) for r in rows]
+    encodings = np.array(self.encodings()[ids], dtype=np.float64)
+    return locations, encodings
+
+  def put (self, content_hash, detector, locations, encodings):
+    """Stores the faces detected in the image with the given hash,
+    replacing any that were stored before."""
+
+    data = np.asarray(encodings, dtype=np.float32).reshape(-1, ENCODING_SIZE)
+    with self._transaction():
+      # Rows beyond the last one referenced from the database may be left
+      # over from an interrupted write, and are overwritten.  The encodings
+      # are on disk before the faces referencing them are committed.
+      (last,) = self._db.execute("SELECT MAX(`id`) FROM `faces`").fetchone()
+      first = 0 if last is None else last + 1
+      if len(data) > 0:
+        fd = os.open(self._encodings_file, os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+          os.pwrite(fd, data.tobytes(), first * ROW_BYTES)
+          os.fsync(fd)
+        finally:
+          os.close(fd)
+
+      self._db.execute("DELETE FROM `faces` WHERE `hash` = ?",
+                       (content_hash,))
+      self._db.execute("""
+        INSERT OR REPLACE INTO `images` (`hash`, `detector`) VALUES (?, ?)
+      """, (content_hash, detector))
+      self._db.executemany("""
+        INSERT INTO `faces` (`id`, `hash`, `top`, `right`, `bottom`, `left`)
+          VALUES (?, ?, ?, ?, ?, ?)
+      """, [(first + i, content_hash) + tuple(int(x) for x in loc)
+            for i, loc in enumerate(locations)])
+
+  def link (self, filename, content_hash):
+    """Records that the given file has the given content hash."""
+    with self._transaction():
+      self._db.execute("""
+        INSERT OR REPLACE INTO `files` (`path`, `hash`) VALUES (?, ?)
+      """, (os.path.abspath(filename), content_hash))
+
+  def files (self):
+    """Returns a list of (path, content hash) tuples for all files whose
+    faces are in the store."""
+    with self._lock:
+      return self._db.execute("""
+        SELECT `files`.`path`, `files`.`hash`
+          FROM `files`
+          INNER JOIN `images` ON `images`.`hash` = `files`.`hash`
+          ORDER BY `files`.`path`
+      """).fetchall()
+
+  def faces (self):
+    """Returns a list of (face ID, content hash, location) tuples of all
+    stored faces, ordered by ID."""
+    with self._lock:
+      rows = self._db.execute("""
+        SELECT `id`, `hash`, `top`, `right`, `bottom`, `left`
+          FROM `faces`
+          ORDER BY `id`
+      """).fetchall()
+    return [(r[0], r[1], tuple(r[2:])) for r in rows]
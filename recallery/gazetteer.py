@@ -0,0 +1,252 @@
+#    recallery - image metadata indexing and search
+#    Copyright (C) 2025  Daniel Kraft <d@domob.eu>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import csv
+import json
+import math
+from pathlib import Path
+
+import numpy as np
+
+# Size of the grid cells (in degrees) that places are bucketed into.
+CELL_DEGREES = 0.1
+GRID_ROWS = round(180 / CELL_DEGREES)
+GRID_COLS = round(360 / CELL_DEGREES)
+
+# Maximum number of rings of cells around the query point that are searched
+# before falling back to a scan over all places (e.g. far out at sea, or
+# close to the poles, where cells are very narrow).
+MAX_RINGS = 100
+
+# Default for the distance (in km) beyond which no place is returned.
+DEFAULT_MAX_DISTANCE = 50.0
+
+# Number of places whose distances are computed at once when scanning.
+SCAN_CHUNK = 1 << 20
+
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+
+# Column indices in the GeoNames dump format.
+GEONAMES_NAME = 1
+GEONAMES_LAT = 4
+GEONAMES_LON = 5
+GEONAMES_CLASS = 6
+GEONAMES_COUNTRY = 8
+GEONAMES_ADMIN1 = 10
+
+def _cell (lat, lon):
+  """Returns the (row, column) of the grid cell for the given coordinates."""
+  row = min(GRID_ROWS - 1, max(0, int((lat + 90) // CELL_DEGREES)))
+  col = int((lon + 180) // CELL_DEGREES) % GRID_COLS
+  return row, col
+
+def _read_geonames (source, feature_classes):
+  """Yields tuples (lat, lon, label) for all places in a GeoNames dump
+  (e.g. allCountries.txt or cities500.txt)."""
+  with open(source, encoding="utf-8", newline="") as f:
+    for row in csv.reader(f, delimiter="\t", quoting=csv.QUOTE_NONE):
+      if feature_classes and row[GEONAMES_CLASS] not in feature_classes:
+        continue
+      parts = [row[GEONAMES_NAME]]
+      if row[GEONAMES_ADMIN1] and not row[GEONAMES_ADMIN1].isdigit():
+        parts.append(row[GEONAMES_ADMIN1])
+      parts.append(row[GEONAMES_COUNTRY])
+      label = ", ".join(p for p in parts if p)
+      yield float(row[GEONAMES_LAT]), float(row[GEONAMES_LON]), label
+
+def _read_csv (source):
+  """Yields tuples (lat, lon, label) for all places in a CSV file with
+  a header line (e.g. an OSM extract).  It must have "lat" and "lon"
+  columns, and the label is taken from "display_name" or "name"."""
+  with open(source, encoding="utf-8", newline="") as f:
+    for row in csv.DictReader(f):
+      label = row.get("display_name") or row.get("name")
+      if not label:
+        continue
+      yield float(row["lat"]), float(row["lon"]), label
+
+def build_index (source, outdir, fmt="geonames", feature_classes="P"):
+  """Builds the spatial index of places from the gazetteer dump in the
+  source file, and writes it to the directory outdir.  fmt is either
+  "geonames" or "csv".  Returns the number of indexed places."""
+
+  if fmt == "geonames":
+    places = _read_geonames(source, feature_classes)
+  elif fmt == "csv":
+    places = _read_csv(source)
+  else:
+    raise ValueError(f"unknown gazetteer format: {fmt}")
+
+  lats = []
+  lons = []
+  labels = []
+  for lat, lon, label in places:
+    lats.append(lat)
+    lons.append(lon)
+    labels.append(label.encode("utf-8"))
+
+  lats = np.array(lats, dtype=np.float64)
+  lons = np.array(lons, dtype=np.float64)
+  rows = np.clip(((lats + 90) // CELL_DEGREES).astype(np.int64),
+                 0, GRID_ROWS - 1)
+  cols = ((lons + 180) // CELL_DEGREES).astype(np.int64) % GRID_COLS
+  keys = rows * GRID_COLS + cols
+  order = np.argsort(keys, kind="stable")
+
+  outdir = Path(outdir)
+  outdir.mkdir(parents=True, exist_ok=True)
+  np.save(outdir / "keys.npy", keys[order].astype(np.int32))
+  np.save(outdir / "coords.npy",
+          np.stack([lats[order], lons[order]], axis=1).astype(np.float32))
+
+  offsets = np.zeros(len(order) + 1, dtype=np.int64)
+  with open(outdir / "labels.bin", "wb") as f:
+    pos = 0
+    for i, j in enumerate(order):
+      f.write(labels[j])
+      pos += len(labels[j])
+      offsets[i + 1] = pos
+  np.save(outdir / "offsets.npy", offsets)
+
+  with open(outdir / "meta.json", "w") as f:
+    json.dump({"cell": CELL_DEGREES, "places": len(order)}, f)
+
+  return len(order)
+
+class Gazetteer:
+  """A spatial index of named places, built by build_index and loaded
+  through memory-mapping.  Places are bucketed into a grid of cells sorted
+  by cell key, so that nearest-place queries only look at the cells around
+  the query point."""
+
+  def __init__ (self, indexdir, max_distance=DEFAULT_MAX_DISTANCE):
+    """Opens the index in the given directory.  Places further away than
+    max_distance (in km) are never returned.  It can be set to None to
+    always return the nearest place, but then queries far away from all
+    places have to look at the whole index."""
+
+    indexdir = Path(indexdir)
+    with open(indexdir / "meta.json") as f:
+      meta = json.load(f)
+    if meta["cell"] != CELL_DEGREES:
+      raise RuntimeError(f"Gazetteer index {indexdir} has an incompatible"
+                         " format, please rebuild it")
+
+    self.max_distance = max_distance
+    self.keys = np.load(indexdir / "keys.npy", mmap_mode="r")
+    self.coords = np.load(indexdir / "coords.npy", mmap_mode="r")
+    self.offsets = np.load(indexdir / "offsets.npy", mmap_mode="r")
+    if len(self.keys) > 0:
+      self.labels = np.memmap(indexdir / "labels.bin", dtype=np.uint8,
+                              mode="r")
+    else:
+      self.labels = np.empty(0, dtype=np.uint8)
+
+  def __len__ (self):
+    return len(self.keys)
+
+  def _ring (self, row, col, r):
+    """Returns the index ranges of all places in the cells at Chebyshev
+    distance r from the given cell."""
+
+    if r == 0:
+      cells = [(row, col)]
+    else:
+      cells = []
+      for dc in range(-r, r + 1):
+        cells.append((row - r, col + dc))
+        cells.append((row + r, col + dc))
+      for dr in range(-r + 1, r):
+        cells.append((row + dr, col - r))
+        cells.append((row + dr, col + r))
+
+    keys = sorted({rr * GRID_COLS + cc % GRID_COLS
+                   for rr, cc in cells if 0 <= rr < GRID_ROWS})
+    keys = np.array(keys, dtype=np.int32)
+    starts = np.searchsorted(self.keys, keys, side="left")
+    ends = np.searchsorted(self.keys, keys, side="right")
+    return [(s, e) for s, e in zip(starts, ends) if s < e]
+
+  def nearest (self, coords):
+    """Returns a tuple (label, distance in km) of the place nearest to
+    the given (latitude, longitude), or None if there is none."""
+
+    lat, lon = coords
+    row, col = _cell(lat, lon)
+    best = None
+
+    for r in range(MAX_RINGS + 1):
+      if r == MAX_RINGS:
+        best = self._scan(lat, lon)
+        break
+
+      for start, end in self._ring(row, col, r):
+        cand = self.coords[start:end].astype(np.float64)
+        dist = _haversine(lat, lon, cand[:, 0], cand[:, 1])
+        i = int(np.argmin(dist))
+        if best is None or dist[i] < best[1]:
+          best = (start + i, float(dist[i]))
+
+      # All places in further rings are at least r full cells away.  Along
+      # the longitude, cells are narrower the closer to the poles.
+      maxlat = min(90.0, abs(lat) + (r + 1) * CELL_DEGREES)
+      bound = r * CELL_DEGREES * KM_PER_DEGREE * math.cos(math.radians(maxlat))
+      if best is not None and best[1] <= bound:
+        break
+      if self.max_distance is not None and bound > self.max_distance:
+        break
+
+    if best is None:
+      return None
+    if self.max_distance is not None and best[1] > self.max_distance:
+      return None
+
+    index, distance = best
+    label = bytes(self.labels[self.offsets[index]:self.offsets[index + 1]])
+    return label.decode("utf-8"), distance
+
+  def _scan (self, lat, lon):
+    """Returns (index, distance) of the nearest place by computing the
+    distances to all of them, or None if there are no places.  Only the
+    band of grid rows within max_distance is looked at, in chunks of
+    SCAN_CHUNK places, so that the index is never copied as a whole."""
+
+    start, end = 0, len(self.keys)
+    if self.max_distance is not None:
+      band = self.max_distance / KM_PER_DEGREE
+      first_row, _ = _cell(lat - band, lon)
+      last_row, _ = _cell(lat + band, lon)
+      start, end = np.searchsorted(self.keys, [first_row * GRID_COLS,
+                                               (last_row + 1) * GRID_COLS])
+
+    best = None
+    for chunk in range(start, end, SCAN_CHUNK):
+      cand = self.coords[chunk:min(end, chunk + SCAN_CHUNK)].astype(np.float64)
+      dist = _haversine(lat, lon, cand[:, 0], cand[:, 1])
+      i = int(np.argmin(dist))
+      if best is None or dist[i] < best[1]:
+        best = (chunk + i, float(dist[i]))
+    return best
+
+def _haversine (lat, lon, lats, lons):
+  """Returns the great-circle distances in km between a point and arrays
+  of other points."""
+  lat, lon = math.radians(lat), math.radians(lon)
+  lats, lons = np.radians(lats), np.radians(lons)
+  a = (np.sin((lats - lat) / 2)**2
+        + math.cos(lat) * np.cos(lats) * np.sin((lons - lon) / 2)**2)
+  return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
@@ -0,0 +1,122 @@
+#    recallery - image metadata indexing and search
+#    Copyright (C) 2025  Daniel Kraft <d@domob.eu>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import sqlite3
+import threading
+import time
+
+class GeoCache:
+  """A persistent cache of reverse geocoding results, stored in an SQLite
+  database.  Coordinates are quantised to a fixed number of decimal places,
+  so that all photos taken at (roughly) the same spot share an entry.
+  Entries expire after a given time, and the least recently used ones are
+  evicted when the cache grows beyond a maximum number of entries."""
+
+  def __init__ (self, path, precision=4, ttl=None, max_entries=None):
+    """Opens (or creates) the cache database at path.  The ttl is the time
+    in seconds after which entries expire (None for never), and max_entries
+    the size limit (None for unlimited)."""
+
+    self.precision = precision
+    self.ttl = ttl
+    self.max_entries = max_entries
+    self.hits = 0
+    self.misses = 0
+
+    self._lock = threading.Lock()
+    self._db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+    self._db.execute("""
+      CREATE TABLE IF NOT EXISTS `locations` (
+        `precision` INTEGER NOT NULL,
+        `lat` INTEGER NOT NULL,
+        `lon` INTEGER NOT NULL,
+        `address` TEXT NULL,
+        `created` REAL NOT NULL,
+        `used` REAL NOT NULL,
+        PRIMARY KEY (`precision`, `lat`, `lon`)
+      )
+    """)
+    self._db.execute("""
+      CREATE INDEX IF NOT EXISTS `locations_used` ON `locations` (`used`)
+    """)
+    self._expire()
+    self._db.commit()
+
+  def close (self):
+    with self._lock:
+      self._db.close()
+
+  def _key (self, coords):
+    scale = 10**self.precision
+    lat, lon = coords
+    return self.precision, round(lat * scale), round(lon * scale)
+
+  def _expire (self):
+    if self.ttl is not None:
+      self._db.execute("DELETE FROM `locations` WHERE `created` < ?",
+                       (time.time() - self.ttl,))
+
+  def get (self, coords):
+    """Looks up the given (latitude, longitude) tuple.  Returns a tuple
+    (found, address), where address may be None also for found entries
+    (if the geocoder returned nothing for that place)."""
+
+    now = time.time()
+    with self._lock:
+      row = self._db.execute("""
+        SELECT `address`, `created`
+          FROM `locations`
+          WHERE `precision` = ? AND `lat` = ? AND `lon` = ?
+      """, self._key(coords)).fetchone()
+      if row is None or (self.ttl is not None and row[1] < now - self.ttl):
+        self.misses += 1
+        return False, None
+
+      self.hits += 1
+      self._db.execute("""
+        UPDATE `locations`
+          SET `used` = ?
+          WHERE `precision` = ? AND `lat` = ? AND `lon` = ?
+      """, (now,) + self._key(coords))
+      self._db.commit()
+      return True, row[0]
+
+  def put (self, coords, address):
+    """Stores the address (which may be None) for the given coordinates."""
+
+    now = time.time()
+    with self._lock:
+      self._db.execute("""
+        INSERT OR REPLACE INTO `locations`
+          (`precision`, `lat`, `lon`, `address`, `created`, `used`)
+          VALUES (?, ?, ?, ?, ?, ?)
+      """, self._key(coords) + (address, now, now))
+      if self.max_entries is not None:
+        self._db.execute("""
+          DELETE FROM `locations`
+            WHERE `rowid` IN (
+              SELECT `rowid`
+                FROM `locations`
+                ORDER BY `used` DESC
+                LIMIT -1 OFFSET ?
+            )
+        """, (self.max_entries,))
+      self._db.commit()
+
+  @property
+  def summary (self):
+    """Returns a human-readable string with the cache statistics."""
+    return f"Reverse geocoding cache: {self.hits} hits, {self.misses} misses"
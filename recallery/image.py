@@ -14,41 +14,339 @@
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-from PIL import Image
-from PIL.ExifTags import TAGS, GPSTAGS
-from libxmp import XMPFiles, XMPMeta
-from libxmp.exempi import XMPError
+from .preview import extract_preview, has_preview, read_gps
+from .stats import NO_STATS
+from .xmpscan import read_properties
+
+import contextlib
+import hashlib
+import io
+import math
+import os
+import shutil
+import struct
+import tempfile
+import threading
 
 # XML namespace for recallery's custom XMP properties
 XMP_NS = "https://www.domob.eu/projects/recallery"
 XMP_PREFIX = "recallery"
 
-XMPMeta.register_namespace(XMP_NS, XMP_PREFIX)
+# PIL, NumPy and libxmp are imported only when needed, so that e.g. just
+# reading properties from JPEG files does not pay for them at startup.
+_libxmp_lock = threading.Lock()
+_libxmp = None
+
+def _load_libxmp ():
+  """Imports libxmp and registers our namespace on first use.  Returns
+  the libxmp module."""
+  global _libxmp
+  with _libxmp_lock:
+    if _libxmp is None:
+      import libxmp
+      import libxmp.exempi
+      libxmp.XMPMeta.register_namespace(XMP_NS, XMP_PREFIX)
+      _libxmp = libxmp
+  return _libxmp
+
+def sidecar_path (filename):
+  """Returns the path of the XMP sidecar file for the given image."""
+  return f"{filename}.xmp"
+
+def _hash_jpeg_content (raw, h):
+  """Feeds all parts of the JPEG data in raw that determine the image
+  (i.e. everything except the APPn and COM segments) into the hash object h.
+  Returns false if the data is not a well-formed JPEG file."""
+
+  if not raw.startswith(b"\xff\xd8"):
+    return False
+
+  pos = 2
+  while pos + 4 <= len(raw):
+    if raw[pos] != 0xff:
+      return False
+    code = raw[pos + 1]
+    if code == 0xff:
+      pos += 1
+      continue
+    if code == 0x01 or 0xd0 <= code <= 0xd8:
+      pos += 2
+      continue
+    if code == 0xda:
+      # Everything from the first scan on is image data (apart from
+      # possibly trailing junk, which we do not care about).
+      h.update(memoryview(raw)[pos:])
+      return True
+
+    (length,) = struct.unpack(">H", raw[pos + 2:pos + 4])
+    end = pos + 2 + length
+    if not (0xe0 <= code <= 0xef or code == 0xfe):
+      h.update(memoryview(raw)[pos:end])
+    pos = end
+
+  return False
+
+class ImageData:
+  """The contents of an image file held in memory, so that it is read only
+  once and shared between all modules.  The decoded image is computed on
+  first use and cached as well, as are reduced-size renditions for modules
+  that do not need the full resolution.  When pickled (e.g. to send the
+  data to a worker process), only the raw bytes are transferred.  The time
+  spent decoding is recorded in the given Stats instance."""
+
+  def __init__ (self, raw, stats=NO_STATS):
+    self.raw = raw
+    self.stats = stats
+    self._size = None
+    self._decoded = None
+    self._pixels = None
+    self._renditions = {}
+    self._rendition_jpegs = {}
+    self._planned = None
+    self._pixel_hash = None
+
+  def __getstate__ (self):
+    return {"raw": self.raw}
+
+  def __setstate__ (self, state):
+    self.__init__ (state["raw"])
+
+  @property
+  def size (self):
+    """Returns the (width, height) of the image, without decoding it."""
+    if self._size is None:
+      from PIL import Image
+      with Image.open(io.BytesIO(self.raw)) as img:
+        self._size = img.size
+    return self._size
+
+  @property
+  def decoded (self):
+    """Returns the fully decoded image as PIL Image."""
+    if self._decoded is None:
+      from PIL import Image
+      with self.stats.timer("decode"):
+        img = Image.open(io.BytesIO(self.raw))
+        img.load()
+      self._decoded = img
+    return self._decoded
+
+  @property
+  def pixels (self):
+    """Returns the decoded image as NumPy array."""
+    if self._pixels is None:
+      import numpy as np
+      self._pixels = np.array(self.decoded)
+    return self._pixels
+
+  def plan_renditions (self, sizes):
+    """Tells which renditions will be used, as list of the input_pixels
+    of the modules that process the image (where None means the full
+    resolution).  Renditions are then scaled down from the next larger one
+    that is needed anyway, instead of decoding the file for each."""
+    self._planned = list(sizes)
+
+  def _rendition_source (self, max_pixels):
+    """Returns the already planned image (full or rendition) that the
+    rendition for max_pixels should be scaled from, or None if it should
+    be decoded from the file."""
+
+    if not self._planned:
+      return None
+    if None in self._planned:
+      return self.decoded
+    larger = [p for p in self._planned if p > max_pixels]
+    if not larger:
+      return None
+    return self.rendition(min(larger))
+
+  @property
+  def pixel_hash (self):
+    """Returns a hash (as hex string) of the image content, which does not
+    change when only metadata is modified.  For JPEG files, this hashes all
+    segments except the APPn (EXIF, XMP, ...) and comment ones, so that no
+    decoding is needed.  For other formats, the decoded pixels are hashed."""
+
+    if self._pixel_hash is None:
+      h = hashlib.sha256()
+      if not _hash_jpeg_content(self.raw, h):
+        h = hashlib.sha256()
+        img = self.decoded
+        h.update(f"{img.mode} {img.size[0]}x{img.size[1]}\n".encode("ascii"))
+        h.update(img.tobytes())
+      self._pixel_hash = h.hexdigest()
+
+    return self._pixel_hash
+
+  def decode_scaled (self, max_pixels):
+    """Decodes the image at a reduced size with at most max_pixels pixels
+    (if it is larger than that), without caching the result.  For JPEG
+    files, the decoder scales by 1/2, 1/4 or 1/8 directly, so that memory
+    for the full resolution is never needed.  Other formats are decoded
+    in full and then scaled down."""
+
+    width, height = self.size
+    if width * height <= max_pixels and self._decoded is not None:
+      return self._decoded
+
+    from PIL import Image
+    with self.stats.timer("decode"):
+      img = Image.open(io.BytesIO(self.raw))
+      scale = 1
+      while scale < 8 and (width // scale) * (height // scale) > max_pixels:
+        scale *= 2
+      if scale > 1:
+        img.draft(img.mode, (-(-width // scale), -(-height // scale)))
+      img.load()
+      if img.width * img.height > max_pixels:
+        factor = math.sqrt(max_pixels / (img.width * img.height))
+        img = img.resize((int(img.width * factor), int(img.height * factor)),
+                         Image.LANCZOS)
+    return img
+
+  def rendition (self, max_pixels):
+    """Returns the image as PIL Image, scaled down (keeping the aspect
+    ratio) to at most max_pixels pixels.  Images that are small enough
+    are returned at full resolution.  For JPEG files, the decoder already
+    scales in the DCT domain (PIL's draft mode), so that most of the work
+    for a full decode is skipped."""
+
+    if max_pixels in self._renditions:
+      return self._renditions[max_pixels]
+
+    width, height = self.size
+    if width * height <= max_pixels:
+      res = self.decoded
+    else:
+      from PIL import Image
+      scale = math.sqrt(max_pixels / (width * height))
+      target = (int(width * scale), int(height * scale))
+      img = self._rendition_source(max_pixels)
+      with self.stats.timer("decode_rendition"):
+        if img is None:
+          img = Image.open(io.BytesIO(self.raw))
+          img.draft(img.mode, target)
+        res = img.resize(target, Image.LANCZOS)
+
+    self._renditions[max_pixels] = res
+    return res
+
+  def rendition_jpeg (self, max_pixels, quality=90):
+    """Returns the rendition for max_pixels encoded as JPEG bytes, e.g. for
+    sending it to an AI model.  If the original is a JPEG file that is small
+    enough already, it is returned as is."""
+
+    if max_pixels in self._rendition_jpegs:
+      return self._rendition_jpegs[max_pixels]
+
+    width, height = self.size
+    if width * height <= max_pixels and self.raw.startswith(b"\xff\xd8"):
+      res = self.raw
+    else:
+      img = self.rendition(max_pixels)
+      if img.mode not in ("RGB", "L"):
+        img = img.convert("RGB")
+      out = io.BytesIO()
+      img.save(out, format="JPEG", quality=quality)
+      res = out.getvalue()
+
+    self._rendition_jpegs[max_pixels] = res
+    return res
 
 class ImageFile:
   """This class represents an image file that is read or written to (metadata)
   for recallery.  It supports the required methods for that, exposing EXIF
   and XMP metadata as well as the raw file contents (to be used e.g. for sending
-  to an AI model)."""
+  to an AI model).
+
+  The image itself and the exempi handle are only opened when needed.
+  In particular, reading the recallery properties from a JPEG file just
+  scans its header for the XMP packet.
 
-  def __init__ (self, fn):
+  In sidecar mode, the recallery properties are written to an XMP sidecar
+  file next to the image (the filename with ".xmp" appended) instead of
+  the image itself, which is then never modified.  Properties are read from
+  the sidecar if it has them, and from the image otherwise.
+
+  For camera RAW and HEIF files, the embedded JPEG preview is used as the
+  image for all processing (and the RAW data is never decoded).  Metadata
+  of those files is always written to sidecars."""
+
+  def __init__ (self, fn, stats=NO_STATS, sidecar=False):
     self.filename = fn
-    self.image = Image.open(fn)
-    self.xmpfile = XMPFiles(file_path=fn, open_forupdate=False)
+    self.stats = stats
+    self.uses_preview = has_preview (fn)
+    self.sidecar = sidecar or self.uses_preview
+    self._image = None
+    self._xmpfile = None
     self.xmpfile_writable = False
+    self._data = None
+    self._rendition_plan = None
+    self._pending = None
+    self._scanned = None
+    self._sidecar_props = None
 
   def __enter__ (self):
     return self
 
   def __exit__ (self, exc_type, exc_value, traceback):
-    self.image.close()
-    self.xmpfile.close_file()
+    if self._image is not None:
+      self._image.close()
+    if self._xmpfile is not None:
+      self._xmpfile.close_file()
+    self._data = None
+
+  @property
+  def image (self):
+    """Returns the PIL Image (opened lazily, without decoding it).  For files
+    with an embedded preview, this is the preview image."""
+    if self._image is None:
+      from PIL import Image
+      if self.uses_preview:
+        self._image = Image.open(io.BytesIO(self.raw_data))
+      else:
+        self._image = Image.open(self.filename)
+    return self._image
+
+  @property
+  def xmpfile (self):
+    """Returns the exempi XMPFiles handle (opened lazily for reading)."""
+    if self._xmpfile is None:
+      libxmp = _load_libxmp()
+      self._xmpfile = libxmp.XMPFiles(file_path=self.filename,
+                                      open_forupdate=False)
+    return self._xmpfile
+
+  @property
+  def data (self):
+    """Returns the file content (or the embedded preview) as ImageData
+    instance.  The file is read on first access only, and then shared
+    by all users."""
+    if self._data is None:
+      with self.stats.timer("read"):
+        if self.uses_preview:
+          raw = extract_preview (self.filename)
+          if raw is None:
+            raise RuntimeError(f"No usable preview in {self.filename}")
+        else:
+          with open(self.filename, 'rb') as f:
+            raw = f.read()
+      self._data = ImageData(raw, self.stats)
+      if self._rendition_plan is not None:
+        self._data.plan_renditions(self._rendition_plan)
+    return self._data
+
+  def plan_renditions (self, sizes):
+    """Passes the renditions that will be used on to the ImageData (see
+    ImageData.plan_renditions), without reading the file yet."""
+    self._rendition_plan = list(sizes)
+    if self._data is not None:
+      self._data.plan_renditions(self._rendition_plan)
 
   @property
   def raw_data (self):
     """Returns the raw file content as bytes."""
-    with open(self.filename, 'rb') as f:
-      return f.read()
+    return self.data.raw
 
   @property
   def user_comment (self):
@@ -63,15 +361,23 @@ class ImageFile:
   def geo_coordinates (self):
     """Returns the geo coordinates (latitude, longitude in decimal degrees)
     from the image metadata or None if none are set."""
-    exif_data = self.image.getexif()
-    if not exif_data:
-      return None
+    from PIL.ExifTags import TAGS, GPSTAGS
 
+    # RAW files have the GPS data in their own EXIF structure, which is
+    # read directly.  Otherwise, it is taken from the (preview) image.
     gps_ifd = None
-    for tag, name in TAGS.items():
-      if name == "GPSInfo":
-        gps_ifd = exif_data.get_ifd(tag)
-        break
+    if self.uses_preview:
+      gps_ifd = read_gps (self.filename)
+
+    if not gps_ifd:
+      exif_data = self.image.getexif()
+      if not exif_data:
+        return None
+
+      for tag, name in TAGS.items():
+        if name == "GPSInfo":
+          gps_ifd = exif_data.get_ifd(tag)
+          break
 
     if not gps_ifd:
       return None
@@ -95,35 +401,205 @@ class ImageFile:
 
     return lat_decimal, lon_decimal
 
+  @property
+  def sidecar_filename (self):
+    """Returns the path of the XMP sidecar file for the image."""
+    return sidecar_path (self.filename)
+
   def get_custom_property (self, nm):
     """Returns the custom recallery XMP property with the given name or
-    None if it is not set."""
-    xmp = self.xmpfile.get_xmp()
-    if xmp is None:
-      return None
-    try:
-      return xmp.get_property(XMP_NS, nm)
-    except XMPError:
-      return None
+    None if it is not set.  Within a metadata session, pending changes
+    are taken into account."""
+    if self._pending is not None and nm in self._pending:
+      return self._pending[nm]
+
+    # In the sidecar, an empty value marks a property that is cleared
+    # (and thus overrides a value still stored in the image).
+    if self.sidecar:
+      props = self._read_sidecar ()
+      if nm in props:
+        return props[nm] or None
+
+    return self._get_file_property (nm)
+
+  def _get_file_property (self, nm):
+    """Reads the custom property from the image file itself."""
+
+    # Unless the file has been written (in which case the exempi handle is
+    # open anyway), try the fast scanner first.
+    if not self.xmpfile_writable:
+      if self._scanned is None:
+        with self.stats.timer("xmp_scan"):
+          self._scanned = read_properties (self.filename, XMP_NS)
+        if self._scanned is None:
+          self._scanned = False
+      if self._scanned is not False:
+        return self._scanned.get (nm)
+
+    libxmp = _load_libxmp()
+    with self.stats.timer("xmp_read"):
+      xmp = self.xmpfile.get_xmp()
+      if xmp is None:
+        return None
+      try:
+        return xmp.get_property(XMP_NS, nm)
+      except libxmp.exempi.XMPError:
+        return None
 
   def set_custom_property (self, nm, val):
     """Sets or clears (val is None) the custom recallery XMP property with
-    the given name on the image."""
+    the given name on the image.  Within a metadata session, the change
+    is only written when the session ends."""
+    if self._pending is not None:
+      self._pending[nm] = val
+    else:
+      self._write_properties ({nm: val})
+
+  @contextlib.contextmanager
+  def metadata_session (self):
+    """Returns a context manager that collects all changes made through
+    set_custom_property and writes them to the file at once when it exits.
+    This also happens when exiting through an exception, so that completed
+    changes are not lost.  If no value actually changed, the file is not
+    written at all."""
+    if self._pending is not None:
+      yield self
+      return
+
+    self._pending = {}
+    try:
+      yield self
+    finally:
+      pending = self._pending
+      self._pending = None
+      self._write_properties (pending)
+
+  def _write_properties (self, props):
+    """Writes the given dict of custom XMP properties (with None values
+    for clearing them) to the file, if any of them changed."""
+    if self.sidecar:
+      self._write_sidecar (props)
+      return
+
+    changed = {nm: val for nm, val in props.items ()
+               if self.get_custom_property (nm) != val}
+    if not changed:
+      return
+
+    with self.stats.timer("xmp_write"):
+      self._put_properties (changed)
+
+  def _put_properties (self, changed):
+    """Writes the changed properties to the file through exempi."""
+
     if not self.xmpfile_writable:
-      self.xmpfile.close_file()
+      if self._xmpfile is not None:
+        self._xmpfile.close_file()
+        self._xmpfile = None
       try:
-        self.xmpfile = XMPFiles(file_path=self.filename, open_forupdate=True)
+        libxmp = _load_libxmp()
+        self._xmpfile = libxmp.XMPFiles(file_path=self.filename,
+                                        open_forupdate=True)
         self.xmpfile_writable = True
       except Exception as e:
         raise RuntimeError(f"Cannot open file for writing: {e}")
     xmp = self.xmpfile.get_xmp()
     if xmp is None:
-      xmp = XMPMeta()
+      xmp = _load_libxmp().XMPMeta()
 
-    if val is None:
-      xmp.delete_property(XMP_NS, nm)
-    else:
-      xmp.set_property(XMP_NS, nm, val)
+    for nm, val in changed.items ():
+      if val is None:
+        xmp.delete_property(XMP_NS, nm)
+      else:
+        xmp.set_property(XMP_NS, nm, val)
 
     if self.xmpfile.can_put_xmp(xmp):
       self.xmpfile.put_xmp(xmp)
+
+  def _read_sidecar (self):
+    """Returns the dict of recallery properties in the sidecar file,
+    which is empty if there is none."""
+
+    if self._sidecar_props is None:
+      path = self.sidecar_filename
+      props = {}
+      if os.path.exists(path):
+        with self.stats.timer("xmp_scan"):
+          props = read_properties (path, XMP_NS)
+        if props is None:
+          props = self._parse_sidecar (path)
+      self._sidecar_props = props
+
+    return self._sidecar_props
+
+  def _parse_sidecar (self, path):
+    """Reads the properties from a sidecar file that the scanner does not
+    handle, through exempi."""
+
+    libxmp = _load_libxmp()
+    res = {}
+    with self.stats.timer("xmp_read"):
+      xmp = self._load_sidecar_xmp (path)
+      for _, nm, val, _ in libxmp.XMPIterator(xmp, XMP_NS):
+        # The iterator yields qualified names (with our prefix).
+        nm = nm.split(":", 1)[-1]
+        if nm:
+          res[nm] = val
+    return res
+
+  def _load_sidecar_xmp (self, path):
+    """Returns the XMPMeta of the existing sidecar at path, or an empty
+    one if there is none."""
+    xmp = _load_libxmp().XMPMeta()
+    if os.path.exists(path):
+      with open(path, "r", encoding="utf-8") as f:
+        xmp.parse_from_str(f.read(), xmpmeta_wrap=False)
+    return xmp
+
+  def _write_sidecar (self, props):
+    """Writes the given properties (with None values for clearing them)
+    to the sidecar file, if any of them changed.  Cleared properties
+    are stored as empty values, so that also all properties processed
+    with no result can be read from the sidecar alone.  Other XMP data
+    in an existing sidecar (e.g. from a photo editor) is preserved."""
+
+    current = self._read_sidecar ()
+    changed = {nm: ("" if val is None else val)
+               for nm, val in props.items ()}
+    changed = {nm: val for nm, val in changed.items ()
+               if current.get (nm) != val}
+    if not changed:
+      return
+
+    # Do not create a sidecar that would just clear properties which are
+    # not set on the image anyway.
+    path = self.sidecar_filename
+    if (not os.path.exists(path)
+          and not any (changed.values ())
+          and all (self._get_file_property (nm) is None for nm in changed)):
+      return
+
+    with self.stats.timer("xmp_write"):
+      xmp = self._load_sidecar_xmp (path)
+      for nm, val in changed.items ():
+        xmp.set_property(XMP_NS, nm, val)
+
+      # Write atomically, so that readers never see a partial file.  The
+      # temporary file has a unique (hidden) name, so that concurrent
+      # writers do not clash and directory watchers ignore it.  It gets the
+      # permissions of the existing sidecar (or else the image).
+      directory, name = os.path.split(os.path.abspath(path))
+      tmp = tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=directory,
+                                        prefix=f".{name}.", suffix=".tmp",
+                                        delete=False)
+      try:
+        with tmp:
+          tmp.write(xmp.serialize_to_str())
+        shutil.copymode(path if os.path.exists(path) else self.filename,
+                        tmp.name)
+        os.replace(tmp.name, path)
+      except BaseException:
+        os.unlink(tmp.name)
+        raise
+
+    self._sidecar_props = dict (current, **changed)
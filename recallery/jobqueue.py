@@ -0,0 +1,251 @@
+#    recallery - image metadata indexing and search
+#    Copyright (C) 2025  Daniel Kraft <d@domob.eu>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import contextlib
+import os
+import sqlite3
+import threading
+import time
+
+# Number of files added per transaction when enqueueing, so that other
+# workers are not blocked for long.
+ENQUEUE_BATCH = 1000
+
+class JobQueue:
+  """A persistent queue of files to process, stored in an SQLite database
+  that can be shared by multiple worker processes (also on different hosts,
+  if the database is on shared storage with working file locks).
+
+  Workers claim jobs with a lease that expires unless renewed, so that
+  jobs of crashed workers are picked up again.  For each job, the XMP
+  properties (i.e. modules) that are complete are tracked, and the job is
+  done when all properties it requires are.  Jobs that failed are retried
+  up to max_attempts times."""
+
+  def __init__ (self, path, journal_mode="wal", max_attempts=3):
+    """Opens (or creates) the queue database.  The journal mode should
+    be "wal" (the default) if all workers run on the same host, and e.g.
+    "delete" if they access the database over a network file system, where
+    WAL mode does not work."""
+
+    self.max_attempts = max_attempts
+    self._lock = threading.Lock()
+    self._db = sqlite3.connect(path, timeout=60, isolation_level=None,
+                               check_same_thread=False)
+    self._db.execute(f"PRAGMA journal_mode = {journal_mode}")
+    with self._transaction():
+      self._db.execute("""
+        CREATE TABLE IF NOT EXISTS `jobs` (
+          `id` INTEGER PRIMARY KEY,
+          `path` TEXT NOT NULL UNIQUE,
+          `state` TEXT NOT NULL,
+          `modules` TEXT NULL,
+          `owner` TEXT NULL,
+          `lease_until` REAL NULL,
+          `attempts` INTEGER NOT NULL DEFAULT 0,
+          `error` TEXT NULL,
+          `updated` REAL NOT NULL
+        )
+      """)
+      self._db.execute("""
+        CREATE INDEX IF NOT EXISTS `jobs_state` ON `jobs` (`state`, `id`)
+      """)
+      self._db.execute("""
+        CREATE TABLE IF NOT EXISTS `job_modules` (
+          `job` INTEGER NOT NULL,
+          `module` TEXT NOT NULL,
+          PRIMARY KEY (`job`, `module`)
+        )
+      """)
+
+  def close (self):
+    with self._lock:
+      self._db.close()
+
+  @contextlib.contextmanager
+  def _transaction (self):
+    """Runs a write transaction, which takes the database lock right away
+    so that concurrent workers are serialised."""
+    with self._lock:
+      self._db.execute("BEGIN IMMEDIATE")
+      try:
+        yield
+      except BaseException:
+        self._db.execute("ROLLBACK")
+        raise
+      self._db.execute("COMMIT")
+
+  def enqueue (self, paths, reset=False):
+    """Adds the given files to the queue.  Files that are already in it
+    are left alone, unless reset is set (in which case they are processed
+    again, also if they are done or failed).  Returns the number of files
+    that were added or reset."""
+
+    count = 0
+    batch = []
+    for path in paths:
+      batch.append(os.path.abspath(path))
+      if len(batch) >= ENQUEUE_BATCH:
+        count += self._enqueue_batch(batch, reset)
+        batch = []
+    if batch:
+      count += self._enqueue_batch(batch, reset)
+    return count
+
+  def _enqueue_batch (self, paths, reset):
+    now = time.time()
+    count = 0
+    with self._transaction():
+      for path in paths:
+        cur = self._db.execute("""
+          INSERT OR IGNORE INTO `jobs` (`path`, `state`, `updated`)
+            VALUES (?, 'pending', ?)
+        """, (path, now))
+        if cur.rowcount == 0 and reset:
+          cur = self._db.execute("""
+            UPDATE `jobs`
+              SET `state` = 'pending', `attempts` = 0, `error` = NULL,
+                  `owner` = NULL, `lease_until` = NULL, `updated` = ?
+              WHERE `path` = ? AND `state` != 'running'
+          """, (now, path))
+          self._db.execute("""
+            DELETE FROM `job_modules`
+              WHERE `job` = (SELECT `id` FROM `jobs` WHERE `path` = ?)
+          """, (path,))
+        count += cur.rowcount
+    return count
+
+  def claim (self, owner, limit, lease, modules):
+    """Claims up to limit jobs for the given owner, with a lease of
+    the given number of seconds.  Jobs of other owners whose lease has
+    expired are claimed as well.  modules is the list of XMP properties
+    that the owner processes, which must all be complete for the job to
+    be done.  Returns the list of paths."""
+
+    now = time.time()
+    with self._transaction():
+      rows = self._db.execute("""
+        SELECT `id`, `path`
+          FROM `jobs`
+          WHERE (`state` = 'pending'
+                  OR (`state` = 'running' AND `lease_until` < ?))
+            AND `attempts` < ?
+          ORDER BY `id`
+          LIMIT ?
+      """, (now, self.max_attempts, limit)).fetchall()
+      self._db.executemany("""
+        UPDATE `jobs`
+          SET `state` = 'running', `owner` = ?, `lease_until` = ?,
+              `modules` = ?, `attempts` = `attempts` + 1, `updated` = ?
+          WHERE `id` = ?
+      """, [(owner, now + lease, ",".join(sorted(modules)), now, i)
+            for i, _ in rows])
+
+      # Jobs whose lease expired too often are given up.
+      self._db.execute("""
+        UPDATE `jobs`
+          SET `state` = 'failed', `owner` = NULL, `updated` = ?,
+              `error` = COALESCE(`error`, 'lease expired')
+          WHERE `state` = 'running' AND `lease_until` < ?
+            AND `attempts` >= ?
+      """, (now, now, self.max_attempts))
+
+    return [path for _, path in rows]
+
+  def renew (self, owner, paths, lease):
+    """Extends the leases of the given jobs held by owner."""
+    now = time.time()
+    with self._transaction():
+      self._db.executemany("""
+        UPDATE `jobs`
+          SET `lease_until` = ?
+          WHERE `path` = ? AND `owner` = ? AND `state` = 'running'
+      """, [(now + lease, os.path.abspath(p), owner) for p in paths])
+
+  def module_done (self, owner, path, modules):
+    """Marks the given XMP properties of the job as complete.  If all its
+    required properties are complete then, the job is done.  Returns true
+    in that case."""
+
+    path = os.path.abspath(path)
+    with self._transaction():
+      row = self._db.execute("""
+        SELECT `id`, `modules`
+          FROM `jobs`
+          WHERE `path` = ? AND `owner` = ? AND `state` = 'running'
+      """, (path, owner)).fetchone()
+      if row is None:
+        return False
+      job, required = row
+
+      self._db.executemany("""
+        INSERT OR IGNORE INTO `job_modules` (`job`, `module`) VALUES (?, ?)
+      """, [(job, m) for m in modules])
+      done = {m for (m,) in self._db.execute("""
+        SELECT `module` FROM `job_modules` WHERE `job` = ?
+      """, (job,))}
+      if not {m for m in (required or "").split(",") if m}.issubset(done):
+        return False
+
+      self._db.execute("""
+        UPDATE `jobs`
+          SET `state` = 'done', `owner` = NULL, `lease_until` = NULL,
+              `error` = NULL, `updated` = ?
+          WHERE `id` = ?
+      """, (time.time(), job))
+      return True
+
+  def fail (self, owner, path, error):
+    """Records that processing the job failed.  It is retried later unless
+    it has reached the maximum number of attempts."""
+    with self._transaction():
+      self._db.execute("""
+        UPDATE `jobs`
+          SET `state` = CASE WHEN `attempts` < ? THEN 'pending'
+                             ELSE 'failed' END,
+              `owner` = NULL, `lease_until` = NULL, `error` = ?,
+              `updated` = ?
+          WHERE `path` = ? AND `owner` = ? AND `state` = 'running'
+      """, (self.max_attempts, str(error), time.time(),
+            os.path.abspath(path), owner))
+
+  def release (self, owner, paths):
+    """Returns jobs that were claimed but not processed (e.g. when the
+    worker is stopped) to the queue, without counting the attempt."""
+    with self._transaction():
+      self._db.executemany("""
+        UPDATE `jobs`
+          SET `state` = 'pending', `owner` = NULL, `lease_until` = NULL,
+              `attempts` = MAX(0, `attempts` - 1), `updated` = ?
+          WHERE `path` = ? AND `owner` = ? AND `state` = 'running'
+      """, [(time.time(), os.path.abspath(p), owner) for p in paths])
+
+  def counts (self):
+    """Returns a dict with the number of jobs in each state."""
+    with self._lock:
+      rows = self._db.execute("""
+        SELECT `state`, COUNT(*) FROM `jobs` GROUP BY `state`
+      """).fetchall()
+    return dict(rows)
+
+  def failures (self):
+    """Returns a list of (path, error) for all failed jobs."""
+    with self._lock:
+      return self._db.execute("""
+        SELECT `path`, `error` FROM `jobs`
+          WHERE `state` = 'failed'
+          ORDER BY `id`
+      """).fetchall()
@@ -0,0 +1,123 @@
+#    recallery - image metadata indexing and search
+#    Copyright (C) 2025  Daniel Kraft <d@domob.eu>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import threading
+
+import httpx
+from ollama import AsyncClient, ResponseError
+
+# Time in seconds for which an endpoint is avoided after a failed request.
+FAILURE_BACKOFF = 60
+
+def _is_unavailable (error):
+  """Returns true if the error of a request means that the endpoint is
+  (temporarily) unavailable, i.e. it could not be reached, timed out or
+  failed with a server error.  Other errors (like 4xx responses for an
+  invalid request or unknown model) would fail the same way on the other
+  endpoints."""
+  if isinstance(error, ResponseError):
+    return error.status_code >= 500
+  return isinstance(error, (httpx.TransportError, ConnectionError,
+                            TimeoutError))
+
+class _Endpoint:
+  """State of one Ollama endpoint in the pool.  Instances live on the
+  pool's event loop, so no locking is needed."""
+
+  def __init__ (self, host, slots):
+    self.host = host
+    limits = httpx.Limits(max_connections=slots,
+                          max_keepalive_connections=slots)
+    self.client = AsyncClient(host=host, limits=limits)
+    self.slots = asyncio.Semaphore(slots)
+    self.load = 0
+    self.failed_until = 0
+
+class EndpointPool:
+  """A pool of Ollama endpoints serving the same model.  Requests are run
+  on an asyncio event loop in a background thread, with a bounded number of
+  requests in flight per endpoint.  Each request goes to the endpoint with
+  the shortest queue, and is retried on the other endpoints if the endpoint
+  is unavailable.  The connections are kept open between requests."""
+
+  def __init__ (self, hosts, per_host=1, keep_alive=None):
+    """Initialises the pool for the given list of endpoint URLs, allowing
+    per_host concurrent requests on each.  keep_alive is passed on to Ollama
+    to control how long the model stays loaded after a request."""
+
+    if not hosts:
+      raise ValueError("no Ollama endpoints given")
+
+    self.hosts = list(hosts)
+    self.per_host = per_host
+    self.keep_alive = keep_alive
+
+    self._loop = asyncio.new_event_loop()
+    self._thread = threading.Thread(target=self._loop.run_forever,
+                                    name="ollama-pool", daemon=True)
+    self._thread.start()
+    self._endpoints = self._run(self._setup())
+
+  def _run (self, coro):
+    """Runs the coroutine on the pool's event loop and waits for
+    its result."""
+    return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
+  async def _setup (self):
+    return [_Endpoint(h, self.per_host) for h in self.hosts]
+
+  def close (self):
+    """Closes all connections and stops the background thread."""
+    self._run(self._close())
+    self._loop.call_soon_threadsafe(self._loop.stop)
+    self._thread.join()
+    self._loop.close()
+
+  async def _close (self):
+    for ep in self._endpoints:
+      await ep.client.close()
+
+  def chat (self, **kwargs):
+    """Runs a chat request with the given arguments and returns the
+    response.  This blocks the calling thread, but any number of threads
+    may call it at the same time."""
+    return self._run(self._chat(kwargs))
+
+  async def _chat (self, kwargs):
+    if self.keep_alive is not None:
+      kwargs = dict(kwargs, keep_alive=self.keep_alive)
+
+    remaining = list(self._endpoints)
+    while True:
+      # Prefer endpoints that have not failed recently, and among those
+      # the one with the fewest requests running or waiting.
+      now = self._loop.time()
+      ep = min(remaining, key=lambda e: (e.failed_until > now, e.load))
+      remaining.remove(ep)
+
+      ep.load += 1
+      try:
+        async with ep.slots:
+          return await ep.client.chat(**kwargs)
+      except Exception as e:
+        if not _is_unavailable(e):
+          raise
+        ep.failed_until = self._loop.time() + FAILURE_BACKOFF
+        if not remaining:
+          raise
+      finally:
+        ep.load -= 1
@@ -0,0 +1,52 @@
+#    recallery - image metadata indexing and search
+#    Copyright (C) 2025  Daniel Kraft <d@domob.eu>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import collections
+import concurrent.futures
+
+class Pipeline:
+  """Runs a per-file task for many files concurrently on a pool of threads,
+  while handing back the results strictly in the order of the input files.
+  Together with the per-module limits of Processor and an executor for
+  CPU-bound modules, this lets e.g. captioning of one file proceed while
+  another one waits on Nominatim."""
+
+  def __init__ (self, jobs):
+    """Initialises the pipeline for running up to jobs files at once."""
+    self.jobs = jobs
+
+  def map (self, fcn, items):
+    """Calls fcn on each of the items, with up to jobs of those calls
+    running in parallel.  Yields tuples (item, result, error) in the order
+    of the items, where error is the exception raised by fcn (and result
+    is None in that case).  Only a bounded number of items is consumed ahead
+    of the results, so items may be a long-running generator."""
+
+    with concurrent.futures.ThreadPoolExecutor (max_workers=self.jobs) as ex:
+      pending = collections.deque ()
+      for item in items:
+        pending.append ((item, ex.submit (fcn, item)))
+        if len (pending) >= 2 * self.jobs:
+          yield self._collect (*pending.popleft ())
+      while pending:
+        yield self._collect (*pending.popleft ())
+
+  @staticmethod
+  def _collect (item, future):
+    try:
+      return item, future.result (), None
+    except Exception as e:
+      return item, None, e
@@ -0,0 +1,340 @@
+#    recallery - image metadata indexing and search
+#    Copyright (C) 2025  Daniel Kraft <d@domob.eu>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import contextlib
+import io
+import mmap
+import os
+import struct
+
+# Camera RAW and HEIF files, for which the embedded preview is used
+# instead of decoding the actual image data.
+RAW_EXTENSIONS = {".arw", ".cr2", ".cr3", ".dng", ".nef", ".nrw", ".orf",
+                  ".pef", ".raf", ".rw2", ".srw"}
+HEIF_EXTENSIONS = {".heic", ".heif"}
+PREVIEW_EXTENSIONS = RAW_EXTENSIONS | HEIF_EXTENSIONS
+
+# If the largest preview referenced from the TIFF structure of a RAW file
+# is smaller than this (e.g. just the EXIF thumbnail, when the actual
+# preview is hidden in the maker notes as for ORF and PEF), the whole file
+# is scanned for embedded JPEG images as well.
+MIN_PREVIEW_PIXELS = 1_000_000
+
+# HEIF thumbnails are HEVC-coded rather than JPEG.  They are decoded through
+# pillow-heif, using the smallest one with at least this size (longer side)
+# or otherwise the primary image.
+HEIF_THUMBNAIL_MIN_BOX = 1024
+
+# Sizes of the TIFF field types in bytes.
+_TIFF_TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 6: 1, 7: 1, 8: 2, 9: 4,
+                    10: 8, 11: 4, 12: 8, 13: 4}
+
+# TIFF tags that point to embedded images or further IFDs.
+_TAG_STRIP_OFFSETS = 0x111
+_TAG_STRIP_BYTE_COUNTS = 0x117
+_TAG_SUB_IFDS = 0x14a
+_TAG_JPEG_OFFSET = 0x201
+_TAG_JPEG_LENGTH = 0x202
+_TAG_EXIF_IFD = 0x8769
+_TAG_GPS_IFD = 0x8825
+
+# SOF markers of JPEG variants that PIL can decode (baseline, extended
+# and progressive).  In particular, this excludes the lossless JPEG used
+# for the raw data of many cameras.
+_DECODABLE_SOF = {0xc0, 0xc1, 0xc2}
+
+def has_preview (filename):
+  """Returns true if the file is of a type for which the embedded preview
+  should be used instead of the image itself."""
+  return os.path.splitext(str(filename))[1].lower() in PREVIEW_EXTENSIONS
+
+def _jpeg_info (buf, start, end=None):
+  """Checks if there is a JPEG stream that PIL can decode at position
+  start of buf.  Returns (pixels, length) or None.  If end is not given,
+  the end of the stream is determined from the EOI marker."""
+
+  if buf[start:start + 2] != b"\xff\xd8":
+    return None
+
+  pixels = None
+  pos = start + 2
+  limit = len(buf) if end is None else min(end, len(buf))
+  while pos + 4 <= limit:
+    if buf[pos] != 0xff:
+      return None
+    code = buf[pos + 1]
+    if code == 0xff:
+      pos += 1
+      continue
+    if code == 0x01 or 0xd0 <= code <= 0xd7:
+      pos += 2
+      continue
+    if code == 0xda:
+      if pixels is None:
+        return None
+      if end is not None:
+        return pixels, end - start
+      eoi = buf.find(b"\xff\xd9", pos)
+      if eoi < 0:
+        return None
+      return pixels, eoi + 2 - start
+
+    (length,) = struct.unpack_from(">H", buf, pos + 2)
+    if 0xc0 <= code <= 0xcf and code not in (0xc4, 0xc8, 0xcc):
+      if code not in _DECODABLE_SOF or pos + 9 > limit:
+        return None
+      height, width = struct.unpack_from(">HH", buf, pos + 5)
+      pixels = width * height
+    pos += 2 + length
+
+  return None
+
+class _Tiff:
+  """Minimal reader for TIFF structures, as used by most RAW formats.
+  The magic number is not checked, since e.g. ORF and RW2 files use
+  their own."""
+
+  def __init__ (self, buf, base=0):
+    self.buf = buf
+    self.base = base
+    order = bytes(buf[base:base + 2])
+    if order == b"II":
+      self.order = "<"
+    elif order == b"MM":
+      self.order = ">"
+    else:
+      raise ValueError("not a TIFF structure")
+    (self.first_ifd,) = self._unpack("I", 4)
+
+  def _unpack (self, fmt, offset):
+    return struct.unpack_from(self.order + fmt, self.buf, self.base + offset)
+
+  def entries (self, offset):
+    """Returns the entries of the IFD at offset as dict (tag to
+    (type, count, value offset)), and the offset of the next IFD."""
+
+    (count,) = self._unpack("H", offset)
+    res = {}
+    for i in range(count):
+      pos = offset + 2 + 12 * i
+      tag, typ, num = self._unpack("HHI", pos)
+      size = _TIFF_TYPE_SIZES.get(typ, 1) * num
+      value_pos = pos + 8
+      if size > 4:
+        (value_pos,) = self._unpack("I", pos + 8)
+      res[tag] = (typ, num, value_pos)
+    (next_ifd,) = self._unpack("I", offset + 2 + 12 * count)
+    return res, next_ifd
+
+  def values (self, entry):
+    """Returns the values of the IFD entry as list.  Rationals are
+    converted to float and ASCII strings to a single str."""
+
+    typ, num, pos = entry
+    if typ == 2:
+      raw = bytes(self.buf[self.base + pos:self.base + pos + num])
+      return [raw.split(b"\x00", 1)[0].decode("ascii", errors="replace")]
+    fmt = {1: "B", 3: "H", 4: "I", 6: "b", 7: "B", 8: "h", 9: "i",
+           13: "I"}.get(typ)
+    if fmt is not None:
+      return list(self._unpack(f"{num}{fmt}", pos))
+    if typ in (5, 10):
+      fmt = "I" if typ == 5 else "i"
+      parts = self._unpack(f"{2 * num}{fmt}", pos)
+      return [n / d if d else 0.0 for n, d in zip(parts[::2], parts[1::2])]
+    return []
+
+  def walk (self):
+    """Yields the entries of all IFDs (the main chain, SubIFDs and the EXIF
+    IFD), each at most once."""
+
+    todo = [self.first_ifd]
+    seen = set()
+    while todo:
+      offset = todo.pop()
+      if offset == 0 or offset in seen or len(seen) > 64:
+        continue
+      seen.add(offset)
+      try:
+        entries, next_ifd = self.entries(offset)
+      except struct.error:
+        continue
+      yield entries
+      todo.append(next_ifd)
+      for tag in (_TAG_SUB_IFDS, _TAG_EXIF_IFD):
+        if tag in entries:
+          todo.extend(self.values(entries[tag]))
+
+def _tiff_candidates (buf):
+  """Returns the (offset, length) of all embedded JPEG images referenced
+  by the TIFF structure of a RAW file."""
+
+  tiff = _Tiff(buf)
+  res = []
+  for entries in tiff.walk():
+    if _TAG_JPEG_OFFSET in entries and _TAG_JPEG_LENGTH in entries:
+      res.append((tiff.values(entries[_TAG_JPEG_OFFSET])[0],
+                  tiff.values(entries[_TAG_JPEG_LENGTH])[0]))
+    if _TAG_STRIP_OFFSETS in entries and _TAG_STRIP_BYTE_COUNTS in entries:
+      offsets = tiff.values(entries[_TAG_STRIP_OFFSETS])
+      counts = tiff.values(entries[_TAG_STRIP_BYTE_COUNTS])
+      if len(offsets) == 1 and len(counts) == 1:
+        res.append((offsets[0], counts[0]))
+    # Some formats (e.g. RW2) store the preview as a blob in a tag.
+    for typ, num, pos in entries.values():
+      if typ == 7 and num > 1024:
+        res.append((pos, num))
+  return res
+
+def _raf_candidates (buf):
+  """Returns the embedded JPEG image of a Fujifilm RAF file, whose
+  offset and length are stored at fixed positions of the header."""
+  offset, length = struct.unpack_from(">II", buf, 84)
+  return [(offset, length)]
+
+def _scan_candidates (buf):
+  """Finds embedded JPEG images by scanning for their start marker, for
+  containers that are not parsed here (e.g. CR3 and HEIF)."""
+  res = []
+  pos = buf.find(b"\xff\xd8\xff")
+  while pos >= 0:
+    res.append((pos, None))
+    pos = buf.find(b"\xff\xd8\xff", pos + 3)
+  return res
+
+def _best_jpeg (buf, candidates):
+  """Returns the largest JPEG image that PIL can decode from the candidate
+  (offset, length) positions as tuple (pixels, offset, length), or None."""
+
+  best = None
+  for offset, length in candidates:
+    if offset <= 0 or offset >= len(buf):
+      continue
+    end = None if length is None else offset + length
+    try:
+      info = _jpeg_info(buf, offset, end)
+    except struct.error:
+      info = None
+    if info is not None and (best is None or info[0] > best[0]):
+      best = (info[0], offset, info[1])
+  return best
+
+@contextlib.contextmanager
+def _mapped (filename):
+  """Memory-maps the file for reading.  Yields None for an empty file
+  (e.g. a partial copy), which cannot be mapped."""
+  with open(filename, "rb") as f:
+    if os.fstat(f.fileno()).st_size == 0:
+      yield None
+      return
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+      yield buf
+
+def _heif_preview (filename):
+  """Returns a thumbnail (or the primary image) of a HEIF file as JPEG
+  bytes, decoded through pillow-heif."""
+
+  try:
+    import pillow_heif
+  except ImportError:
+    raise RuntimeError(f"{filename} has no JPEG preview, and pillow-heif"
+                       " is not installed to decode it")
+  from PIL import Image
+
+  pillow_heif.register_heif_opener()
+  with Image.open(filename) as img:
+    thumb = pillow_heif.thumbnail(img, HEIF_THUMBNAIL_MIN_BOX)
+    if thumb.mode not in ("RGB", "L"):
+      thumb = thumb.convert("RGB")
+    out = io.BytesIO()
+    thumb.save(out, format="JPEG", quality=90, exif=img.getexif())
+  return out.getvalue()
+
+def extract_preview (filename):
+  """Returns the largest embedded JPEG preview of the RAW or HEIF file
+  as bytes.  For TIFF-based RAW formats, only the file structure and the
+  preview itself are read (unless the preview found that way is small).
+  Returns None if no preview is found."""
+
+  res = None
+  with _mapped(filename) as buf:
+    if buf is None:
+      return None
+
+    candidates = []
+    try:
+      if buf[:15] == b"FUJIFILMCCD-RAW":
+        candidates = _raf_candidates(buf)
+      elif buf[:2] in (b"II", b"MM"):
+        candidates = _tiff_candidates(buf)
+    except (ValueError, struct.error):
+      pass
+    best = _best_jpeg(buf, candidates)
+    if best is None or best[0] < MIN_PREVIEW_PIXELS:
+      scanned = _best_jpeg(buf, _scan_candidates(buf))
+      if scanned is not None and (best is None or scanned[0] > best[0]):
+        best = scanned
+    if best is not None:
+      _, offset, length = best
+      res = bytes(buf[offset:offset + length])
+
+  ext = os.path.splitext(str(filename))[1].lower()
+  if res is None and ext in HEIF_EXTENSIONS:
+    res = _heif_preview(filename)
+  return res
+
+def _gps_from_ifd (tiff, offset):
+  """Returns the tags of the GPS IFD at offset as dict."""
+  entries, _ = tiff.entries(offset)
+  res = {}
+  for tag, entry in entries.items():
+    vals = tiff.values(entry)
+    if len(vals) == 1:
+      res[tag] = vals[0]
+    elif vals:
+      res[tag] = tuple(vals)
+  return res
+
+def read_gps (filename):
+  """Reads the EXIF GPS tags from the RAW or HEIF file without decoding
+  it.  Returns a dict from GPS tag number to value (with rationals as
+  floats), or None if no GPS data is found here (e.g. because it is only
+  in the EXIF data of the embedded preview)."""
+
+  with _mapped(filename) as buf:
+    if buf is None:
+      return None
+    try:
+      if buf[:2] in (b"II", b"MM"):
+        tiff = _Tiff(buf)
+      else:
+        # CR3 stores the GPS IFD as its own TIFF structure in a CMT4 box.
+        pos = buf.find(b"CMT4")
+        if pos >= 0:
+          tiff = _Tiff(buf, pos + 4)
+          return _gps_from_ifd(tiff, tiff.first_ifd) or None
+        # HEIF has the EXIF data (in JPEG APP1 form) as an item.
+        pos = buf.find(b"Exif\x00\x00")
+        if pos < 0:
+          return None
+        tiff = _Tiff(buf, pos + 6)
+
+      entries, _ = tiff.entries(tiff.first_ifd)
+      if _TAG_GPS_IFD not in entries:
+        return None
+      return _gps_from_ifd(tiff, tiff.values(entries[_TAG_GPS_IFD])[0])
+    except (ValueError, struct.error):
+      return None
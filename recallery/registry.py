@@ -0,0 +1,85 @@
+#    recallery - image metadata indexing and search
+#    Copyright (C) 2025  Daniel Kraft <d@domob.eu>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from .base import Module
+
+import importlib
+import time
+
+# Time in seconds it took to import each of the backend implementations
+# that have been loaded so far.
+IMPORT_TIMES = {}
+
+class ModuleSpec (Module):
+  """Describes one of the recallery modules without importing its
+  implementation (and the heavy libraries it depends on).  A spec can be
+  added to a Processor directly for reading and clearing metadata, which
+  only needs the XMP property name.  For processing, load() imports the
+  implementation and constructs the actual module from the config."""
+
+  def __init__ (self, name, xmp_attribute, section, impl, enabled,
+                cpu_bound=False):
+    """Defines the module with the given name and XMP property.  section
+    is its config section, impl the Python module that implements it (and
+    has a from_config function), and enabled a predicate on the Config that
+    tells whether it is turned on."""
+    self._name = name
+    self._xmp_attribute = xmp_attribute
+    self.section = section
+    self.impl = impl
+    self._enabled = enabled
+    self._cpu_bound = cpu_bound
+
+  @property
+  def name (self):
+    return self._name
+
+  @property
+  def xmp_attribute (self):
+    return self._xmp_attribute
+
+  @property
+  def cpu_bound (self):
+    return self._cpu_bound
+
+  def enabled (self, config):
+    return self._enabled (config)
+
+  def process (self, img):
+    raise RuntimeError (f"module {self.name} has not been loaded")
+
+  def load (self, config):
+    """Imports the implementation and returns the module instance
+    for the given config."""
+    start = time.perf_counter ()
+    impl = importlib.import_module (self.impl)
+    IMPORT_TIMES.setdefault (self.impl, time.perf_counter () - start)
+    return impl.from_config (config)
+
+MODULES = [
+  ModuleSpec ("Location", "RevgeoLocation", "revgeo", "recallery.revgeo",
+              lambda config: True),
+  ModuleSpec ("Caption", "AICaption", "caption", "recallery.caption",
+              lambda config: config.get ("caption", "model") is not None),
+  ModuleSpec ("Persons", "DetectedPersons", "faces", "recallery.faces",
+              lambda config: ((config.known_faces_dir / "names.json").exists ()
+                              or config.encoded_faces_file.exists ()),
+              cpu_bound=True),
+]
+
+def enabled_modules (config):
+  """Returns the specs of all modules enabled in the config."""
+  return [m for m in MODULES if m.enabled (config)]
@@ -0,0 +1,127 @@
+#    recallery - image metadata indexing and search
+#    Copyright (C) 2025  Daniel Kraft <d@domob.eu>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import hashlib
+import sqlite3
+import threading
+import time
+
+class ResultCache:
+  """A content-addressed cache of module results, stored in an SQLite
+  database.  Entries are keyed by a hash of the image content together with
+  the module's configuration, so that results can be reused for renamed or
+  copied files, or after the metadata was stripped.  The total size of the
+  cached values is bounded, with the least recently used entries evicted
+  first."""
+
+  def __init__ (self, path, max_bytes=None):
+    self.max_bytes = max_bytes
+    self.hits = 0
+    self.misses = 0
+
+    self._lock = threading.Lock()
+    self._db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+    self._db.execute("""
+      CREATE TABLE IF NOT EXISTS `results` (
+        `key` TEXT PRIMARY KEY,
+        `value` TEXT NULL,
+        `size` INTEGER NOT NULL,
+        `used` REAL NOT NULL
+      )
+    """)
+    self._db.execute("""
+      CREATE INDEX IF NOT EXISTS `results_used` ON `results` (`used`)
+    """)
+    self._db.commit()
+
+  def close (self):
+    with self._lock:
+      self._db.close()
+
+  @staticmethod
+  def make_key (content_hash, module_key):
+    """Combines the hash of the image content and the module's cache
+    key into the key for the cache."""
+    h = hashlib.sha256()
+    h.update(content_hash.encode("ascii"))
+    h.update(b"\0")
+    h.update(module_key.encode("utf-8"))
+    return h.hexdigest()
+
+  def get (self, key):
+    """Looks up the given key.  Returns a tuple (found, value), where value
+    may be None also for found entries (if the module had no result)."""
+
+    with self._lock:
+      row = self._db.execute("""
+        SELECT `value` FROM `results` WHERE `key` = ?
+      """, (key,)).fetchone()
+      if row is None:
+        self.misses += 1
+        return False, None
+
+      self.hits += 1
+      self._db.execute("""
+        UPDATE `results` SET `used` = ? WHERE `key` = ?
+      """, (time.time(), key))
+      self._db.commit()
+      return True, row[0]
+
+  def put (self, key, value):
+    """Stores the value (which may be None) for the given key."""
+
+    size = len(key) + (0 if value is None else len(value.encode("utf-8")))
+    with self._lock:
+      # The database may be shared with other processes, so the total size
+      # is computed in the same (immediately locked) transaction as the
+      # insert and eviction.
+      self._db.execute("BEGIN IMMEDIATE")
+      try:
+        self._db.execute("""
+          INSERT OR REPLACE INTO `results` (`key`, `value`, `size`, `used`)
+            VALUES (?, ?, ?, ?)
+        """, (key, value, size, time.time()))
+
+        if self.max_bytes is not None:
+          (total,) = self._db.execute("""
+            SELECT COALESCE(SUM(`size`), 0) FROM `results`
+          """).fetchone()
+          if total > self.max_bytes:
+            self._evict(total)
+      except BaseException:
+        self._db.rollback()
+        raise
+      self._db.commit()
+
+  def _evict (self, total):
+    """Removes the least recently used entries until the total size
+    is within the limit again."""
+
+    rows = self._db.execute("""
+      SELECT `key`, `size` FROM `results` ORDER BY `used` ASC
+    """)
+    victims = []
+    for key, size in rows:
+      if total <= self.max_bytes:
+        break
+      victims.append((key,))
+      total -= size
+    self._db.executemany("DELETE FROM `results` WHERE `key` = ?", victims)
+
+  @property
+  def summary (self):
+    """Returns a human-readable string with the cache statistics."""
+    return f"Result cache: {self.hits} hits, {self.misses} misses"
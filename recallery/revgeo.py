@@ -15,34 +15,304 @@
 #    along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 from .base import Module
+from .geocache import GeoCache
 
 from geopy.geocoders import Nominatim
 from geopy.extra.rate_limiter import RateLimiter
+import collections
+import concurrent.futures
+import math
+import queue
+import threading
+import time
+
+# Mean radius of the earth and length of a degree of latitude in km.
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+
+# Time in seconds for which the result of a lookup is shared with nearby
+# requests, so that a long-running process (e.g. the watch daemon) does
+# not keep every location it has ever seen.
+DEDUP_EXPIRY = 3600
+
+class NominatimGeocoder:
+  """Reverse geocoding backend that queries a Nominatim API endpoint."""
+
+  def __init__ (self, nominatim, delay=0, scheme=None):
+    """Initialises the reverse geocoder based on a Nominatim API endpoint
+    and with an optional rate-limiting delay between requests.  scheme can
+    be set to "http" for servers without TLS."""
+    geolocator = Nominatim(user_agent="recallery", domain=nominatim,
+                           scheme=scheme)
+    self.reverse = RateLimiter(geolocator.reverse, min_delay_seconds=delay)
+
+  def lookup (self, coords):
+    """Returns the address for the given (latitude, longitude) tuple,
+    or None if there is none."""
+    location = self.reverse(coords)
+    if location is None:
+      return None
+    return location.address
+
+class GazetteerGeocoder:
+  """Reverse geocoding backend that looks up the nearest place in a local
+  gazetteer index, without any network access."""
+
+  def __init__ (self, gazetteer):
+    """Initialises the backend with a Gazetteer instance."""
+    self.gazetteer = gazetteer
+
+  def lookup (self, coords):
+    res = self.gazetteer.nearest(coords)
+    if res is None:
+      return None
+    return res[0]
+
+def _distance_km (a, b):
+  """Returns the great-circle distance between two (lat, lon) tuples."""
+  lat1, lon1 = map(math.radians, a)
+  lat2, lon2 = map(math.radians, b)
+  h = (math.sin((lat2 - lat1) / 2)**2
+        + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2)**2)
+  return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(h)))
+
+class GeocodingQueue:
+  """Runs the lookups of a geocoder in a background thread, one at a time
+  (so that a rate limit of the backend is respected without blocking the
+  callers).  Requests for coordinates within radius km of a location that
+  was requested recently (within DEDUP_EXPIRY) share its result, so that
+  there is only one lookup per distinct place.  Failed lookups are not
+  shared, so that the next nearby request tries again.  If a GeoCache is
+  given, it is consulted before queueing a lookup."""
+
+  def __init__ (self, geocoder, radius, cache=None):
+    self.geocoder = geocoder
+    self.radius = radius
+    self.cache = cache
+    self.lookups = 0
+    self.shared = 0
+
+    self._lock = threading.Lock()
+    self._cells = {}
+    self._finished = collections.deque()
+    self._queue = queue.Queue()
+    self._thread = None
+
+  def _cell (self, coords):
+    size = max(self.radius, 1e-3) / KM_PER_DEGREE
+    return int(math.floor(coords[0] / size)), int(math.floor(coords[1] / size))
+
+  def _find (self, coords):
+    """Returns the future of a previous request within the radius of
+    coords, or None.  Must be called with the lock held."""
+
+    lat_cell, lon_cell = self._cell(coords)
+    # A degree of longitude is shorter than a degree of latitude, so more
+    # cells have to be checked along the longitude.
+    cos_lat = max(math.cos(math.radians(coords[0])), 0.01)
+    lon_range = min(int(math.ceil(1 / cos_lat)), 100)
+    for dlat in (-1, 0, 1):
+      for dlon in range(-lon_range, lon_range + 1):
+        for other, future in self._cells.get((lat_cell + dlat,
+                                              lon_cell + dlon), []):
+          if _distance_km(coords, other) <= self.radius:
+            return future
+    return None
+
+  def submit (self, coords):
+    """Requests the address for the given (latitude, longitude) tuple.
+    Returns a Future for it."""
+
+    if self.cache is not None:
+      found, address = self.cache.get(coords)
+      if found:
+        future = concurrent.futures.Future()
+        future.set_result(address)
+        return future
+
+    with self._lock:
+      self._expire(time.monotonic())
+      if self.radius > 0:
+        future = self._find(coords)
+        if future is not None:
+          self.shared += 1
+          return future
+
+      future = concurrent.futures.Future()
+      self._cells.setdefault(self._cell(coords), []).append((coords, future))
+      self._queue.put((coords, future))
+      if self._thread is None:
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+    return future
+
+  def _forget (self, coords, future):
+    """Removes a request from the cells.  Must be called with the lock
+    held."""
+    cell = self._cell(coords)
+    entries = [e for e in self._cells.get(cell, []) if e[1] is not future]
+    if entries:
+      self._cells[cell] = entries
+    else:
+      self._cells.pop(cell, None)
+
+  def _expire (self, now):
+    """Removes the finished requests that are no longer shared.  Must be
+    called with the lock held."""
+    while self._finished and self._finished[0][0] <= now:
+      _, coords, future = self._finished.popleft()
+      self._forget(coords, future)
+
+  def _run (self):
+    while True:
+      coords, future = self._queue.get()
+      if not future.set_running_or_notify_cancel():
+        with self._lock:
+          self._forget(coords, future)
+        continue
+      try:
+        address = self.geocoder.lookup(coords)
+        self.lookups += 1
+        if self.cache is not None:
+          self.cache.put(coords, address)
+      except Exception as e:
+        with self._lock:
+          self._forget(coords, future)
+        future.set_exception(e)
+        continue
+
+      # Only successful requests are kept for sharing (until they expire).
+      with self._lock:
+        self._finished.append((time.monotonic() + DEDUP_EXPIRY,
+                               coords, future))
+      future.set_result(address)
+
+  @property
+  def summary (self):
+    return (f"Reverse geocoding: {self.lookups} lookups,"
+            f" {self.shared} shared with nearby photos")
 
 class ReverseGeocoding (Module):
   """Module that takes geo coordinates from image metadata and applies
   reverse geocoding to get a place name in text form that can then be
   attached to the image for better searching."""
 
-  def __init__ (self, nominatim, delay=0):
-    """Initialises the reverse geocoder based on a Nominatim API endpoint
-    and with an optional rate-limiting delay between requests."""
-    geolocator = Nominatim(user_agent="recallery", domain=nominatim)
-    self.reverse = RateLimiter(geolocator.reverse, min_delay_seconds=delay)
+  def __init__ (self, geocoder, cache=None, dedup_radius=None):
+    """Initialises the module with the backend (e.g. NominatimGeocoder)
+    to use for the lookups.  If a GeoCache instance is passed, it is
+    consulted before querying the backend.  If dedup_radius (in km) is
+    given, lookups are made in the background through a GeocodingQueue
+    with that radius, so that they do not block processing."""
+    self.geocoder = geocoder
+    self.cache = cache
+    self.queue = None
+    if dedup_radius is not None:
+      self.queue = GeocodingQueue(geocoder, dedup_radius, cache)
 
   @property
   def name (self):
     return "Location"
 
+  @property
+  def summary (self):
+    lines = []
+    if self.queue is not None:
+      lines.append(self.queue.summary)
+    if self.cache is not None:
+      lines.append(self.cache.summary)
+    return "\n".join(lines) if lines else None
+
   @property
   def xmp_attribute (self):
     return "RevgeoLocation"
 
+  def submit (self, img):
+    if self.queue is None:
+      return None
+
+    coords = img.geo_coordinates
+    if coords is None:
+      future = concurrent.futures.Future()
+      future.set_result(None)
+      return future
+    return self.queue.submit(coords)
+
   def process (self, img):
+    if self.queue is not None:
+      return self.submit(img).result()
+
     coords = img.geo_coordinates
     if coords is None:
       return None
-    location = self.reverse(coords)
-    if location is None:
-      return None
-    return location.address
+
+    if self.cache is not None:
+      found, address = self.cache.get(coords)
+      if found:
+        return address
+
+    address = self.geocoder.lookup(coords)
+
+    if self.cache is not None:
+      self.cache.put(coords, address)
+    return address
+
+def from_config (config):
+  """Creates the reverse geocoding module for the [revgeo] section
+  of the given Config."""
+
+  backend = config.get("revgeo", "backend")
+  if backend is None:
+    backend = "nominatim"
+
+  geocache = None
+  dedup_radius = None
+  if backend == "nominatim":
+    nominatim_url = config.get("revgeo", "nominatim")
+    if nominatim_url is None:
+      nominatim_url = "nominatim.openstreetmap.org"
+
+    nominatim_delay = config.get("revgeo", "delay")
+    if nominatim_delay is None:
+      nominatim_delay = 5
+    else:
+      nominatim_delay = int(nominatim_delay)
+
+    geocoder = NominatimGeocoder(nominatim_url, nominatim_delay,
+                                 config.get("revgeo", "scheme"))
+
+    # The cache of reverse geocoding results is enabled by default, with
+    # coordinates rounded to four decimal places (about 10 m) and entries
+    # expiring after 180 days.
+    if config.get_boolean("revgeo", "cache", True):
+      precision = config.get("revgeo", "cache_precision")
+      precision = 4 if precision is None else int(precision)
+      ttl_days = config.get("revgeo", "cache_ttl")
+      ttl_days = 180 if ttl_days is None else float(ttl_days)
+      max_entries = config.get("revgeo", "cache_size")
+      max_entries = None if max_entries is None else int(max_entries)
+      geocache = GeoCache(config.revgeo_cache_file, precision,
+                          ttl_days * 24 * 60 * 60, max_entries)
+
+    # Lookups run in the background by default, so that the rate limit
+    # does not hold up the other modules.  Photos taken within
+    # [revgeo] dedup_radius km (100 m by default) of each other share
+    # a single lookup.
+    if config.get_boolean("revgeo", "background", True):
+      dedup_radius = config.get("revgeo", "dedup_radius")
+      dedup_radius = 0.1 if dedup_radius is None else float(dedup_radius)
+  elif backend == "gazetteer":
+    from .gazetteer import DEFAULT_MAX_DISTANCE, Gazetteer
+
+    max_distance = config.get("revgeo", "max_distance")
+    if max_distance is None:
+      max_distance = DEFAULT_MAX_DISTANCE
+    else:
+      max_distance = float(max_distance)
+    if not config.gazetteer_dir.exists():
+      raise RuntimeError(f"Gazetteer index {config.gazetteer_dir} does not"
+                         " exist, build it with recallery-build-gazetteer")
+    geocoder = GazetteerGeocoder(Gazetteer(config.gazetteer_dir, max_distance))
+  else:
+    raise RuntimeError(f"Unknown reverse geocoding backend {backend}")
+
+  return ReverseGeocoding(geocoder, geocache, dedup_radius)
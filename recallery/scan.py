@@ -0,0 +1,181 @@
+#    recallery - image metadata indexing and search
+#    Copyright (C) 2025  Daniel Kraft <d@domob.eu>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from .image import sidecar_path
+from .preview import PREVIEW_EXTENSIONS
+
+import hashlib
+import os
+import sqlite3
+import threading
+
+# File extensions (lower-case) that are picked up when scanning directories.
+# This includes RAW and HEIF files, which are processed through their
+# embedded previews.
+IMAGE_EXTENSIONS = ({".jpg", ".jpeg", ".png", ".tif", ".tiff", ".webp"}
+                    | PREVIEW_EXTENSIONS)
+
+def iter_files (paths):
+  """Yields all files to process for the given list of paths.  Files are
+  yielded as they are, while directories are walked recursively (in sorted
+  order) for image files."""
+
+  for path in paths:
+    if not os.path.isdir(path):
+      yield path
+      continue
+
+    for root, dirs, files in os.walk(path):
+      dirs.sort()
+      for name in sorted(files):
+        if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS:
+          yield os.path.join(root, name)
+
+def hash_file (path):
+  """Returns the SHA-256 hash of the file's content as hex string."""
+  h = hashlib.sha256()
+  with open(path, "rb") as f:
+    while True:
+      chunk = f.read(1 << 20)
+      if not chunk:
+        break
+      h.update(chunk)
+  return h.hexdigest()
+
+def _sidecar_state (path):
+  """Returns the stat data of the XMP sidecar of the given file as string,
+  or None if there is no sidecar."""
+  try:
+    st = os.stat(sidecar_path(path))
+  except FileNotFoundError:
+    return None
+  return f"{st.st_size}:{st.st_mtime_ns}:{st.st_ino}"
+
+class Manifest:
+  """A record of files that have been processed, stored in an SQLite
+  database.  For each file, it keeps the size, modification time and inode
+  (and optionally a content hash) as of the end of processing, together with
+  the XMP properties that were complete at that time.  This allows skipping
+  unchanged files based on a stat call alone.  The stat data of the file's
+  XMP sidecar (if any) is recorded as well, so that files are also
+  processed again when their sidecar is changed or removed."""
+
+  def __init__ (self, path, use_hash=False):
+    """Opens (or creates) the manifest database.  If use_hash is set,
+    files whose stat data changed are still considered unchanged if their
+    content hash matches."""
+
+    self.use_hash = use_hash
+    self._lock = threading.Lock()
+    self._db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+    self._db.execute("""
+      CREATE TABLE IF NOT EXISTS `files` (
+        `path` TEXT PRIMARY KEY,
+        `size` INTEGER NOT NULL,
+        `mtime` INTEGER NOT NULL,
+        `inode` INTEGER NOT NULL,
+        `hash` TEXT NULL,
+        `sidecar` TEXT NULL,
+        `modules` TEXT NOT NULL
+      )
+    """)
+    self._db.commit()
+
+  def close (self):
+    with self._lock:
+      self._db.close()
+
+  def is_current (self, filename, attributes):
+    """Returns true if the file is unchanged since it was recorded, and
+    all of the given XMP properties were complete at that time."""
+
+    path = os.path.abspath(filename)
+    with self._lock:
+      row = self._db.execute("""
+        SELECT `size`, `mtime`, `inode`, `hash`, `sidecar`, `modules`
+          FROM `files`
+          WHERE `path` = ?
+      """, (path,)).fetchone()
+    if row is None:
+      return False
+
+    size, mtime, inode, digest, sidecar, modules = row
+    if not set(attributes).issubset(modules.split(",")):
+      return False
+    if _sidecar_state(path) != sidecar:
+      return False
+
+    try:
+      st = os.stat(path)
+    except OSError:
+      return False
+    if (st.st_size, st.st_mtime_ns, st.st_ino) == (size, mtime, inode):
+      return True
+
+    if not self.use_hash or digest is None or st.st_size != size:
+      return False
+    if hash_file(path) != digest:
+      return False
+
+    # The file was only touched (or copied), so update the stat data
+    # for next time.
+    with self._lock:
+      self._db.execute("""
+        UPDATE `files`
+          SET `mtime` = ?, `inode` = ?
+          WHERE `path` = ?
+      """, (st.st_mtime_ns, st.st_ino, path))
+      self._db.commit()
+    return True
+
+  def record (self, filename, attributes):
+    """Records the current state of the file, with the given XMP properties
+    being complete.  This must be called after all metadata has been written
+    to the file."""
+
+    path = os.path.abspath(filename)
+    st = os.stat(path)
+    digest = hash_file(path) if self.use_hash else None
+    sidecar = _sidecar_state(path)
+    with self._lock:
+      self._db.execute("""
+        INSERT OR REPLACE INTO `files`
+          (`path`, `size`, `mtime`, `inode`, `hash`, `sidecar`, `modules`)
+          VALUES (?, ?, ?, ?, ?, ?, ?)
+      """, (path, st.st_size, st.st_mtime_ns, st.st_ino, digest, sidecar,
+            ",".join(sorted(attributes))))
+      self._db.commit()
+
+  def refresh (self, filename, attributes=()):
+    """Updates the stat data of the file (if it is in the manifest at all)
+    after its metadata was changed outside of processing.  The given XMP
+    properties are marked as complete in addition."""
+
+    path = os.path.abspath(filename)
+    with self._lock:
+      row = self._db.execute("""
+        SELECT `modules` FROM `files` WHERE `path` = ?
+      """, (path,)).fetchone()
+    if row is not None:
+      complete = {a for a in row[0].split(",") if a}
+      self.record(path, complete.union(attributes))
+
+  def remove (self, filename):
+    """Removes the file from the manifest, so that it is processed again."""
+    with self._lock:
+      self._db.execute("DELETE FROM `files` WHERE `path` = ?",
+                       (os.path.abspath(filename),))
+      self._db.commit()
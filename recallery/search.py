@@ -0,0 +1,113 @@
+#    recallery - image metadata indexing and search
+#    Copyright (C) 2025  Daniel Kraft <d@domob.eu>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import re
+import sqlite3
+import threading
+
+# The metadata properties that are indexed for search.
+INDEXED_PROPERTIES = ["AICaption", "RevgeoLocation", "DetectedPersons"]
+
+class SearchIndex:
+  """A persistent full-text index of the recallery metadata of image files,
+  stored as an SQLite FTS5 table.  It is updated as files are processed or
+  cleared, and answers ranked queries without opening any of the files."""
+
+  properties = INDEXED_PROPERTIES
+
+  def __init__ (self, path):
+    self._lock = threading.Lock()
+    self._db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+    self._db.execute("""
+      CREATE TABLE IF NOT EXISTS `files` (
+        `id` INTEGER PRIMARY KEY,
+        `path` TEXT NOT NULL UNIQUE
+      )
+    """)
+    columns = ", ".join(f"`{p}`" for p in INDEXED_PROPERTIES)
+    self._db.execute(f"""
+      CREATE VIRTUAL TABLE IF NOT EXISTS `metadata` USING fts5 (
+        {columns},
+        tokenize = 'unicode61 remove_diacritics 2'
+      )
+    """)
+    self._db.commit()
+
+  def close (self):
+    with self._lock:
+      self._db.close()
+
+  def update (self, filename, props):
+    """Sets the indexed metadata of the given file, where props is a dict
+    mapping XMP property names to their values.  If none of the properties
+    is set, the file is removed from the index."""
+
+    path = os.path.abspath(filename)
+    values = [props.get(p) for p in INDEXED_PROPERTIES]
+    if all(v is None for v in values):
+      self.remove(filename)
+      return
+
+    with self._lock:
+      self._db.execute("""
+        INSERT OR IGNORE INTO `files` (`path`) VALUES (?)
+      """, (path,))
+      (rowid,) = self._db.execute("""
+        SELECT `id` FROM `files` WHERE `path` = ?
+      """, (path,)).fetchone()
+      self._db.execute("DELETE FROM `metadata` WHERE `rowid` = ?", (rowid,))
+      placeholders = ", ".join("?" for _ in INDEXED_PROPERTIES)
+      self._db.execute(f"""
+        INSERT INTO `metadata` (`rowid`, {", ".join(INDEXED_PROPERTIES)})
+          VALUES (?, {placeholders})
+      """, [rowid] + values)
+      self._db.commit()
+
+  def remove (self, filename):
+    """Removes the given file from the index (if it is there)."""
+
+    path = os.path.abspath(filename)
+    with self._lock:
+      row = self._db.execute("""
+        SELECT `id` FROM `files` WHERE `path` = ?
+      """, (path,)).fetchone()
+      if row is None:
+        return
+      self._db.execute("DELETE FROM `metadata` WHERE `rowid` = ?", row)
+      self._db.execute("DELETE FROM `files` WHERE `id` = ?", row)
+      self._db.commit()
+
+  def search (self, query, limit=None):
+    """Searches the index for files matching all words in the query
+    string.  Returns a list of file paths, best matches first."""
+
+    words = re.findall(r"\w+", query)
+    if not words:
+      return []
+    match = " ".join(f'"{w}"' for w in words)
+
+    with self._lock:
+      rows = self._db.execute("""
+        SELECT `files`.`path`
+          FROM `metadata`
+          INNER JOIN `files` ON `files`.`id` = `metadata`.`rowid`
+          WHERE `metadata` MATCH ?
+          ORDER BY `metadata`.`rank`
+          LIMIT ?
+      """, (match, -1 if limit is None else limit)).fetchall()
+
+    return [r[0] for r in rows]
@@ -0,0 +1,127 @@
+#    recallery - image metadata indexing and search
+#    Copyright (C) 2025  Daniel Kraft <d@domob.eu>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import contextlib
+import json
+import threading
+import time
+
+class Stats:
+  """Collects the wall time and number of calls of processing phases
+  (like decoding, XMP reads and writes, or running a module), as well as
+  counters of events (like cache hits).  Names are either a plain phase
+  or event name, or of the form "kind:module" for per-module values.
+  Recording is thread-safe, as files are processed in parallel."""
+
+  def __init__ (self):
+    self.started = time.perf_counter()
+    self.timers = {}
+    self.counters = {}
+    self._lock = threading.Lock()
+
+  @contextlib.contextmanager
+  def timer (self, name):
+    """Returns a context manager that records the time spent in it
+    for the given phase."""
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      duration = time.perf_counter() - start
+      with self._lock:
+        entry = self.timers.setdefault(name, [0, 0.0])
+        entry[0] += 1
+        entry[1] += duration
+
+  def count (self, name, n=1):
+    """Increments the counter of the given event."""
+    with self._lock:
+      self.counters[name] = self.counters.get(name, 0) + n
+
+  def as_dict (self):
+    """Returns all recorded values as dict suitable for JSON."""
+    with self._lock:
+      return {
+        "wall_seconds": time.perf_counter() - self.started,
+        "timers": {nm: {"calls": calls, "seconds": seconds}
+                   for nm, (calls, seconds) in sorted(self.timers.items())},
+        "counters": dict(sorted(self.counters.items())),
+      }
+
+  def report (self):
+    """Returns the recorded values as human-readable text."""
+    data = self.as_dict()
+    lines = [f"Total wall time: {data['wall_seconds']:.2f} s"]
+    for nm, t in data["timers"].items():
+      avg = 1000 * t["seconds"] / t["calls"]
+      lines.append(f"  {nm:<30} {t['calls']:>8} calls {t['seconds']:>10.2f} s"
+                   f" ({avg:.1f} ms avg)")
+    for nm, value in data["counters"].items():
+      lines.append(f"  {nm:<30} {value:>8}")
+    return "\n".join(lines)
+
+  def prometheus (self):
+    """Returns the recorded values in the Prometheus text format, e.g. for
+    the textfile collector of the node exporter."""
+
+    def labels(nm, kind):
+      if ":" in nm:
+        kind_value, module = nm.split(":", 1)
+        return f'{{{kind}="{kind_value}",module="{module}"}}'
+      return f'{{{kind}="{nm}"}}'
+
+    data = self.as_dict()
+    lines = [
+      "# TYPE recallery_wall_seconds gauge",
+      f"recallery_wall_seconds {data['wall_seconds']:.6f}",
+      "# TYPE recallery_phase_seconds_total counter",
+    ]
+    for nm, t in data["timers"].items():
+      lines.append(f"recallery_phase_seconds_total{labels(nm, 'phase')}"
+                   f" {t['seconds']:.6f}")
+    lines.append("# TYPE recallery_phase_calls_total counter")
+    for nm, t in data["timers"].items():
+      lines.append(f"recallery_phase_calls_total{labels(nm, 'phase')}"
+                   f" {t['calls']}")
+    lines.append("# TYPE recallery_events_total counter")
+    for nm, value in data["counters"].items():
+      lines.append(f"recallery_events_total{labels(nm, 'event')} {value}")
+    return "\n".join(lines) + "\n"
+
+  def write (self, path):
+    """Writes the report to the given file, in Prometheus format if its
+    name ends in .prom and as JSON otherwise."""
+    path = str(path)
+    with open(path, "w", encoding="utf-8") as f:
+      if path.endswith(".prom"):
+        f.write(self.prometheus())
+      else:
+        json.dump(self.as_dict(), f, indent=2)
+
+class _NoStats:
+  """Stand-in for Stats when instrumentation is disabled, which does
+  as little work as possible."""
+
+  _null = contextlib.nullcontext()
+
+  def timer (self, name):
+    return self._null
+
+  def count (self, name, n=1):
+    pass
+
+# Shared instance used by default, which records nothing.
+NO_STATS = _NoStats()
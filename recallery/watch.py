@@ -0,0 +1,304 @@
+#    recallery - image metadata indexing and search
+#    Copyright (C) 2025  Daniel Kraft <d@domob.eu>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from .scan import IMAGE_EXTENSIONS, iter_files
+
+import ctypes
+import ctypes.util
+import os
+import select
+import sqlite3
+import struct
+import sys
+import threading
+import time
+
+# inotify constants from <sys/inotify.h>.
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+_EVENT_HEADER = struct.Struct("iIII")
+
+# Files whose processing failed are retried after RETRY_DELAY seconds,
+# doubling with each further failure up to RETRY_MAX_DELAY.
+RETRY_DELAY = 60.0
+RETRY_MAX_DELAY = 3600.0
+
+def is_image_file (path):
+  """Returns true if the path looks like an image file that should be
+  processed, excluding hidden (e.g. temporary) files."""
+  name = os.path.basename(path)
+  if name.startswith("."):
+    return False
+  return os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS
+
+class _Inotify:
+  """Minimal wrapper around the Linux inotify API through ctypes."""
+
+  def __init__ (self):
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    self._add_watch = libc.inotify_add_watch
+    self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    if self.fd < 0:
+      raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+    self.dirs = {}
+
+  def close (self):
+    os.close(self.fd)
+
+  def add_watch (self, path):
+    wd = self._add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+    if wd < 0:
+      err = ctypes.get_errno()
+      raise OSError(err, os.strerror(err), path)
+    self.dirs[wd] = path
+
+  def read (self, timeout):
+    """Waits up to timeout seconds for events, and returns a list of
+    (path, mask) tuples.  The path is None for a queue overflow."""
+
+    ready, _, _ = select.select([self.fd], [], [], timeout)
+    if not ready:
+      return []
+    try:
+      buf = os.read(self.fd, 64 * 1024)
+    except BlockingIOError:
+      return []
+
+    res = []
+    pos = 0
+    while pos + _EVENT_HEADER.size <= len(buf):
+      wd, mask, _, length = _EVENT_HEADER.unpack_from(buf, pos)
+      pos += _EVENT_HEADER.size
+      name = buf[pos:pos + length].rstrip(b"\0")
+      pos += length
+
+      if mask & IN_Q_OVERFLOW:
+        res.append((None, mask))
+      elif mask & IN_IGNORED:
+        self.dirs.pop(wd, None)
+      elif wd in self.dirs:
+        res.append((os.path.join(self.dirs[wd], os.fsdecode(name)), mask))
+    return res
+
+class DirectoryWatcher:
+  """Watches directory trees for image files that are created or modified.
+  On Linux, this uses inotify.  Elsewhere (or if inotify is not available),
+  the directories are scanned again every poll_interval seconds."""
+
+  def __init__ (self, paths, poll_interval=10):
+    self.paths = [os.path.abspath(p) for p in paths]
+    self.poll_interval = poll_interval
+
+    self._inotify = None
+    if sys.platform.startswith("linux"):
+      try:
+        self._inotify = _Inotify()
+      except (OSError, AttributeError):
+        self._inotify = None
+
+    self._known = {}
+    self._last_scan = 0
+    if self._inotify is not None:
+      for path in self.paths:
+        self._watch_tree(path)
+    else:
+      self._scan()
+
+  def close (self):
+    if self._inotify is not None:
+      self._inotify.close()
+
+  def _watch_tree (self, path):
+    """Adds watches for path and all directories below it.  Returns the
+    image files already in them (which may have been created before the
+    watch was in place)."""
+    for root, dirs, _ in os.walk(path):
+      try:
+        self._inotify.add_watch(root)
+      except OSError as e:
+        print(f"Warning: cannot watch {root}: {e}", file=sys.stderr)
+    return [f for f in iter_files([path]) if is_image_file(f)]
+
+  def _scan (self):
+    """Scans all paths and returns the image files that are new or whose
+    size or modification time changed since the last scan."""
+    self._last_scan = time.monotonic()
+    res = []
+    seen = {}
+    for f in iter_files(self.paths):
+      if not is_image_file(f):
+        continue
+      try:
+        st = os.stat(f)
+      except OSError:
+        continue
+      seen[f] = (st.st_size, st.st_mtime_ns)
+      if self._known.get(f) != seen[f]:
+        res.append(f)
+    self._known = seen
+    return res
+
+  def read (self, timeout):
+    """Waits up to timeout seconds and returns the list of image files
+    that have been created or modified (possibly still being written)."""
+
+    if self._inotify is None:
+      remaining = self._last_scan + self.poll_interval - time.monotonic()
+      if remaining > timeout:
+        time.sleep(timeout)
+        return []
+      time.sleep(max(0, remaining))
+      return self._scan()
+
+    res = []
+    for path, mask in self._inotify.read(timeout):
+      if path is None:
+        # Events were lost, so look at everything again.
+        for p in self.paths:
+          res.extend(self._watch_tree(p))
+      elif mask & IN_ISDIR:
+        if mask & (IN_CREATE | IN_MOVED_TO):
+          res.extend(self._watch_tree(path))
+      elif is_image_file(path):
+        res.append(path)
+    return res
+
+class Debouncer:
+  """Tracks files that are being written, and releases them once their
+  size and modification time have not changed for settle seconds."""
+
+  def __init__ (self, settle):
+    self.settle = settle
+    self._pending = {}
+
+  def __len__ (self):
+    return len(self._pending)
+
+  def add (self, path):
+    """Notes that the file has changed (just now)."""
+    self._pending[path] = (None, time.monotonic())
+
+  def ready (self):
+    """Returns the files that have settled, and stops tracking them.
+    Files that disappeared are dropped."""
+
+    now = time.monotonic()
+    res = []
+    for path, (stat, since) in list(self._pending.items()):
+      try:
+        st = os.stat(path)
+      except OSError:
+        del self._pending[path]
+        continue
+      current = (st.st_size, st.st_mtime_ns)
+      if current != stat:
+        self._pending[path] = (current, now)
+      elif now - since >= self.settle:
+        del self._pending[path]
+        res.append(path)
+    return res
+
+class Backlog:
+  """Files waiting to be processed by the watch daemon, persisted in an
+  SQLite database so that they are not lost on a restart.  Files whose
+  processing failed stay in the backlog, and are retried with a delay
+  that increases with the number of failed attempts."""
+
+  def __init__ (self, path):
+    self._lock = threading.Lock()
+    self._db = sqlite3.connect(path, check_same_thread=False)
+    self._db.execute("""
+      CREATE TABLE IF NOT EXISTS `backlog` (
+        `path` TEXT PRIMARY KEY,
+        `added` REAL NOT NULL,
+        `attempts` INTEGER NOT NULL DEFAULT 0,
+        `retry_at` REAL NOT NULL DEFAULT 0
+      )
+    """)
+    self._db.commit()
+
+  def close (self):
+    with self._lock:
+      self._db.close()
+
+  def __len__ (self):
+    with self._lock:
+      (res,) = self._db.execute("SELECT COUNT(*) FROM `backlog`").fetchone()
+    return res
+
+  def add (self, paths):
+    """Adds the given files (if not yet in the backlog)."""
+    now = time.time()
+    with self._lock:
+      self._db.executemany("""
+        INSERT OR IGNORE INTO `backlog` (`path`, `added`) VALUES (?, ?)
+      """, [(os.path.abspath(p), now) for p in paths])
+      self._db.commit()
+
+  def remove (self, path):
+    """Removes a file that has been processed."""
+    with self._lock:
+      self._db.execute("DELETE FROM `backlog` WHERE `path` = ?",
+                       (os.path.abspath(path),))
+      self._db.commit()
+
+  def fail (self, path):
+    """Records that processing the file failed, so that it is retried
+    later.  Returns the number of failed attempts so far."""
+    with self._lock:
+      path = os.path.abspath(path)
+      row = self._db.execute("""
+        SELECT `attempts` FROM `backlog` WHERE `path` = ?
+      """, (path,)).fetchone()
+      if row is None:
+        return 0
+      attempts = row[0] + 1
+      delay = min(RETRY_MAX_DELAY, RETRY_DELAY * 2**(attempts - 1))
+      self._db.execute("""
+        UPDATE `backlog`
+          SET `attempts` = ?, `retry_at` = ?
+          WHERE `path` = ?
+      """, (attempts, time.time() + delay, path))
+      self._db.commit()
+    return attempts
+
+  def oldest (self, limit, exclude=()):
+    """Returns up to limit files from the backlog, oldest first, that
+    are not in exclude and not waiting for a retry."""
+    with self._lock:
+      rows = self._db.execute("""
+        SELECT `path` FROM `backlog`
+          WHERE `retry_at` <= ?
+          ORDER BY `added`, `path`
+      """, (time.time(),))
+      res = []
+      for (path,) in rows:
+        if len(res) >= limit:
+          break
+        if path not in exclude:
+          res.append(path)
+    return res
@@ -0,0 +1,110 @@
+#    recallery - image metadata indexing and search
+#    Copyright (C) 2025  Daniel Kraft <d@domob.eu>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import struct
+import xml.etree.ElementTree as ET
+
+# Signatures of the JPEG APP1 segments that hold XMP data.
+XMP_SIGNATURE = b"http://ns.adobe.com/xap/1.0/\x00"
+EXTENDED_XMP_SIGNATURE = b"http://ns.adobe.com/xmp/extension/\x00"
+
+RDF_NS = "http://www.w3.org/1999/02/22-rdf-syntax-ns#"
+
+class UnsupportedXmp (Exception):
+  """Raised if the XMP data is in a form that the scanner does not handle,
+  in which case the caller should fall back to exempi."""
+
+def _read_jpeg_packet (f):
+  """Walks the JPEG segments in the header of the file f, up to the start
+  of the image data, and returns the XMP packet as bytes, or None if there
+  is none."""
+
+  if f.read(2) != b"\xff\xd8":
+    raise UnsupportedXmp("not a JPEG file")
+
+  packet = None
+  while True:
+    byte = f.read(1)
+    if byte != b"\xff":
+      raise UnsupportedXmp("invalid JPEG marker")
+    marker = f.read(1)
+    while marker == b"\xff":
+      marker = f.read(1)
+    if not marker:
+      raise UnsupportedXmp("unexpected end of file")
+
+    code = marker[0]
+    if code == 0x01 or 0xd0 <= code <= 0xd8:
+      continue
+    if code in (0xd9, 0xda):
+      return packet
+
+    header = f.read(2)
+    if len(header) != 2:
+      raise UnsupportedXmp("unexpected end of file")
+    (length,) = struct.unpack(">H", header)
+    if code != 0xe1:
+      f.seek(length - 2, 1)
+      continue
+
+    payload = f.read(length - 2)
+    if payload.startswith(EXTENDED_XMP_SIGNATURE):
+      raise UnsupportedXmp("extended XMP")
+    if packet is None and payload.startswith(XMP_SIGNATURE):
+      packet = payload[len(XMP_SIGNATURE):]
+
+def parse_packet (packet, ns):
+  """Parses the XMP packet (bytes) and returns a dict of all simple
+  properties in the namespace ns."""
+
+  try:
+    root = ET.fromstring(packet.rstrip(b"\x00 \t\r\n"))
+  except ET.ParseError as e:
+    raise UnsupportedXmp(f"invalid XMP packet: {e}")
+
+  prefix = "{" + ns + "}"
+  res = {}
+  for desc in root.iter(f"{{{RDF_NS}}}Description"):
+    for key, val in desc.attrib.items():
+      if key.startswith(prefix):
+        res[key[len(prefix):]] = val
+    for child in desc:
+      if not child.tag.startswith(prefix):
+        continue
+      if len(child) > 0 or f"{{{RDF_NS}}}resource" in child.attrib:
+        raise UnsupportedXmp(f"non-simple property {child.tag}")
+      res[child.tag[len(prefix):]] = child.text or ""
+
+  return res
+
+def read_properties (filename, ns):
+  """Reads the XMP properties in namespace ns from the given file, which
+  may be a JPEG image or an XMP sidecar.  Only the file header is read up
+  to the XMP packet, and the image itself is never decoded.  Returns a dict
+  of the properties, or None if the file cannot be handled here (in which
+  case exempi should be used instead)."""
+
+  try:
+    with open(filename, "rb") as f:
+      if str(filename).lower().endswith(".xmp"):
+        packet = f.read()
+      else:
+        packet = _read_jpeg_packet(f)
+    if packet is None:
+      return {}
+    return parse_packet(packet, ns)
+  except UnsupportedXmp:
+    return None
@@ -0,0 +1,159 @@
+#    recallery - image metadata indexing and search
+#    Copyright (C) 2025  Daniel Kraft <d@domob.eu>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from recallery import base
+from recallery.base import Module, Processor
+
+import concurrent.futures
+import contextlib
+import threading
+import unittest
+from unittest import mock
+
+class FakeImage:
+  """Stand-in for ImageFile that keeps the properties in memory and
+  records each metadata write together with the thread doing it."""
+
+  def __init__ (self, filename):
+    self.filename = filename
+    self.props = {}
+    self.writes = []
+    self._pending = None
+
+  def __enter__ (self):
+    return self
+
+  def __exit__ (self, *args):
+    pass
+
+  @contextlib.contextmanager
+  def metadata_session (self):
+    self._pending = {}
+    try:
+      yield self
+    finally:
+      pending, self._pending = self._pending, None
+      if pending:
+        self.props.update(pending)
+        self.writes.append((pending, threading.current_thread()))
+
+  def get_custom_property (self, nm):
+    return self.props.get(nm)
+
+  def set_custom_property (self, nm, val):
+    self._pending[nm] = val
+
+  def plan_renditions (self, sizes):
+    pass
+
+class FakeProcessor (Processor):
+
+  def __init__ (self):
+    super().__init__()
+    self.images = {}
+
+  def open_file (self, filename):
+    return self.images.setdefault(filename, FakeImage(filename))
+
+class ValueModule (Module):
+
+  def __init__ (self, name, value):
+    self._name = name
+    self.value = value
+
+  @property
+  def name (self):
+    return self._name
+
+  @property
+  def xmp_attribute (self):
+    return self._name
+
+  def process (self, img):
+    return self.value
+
+class BackgroundModule (ValueModule):
+  """Module whose values are computed in the background, with futures
+  completed by the test."""
+
+  def __init__ (self, name):
+    super().__init__(name, None)
+    self.future = concurrent.futures.Future()
+
+  def submit (self, img):
+    return self.future
+
+class DeferredTest (unittest.TestCase):
+
+  def setUp (self):
+    self.processor = FakeProcessor()
+    self.processor.add_module(ValueModule("sync", "a"))
+    self.first = BackgroundModule("first")
+    self.second = BackgroundModule("second")
+    self.processor.add_module(self.first)
+    self.processor.add_module(self.second)
+
+  def process (self, filename="a.jpg"):
+    with self.processor.open_file(filename) as img:
+      return img, self.processor.process(img, False)
+
+  def test_done_in_time (self):
+    threading.Timer(0.1, self.first.future.set_result, ["x"]).start()
+    threading.Timer(0.2, self.second.future.set_result, ["y"]).start()
+    img, deferred = self.process()
+
+    self.assertEqual(deferred, [])
+    self.assertEqual(len(img.writes), 1)
+    self.assertEqual(img.props, {"sync": "a", "first": "x", "second": "y"})
+
+  def test_deferred (self):
+    with mock.patch.object(base, "DEFERRED_WAIT", 0):
+      img, deferred = self.process()
+    self.assertEqual([m for m, _ in deferred], [self.first, self.second])
+    self.assertEqual(img.props, {"sync": "a"})
+
+    written = []
+    self.processor.complete_deferred(
+        img.filename, deferred, lambda fn, attrs: written.append((fn, attrs)))
+    self.first.future.set_result("x")
+    self.assertEqual(self.processor.deferred_count, 2)
+    self.second.future.set_result("y")
+    self.processor.wait_deferred()
+
+    # Both values are written in one update, from the writer thread.
+    self.assertEqual(len(img.writes), 2)
+    values, thread = img.writes[1]
+    self.assertEqual(values, {"first": "x", "second": "y"})
+    self.assertIsNot(thread, threading.current_thread())
+    self.assertEqual(written, [("a.jpg", ["first", "second"])])
+    self.assertEqual(self.processor.deferred_count, 0)
+    self.assertEqual(self.processor.deferred_errors, [])
+
+  def test_deferred_error (self):
+    with mock.patch.object(base, "DEFERRED_WAIT", 0):
+      img, deferred = self.process()
+    self.processor.complete_deferred(img.filename, deferred)
+    error = RuntimeError("failed")
+    self.first.future.set_exception(error)
+    self.second.future.set_result("y")
+    self.processor.wait_deferred()
+
+    self.assertEqual(img.props, {"sync": "a", "second": "y"})
+    self.assertEqual(self.processor.deferred_errors,
+                     [("a.jpg", "first", error)])
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,47 @@
+#    recallery - image metadata indexing and search
+#    Copyright (C) 2025  Daniel Kraft <d@domob.eu>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from recallery.caption import Captioning
+
+import types
+import unittest
+
+class CacheKeyTest (unittest.TestCase):
+
+  def captioning (self, hosts, model="model", max_pixels=1_000_000):
+    res = Captioning(hosts, model, max_pixels)
+    self.addCleanup(res.client.close)
+    return res
+
+  def test_cache_key (self):
+    img = types.SimpleNamespace(user_comment=None)
+    key = self.captioning(["http://a:11434"]).cache_key(img)
+
+    # The endpoints do not matter, as long as the model is the same.
+    self.assertEqual(
+        self.captioning(["http://b:11434", "http://c:11434"]).cache_key(img),
+        key)
+
+    self.assertNotEqual(self.captioning(["http://a:11434"],
+                                        model="other").cache_key(img), key)
+    self.assertNotEqual(self.captioning(["http://a:11434"],
+                                        max_pixels=None).cache_key(img), key)
+    commented = types.SimpleNamespace(user_comment="Holidays")
+    self.assertNotEqual(
+        self.captioning(["http://a:11434"]).cache_key(commented), key)
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,97 @@
+#    recallery - image metadata indexing and search
+#    Copyright (C) 2025  Daniel Kraft <d@domob.eu>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from recallery import cluster
+
+import unittest
+
+import numpy as np
+
+def _planted (rng, sizes, spread=0.02):
+  """Returns encodings of planted clusters with the given sizes around
+  random centres (which are far apart), followed by the same number of
+  isolated points.  Also returns the list of index sets of the clusters."""
+
+  parts = []
+  groups = []
+  start = 0
+  for size in sizes:
+    centre = rng.normal(0, 0.1, 128)
+    parts.append(centre + rng.normal(0, spread, (size, 128)))
+    groups.append(set(range(start, start + size)))
+    start += size
+  parts.append(rng.normal(0, 0.1, (len(sizes), 128)))
+  return np.vstack(parts), groups
+
+class ClusterTest (unittest.TestCase):
+
+  def test_recovers_planted_clusters (self):
+    rng = np.random.default_rng(11)
+    sizes = [40, 25, 12, 5, 3, 2]
+    encodings, groups = _planted(rng, sizes)
+    # Shuffle, so that the clusters are not contiguous in the input.
+    perm = rng.permutation(len(encodings))
+    inverse = np.argsort(perm)
+    encodings = encodings[perm]
+    groups = [{int(inverse[i]) for i in g} for g in groups]
+
+    res = cluster.cluster(encodings, radius=0.45, min_size=3)
+    self.assertEqual([set(c.tolist()) for c in res], groups[:5])
+    # Largest cluster first.
+    self.assertEqual([len(c) for c in res], sizes[:5])
+
+    res = cluster.cluster(encodings, radius=0.45, min_size=2)
+    self.assertEqual([set(c.tolist()) for c in res], groups)
+
+  def test_many_cells (self):
+    rng = np.random.default_rng(12)
+    encodings, groups = _planted(rng, [30] * 50)
+    res = cluster.cluster(encodings, radius=0.45, min_size=2)
+    self.assertEqual(sorted(sorted(c.tolist()) for c in res),
+                     sorted(sorted(g) for g in groups))
+
+  def test_radius (self):
+    rng = np.random.default_rng(13)
+    encodings, _ = _planted(rng, [10])
+    # All faces of the cluster are about 0.32 apart.
+    self.assertEqual(cluster.cluster(encodings, radius=0.1), [])
+    self.assertEqual(cluster.cluster(np.empty((0, 128)), radius=0.45), [])
+
+  def test_neighbour_index (self):
+    rng = np.random.default_rng(14)
+    data = rng.normal(0, 0.1, (500, 128))
+    data[100] = data[7] + 0.001
+    index = cluster.NeighbourIndex(data, probes=4)
+    self.assertEqual(sorted(np.concatenate(index.cells).tolist()),
+                     list(range(500)))
+
+    sources, targets = index.neighbours(0.05, k=5)
+    self.assertEqual(sorted(zip(sources.tolist(), targets.tolist())),
+                     [(7, 100), (100, 7)])
+
+  def test_representative (self):
+    encodings = np.zeros((4, 128))
+    encodings[0, 0] = 1.0
+    encodings[1, 0] = 0.4
+    encodings[2, 0] = 0.3
+    encodings[3, 0] = -0.1
+    members = np.array([0, 1, 2, 3])
+    # The mean is at 0.4.
+    self.assertEqual(cluster.representative(encodings, members), 1)
+    self.assertEqual(cluster.representative(encodings, members[1:]), 2)
+
+if __name__ == "__main__":
+  unittest.main()
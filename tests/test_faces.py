@@ -0,0 +1,344 @@
+#    recallery - image metadata indexing and search
+#    Copyright (C) 2025  Daniel Kraft <d@domob.eu>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import importlib.util
+import io
+import os.path
+import tempfile
+import types
+import unittest
+from unittest import mock
+
+import numpy as np
+from PIL import Image
+
+HAVE_FACE_RECOGNITION = importlib.util.find_spec("face_recognition") is not None
+if HAVE_FACE_RECOGNITION:
+  import face_recognition
+  from recallery import faces
+  from recallery.faces import FaceDetection, KnownFaces
+  from recallery.facestore import FaceStore
+  from recallery.image import ImageData
+
+TOLERANCE = 0.6
+DETECTOR = "hog:test"
+
+def _random_encodings (rng, n):
+  return rng.normal(0, 0.1, (n, 128))
+
+def _match_loop (persons, faces, tolerance):
+  """The original matching with one face_distance call per known face,
+  which the batched matching must reproduce exactly."""
+
+  matches = []
+  for encoding in faces:
+    best_name = None
+    best_distance = float("inf")
+    for name, known in persons:
+      distance = face_recognition.face_distance([known], encoding)[0]
+      if distance < best_distance:
+        best_distance = distance
+        best_name = name
+    if best_name is not None:
+      matches.append((best_name, best_distance))
+
+  matches.sort(key=lambda x: x[1])
+  seen = set()
+  names = []
+  for name, dist in matches:
+    if dist > tolerance:
+      break
+    if name not in seen:
+      names.append(name)
+      seen.add(name)
+  return names
+
+@unittest.skipUnless(HAVE_FACE_RECOGNITION, "face_recognition is not installed")
+class KnownFacesMatchTest (unittest.TestCase):
+
+  def known_faces (self, persons):
+    res = KnownFaces()
+    for name, encoding in persons:
+      res.add(name, encoding)
+    return res
+
+  def assertSameMatches (self, persons, faces, tolerance=TOLERANCE):
+    known = self.known_faces(persons)
+    self.assertEqual(known.match(faces, tolerance),
+                     _match_loop(persons, faces, tolerance))
+
+  def test_random (self):
+    rng = np.random.default_rng(42)
+    for _ in range(20):
+      known = _random_encodings(rng, 60)
+      persons = [(f"person {i % 15}", e) for i, e in enumerate(known)]
+      # Some faces are close to known ones, others are not.
+      close = known[rng.choice(len(known), 8)] + rng.normal(0, 0.03, (8, 128))
+      faces = np.vstack([close, _random_encodings(rng, 8)])
+      rng.shuffle(faces)
+      self.assertSameMatches(persons, faces)
+      self.assertSameMatches(persons, faces, tolerance=1.5)
+
+  def test_ties (self):
+    rng = np.random.default_rng(1)
+    a, b, c = _random_encodings(rng, 3)
+    # The same encoding is known for two persons, and two faces have the
+    # same distance to different persons.
+    persons = [("first", a), ("second", a), ("third", b), ("fourth", c)]
+    offset = np.zeros(128)
+    offset[0] = 0.1
+    faces = [a, b + offset, c - offset, a]
+    self.assertSameMatches(persons, faces)
+    self.assertSameMatches(persons, list(reversed(faces)))
+
+  def test_tolerance_edge (self):
+    rng = np.random.default_rng(7)
+    known = _random_encodings(rng, 10)
+    persons = [(f"person {i}", e) for i, e in enumerate(known)]
+    faces = known[:5] + rng.normal(0, 0.05, (5, 128))
+
+    for face in faces:
+      dists = face_recognition.face_distance(known, face)
+      edge = dists.min()
+      # A face exactly at the tolerance matches, and one just beyond not.
+      for tolerance in [edge, np.nextafter(edge, 0), np.nextafter(edge, 1)]:
+        self.assertSameMatches(persons, faces, tolerance)
+
+  def test_empty (self):
+    rng = np.random.default_rng(0)
+    persons = [("someone", _random_encodings(rng, 1)[0])]
+    self.assertSameMatches(persons, [])
+    self.assertSameMatches([], _random_encodings(rng, 3))
+
+@unittest.skipUnless(HAVE_FACE_RECOGNITION, "face_recognition is not installed")
+class FastDistancesTest (unittest.TestCase):
+
+  def test_same_matches (self):
+    rng = np.random.default_rng(3)
+    known = KnownFaces()
+    encodings = _random_encodings(rng, 200)
+    for i, e in enumerate(encodings):
+      known.add(f"person {i % 40}", e)
+    # Duplicate rows are ties, for which the first one is chosen.
+    known.add("duplicate", encodings[5])
+
+    faces = np.vstack([
+      encodings[rng.choice(len(encodings), 50)]
+          + rng.normal(0, 0.03, (50, 128)),
+      encodings[5:6],
+      _random_encodings(rng, 50),
+    ])
+    # The single-precision expansion of the squared distance loses most
+    # digits for (nearly) identical encodings, but not at the distances
+    # that matter for matching.
+    exact = known.distances(faces)
+    fast = known.fast_distances(faces)
+    np.testing.assert_allclose(fast, exact, rtol=1e-5, atol=1e-3)
+
+    labels, dists = known.best_matches(faces)
+    fast_labels, fast_dists = known.best_matches(faces, fast=True)
+    np.testing.assert_allclose(fast_dists, dists, rtol=1e-5, atol=1e-3)
+    # The best match may only differ where two known faces are closer
+    # together than the error of single precision.
+    second = np.partition(exact, 1, axis=1)[:, 1]
+    clear = second - dists > 1e-4
+    np.testing.assert_array_equal(fast_labels[clear], labels[clear])
+    self.assertEqual(known.names[labels[50]], "person 5")
+    self.assertEqual(known.names[fast_labels[50]], "person 5")
+
+@unittest.skipUnless(HAVE_FACE_RECOGNITION, "face_recognition is not installed")
+class RematchTest (unittest.TestCase):
+
+  def setUp (self):
+    self.tmp = tempfile.TemporaryDirectory()
+    self.store = FaceStore(self.tmp.name)
+    self.rng = np.random.default_rng(5)
+    self.alice, self.bob, self.carol = _random_encodings(self.rng, 3)
+    self.known = KnownFaces()
+    self.known.add("Alice", self.alice)
+    self.known.add("Bob", self.bob)
+
+  def tearDown (self):
+    self.store.close()
+    self.tmp.cleanup()
+
+  def put (self, content_hash, encodings, *paths):
+    locations = [(0, 10, 10, 0)] * len(encodings)
+    self.store.put(content_hash, DETECTOR, locations, encodings)
+    for p in paths:
+      self.store.link(p, content_hash)
+
+  def rematch (self, known, tolerance=TOLERANCE):
+    module = FaceDetection("hog", tolerance, known, self.store)
+    return {os.path.basename(path): val
+            for path, _, val in module.rematch()}
+
+  def noisy (self, encoding, scale):
+    return encoding + self.rng.normal(0, scale, 128)
+
+  def test_rematch (self):
+    self.put("both", [self.noisy(self.bob, 0.02), self.noisy(self.alice, 0.01)],
+             "a.jpg", "copy.jpg")
+    self.put("carol", [self.noisy(self.carol, 0.01)], "c.jpg")
+    self.put("none", [], "n.jpg")
+    self.put("unlinked", [self.alice])
+
+    self.assertEqual(self.rematch(self.known), {
+      "a.jpg": "Alice, Bob",
+      "copy.jpg": "Alice, Bob",
+      "c.jpg": None,
+      "n.jpg": None,
+    })
+
+    # New known faces are picked up without detecting anything.
+    self.known.add("Carol", self.carol)
+    self.assertEqual(self.rematch(self.known)["c.jpg"], "Carol")
+    self.assertEqual(self.rematch(KnownFaces())["a.jpg"], None)
+
+  def test_same_as_matching (self):
+    encodings = {}
+    for i in range(20):
+      faces = [self.noisy(e, 0.05) for e in (self.alice, self.bob, self.carol)]
+      self.put(f"hash {i}", faces, f"{i}.jpg")
+      encodings[f"{i}.jpg"] = self.store.get(f"hash {i}", DETECTOR)[1]
+
+    for tolerance in [0.5, 0.55, 0.6, 0.65]:
+      expected = {}
+      for name, faces in encodings.items():
+        names = self.known.match(faces, tolerance)
+        expected[name] = ", ".join(names) if names else None
+      self.assertEqual(self.rematch(self.known, tolerance), expected)
+
+  def test_tolerance_edge (self):
+    # A face exactly at the tolerance (with the single-precision encoding
+    # in the store) gets the same value from processing, from the store
+    # and from rematch.
+    for i in range(20):
+      face = self.noisy(self.alice, 0.05)
+      rounded = np.asarray(face, dtype=np.float32).astype(np.float64)
+      edge = self.known.distances([rounded])[0, 0]
+      for tolerance, expected in [(edge, "Alice"),
+                                  (np.nextafter(edge, 0), None)]:
+        path = os.path.join(self.tmp.name, f"{i}.jpg")
+        img = types.SimpleNamespace(
+            filename=path,
+            data=types.SimpleNamespace(pixel_hash=f"{i}:{tolerance}"))
+        module = FaceDetection("hog", tolerance, self.known, self.store)
+        with mock.patch.object(module, "_detect",
+                               return_value=([(0, 10, 10, 0)], [face])):
+          self.assertEqual(module.process(img), expected)
+        self.assertEqual(module.process(img), expected)
+        self.assertEqual(self.rematch(self.known, tolerance)[f"{i}.jpg"],
+                         expected)
+
+
+def _find_squares (pixels, model="hog"):
+  """Stand-in for face_recognition.face_locations that finds bright
+  squares of at least 20 pixels, which are only reported if they lie
+  completely inside the image (like a face that is cut off at a tile
+  border would not be found)."""
+
+  mask = pixels[..., 0] > 128
+  res = []
+  rows = np.flatnonzero(mask.any(axis=1))
+  if len(rows) == 0:
+    return res
+  breaks = np.flatnonzero(np.diff(rows) > 1)
+  for top, bottom in zip(np.r_[rows[0], rows[breaks + 1]],
+                         np.r_[rows[breaks], rows[-1]] + 1):
+    cols = np.flatnonzero(mask[top:bottom].any(axis=0))
+    left, right = cols[0], cols[-1] + 1
+    if bottom - top < 20 or right - left < 20:
+      continue
+    if top == 0 or left == 0:
+      continue
+    if bottom == pixels.shape[0] or right == pixels.shape[1]:
+      continue
+    res.append((int(top), int(right), int(bottom), int(left)))
+  return res
+
+def _encode_crops (pixels, locations):
+  """Stand-in for face_recognition.face_encodings that encodes the size
+  of each face box and of the image it is cut from."""
+  return [np.array([b - t, r - l] + [0] * 126, dtype=np.float64)
+          for t, r, b, l in locations]
+
+@unittest.skipUnless(HAVE_FACE_RECOGNITION, "face_recognition is not installed")
+class TiledDetectionTest (unittest.TestCase):
+
+  def setUp (self):
+    for name, fcn in [("face_locations", _find_squares),
+                      ("face_encodings", _encode_crops)]:
+      patcher = mock.patch.object(face_recognition, name, side_effect=fcn)
+      patcher.start()
+      self.addCleanup(patcher.stop)
+
+  def image (self, size, boxes):
+    img = Image.new("RGB", size)
+    for left, top, right, bottom in boxes:
+      img.paste((255, 255, 255), (left, top, right, bottom))
+    out = io.BytesIO()
+    img.save(out, format="PNG")
+    return ImageData(out.getvalue())
+
+  def detect (self, data, tile_size=1024):
+    return faces.detectFacesTiled(data, "hog", tile_size, 16_000_000,
+                                  128 * 1024 * 1024)
+
+  def test_face_on_tile_boundary (self):
+    # Tiles of 1024 pixels overlap by 256, so this face is completely
+    # inside four tiles and cut off at the border of others.  It is too
+    # small to be found in the 2 MP rendition.
+    box = (900, 800, 940, 840)
+    data = self.image((4000, 3000), [box])
+    locations, encodings = self.detect(data)
+
+    self.assertEqual(len(locations), 1)
+    top, right, bottom, left = locations[0]
+    for actual, expected in zip((left, top, right, bottom), box):
+      self.assertAlmostEqual(actual, expected, delta=1)
+    self.assertEqual(len(encodings), 1)
+    self.assertEqual(encodings[0][0], 40)
+
+  def test_large_and_small_faces (self):
+    # The large face is found in the rendition and in tiles, the small
+    # one only in tiles.
+    boxes = [(2000, 1000, 2600, 1600), (3500, 2500, 3540, 2540)]
+    data = self.image((4000, 3000), boxes)
+    locations, _ = self.detect(data)
+    self.assertEqual(len(locations), 2)
+    found = sorted((l, t) for t, r, b, l in locations)
+    for (left, top), box in zip(found, sorted(boxes)):
+      self.assertAlmostEqual(left, box[0], delta=3)
+      self.assertAlmostEqual(top, box[1], delta=3)
+
+  def test_small_image (self):
+    # Images below the rendition size are not tiled.
+    data = self.image((800, 600), [(100, 100, 140, 140)])
+    locations, _ = self.detect(data, tile_size=256)
+    self.assertEqual(locations, [(100, 140, 140, 100)])
+    self.assertEqual(face_recognition.face_locations.call_count, 1)
+
+  def test_tiles (self):
+    tiles = faces._tiles(2500, 1000, 1024)
+    self.assertEqual(sorted({t[0] for t in tiles}), [0, 768, 1476])
+    self.assertEqual({t[1] for t in tiles}, {0})
+    self.assertTrue(all(r - l <= 1024 and b - t <= 1024
+                        for l, t, r, b in tiles))
+    self.assertEqual(max(t[2] for t in tiles), 2500)
+
+if __name__ == "__main__":
+  unittest.main()
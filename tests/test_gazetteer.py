@@ -0,0 +1,127 @@
+#    recallery - image metadata indexing and search
+#    Copyright (C) 2025  Daniel Kraft <d@domob.eu>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from recallery import gazetteer
+from recallery.gazetteer import Gazetteer, build_index
+
+import csv
+import os.path
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+
+class GazetteerTest (unittest.TestCase):
+
+  def setUp (self):
+    self.tmp = tempfile.TemporaryDirectory()
+    self.addCleanup(self.tmp.cleanup)
+
+  def build (self, places):
+    source = os.path.join(self.tmp.name, "places.csv")
+    with open(source, "w", newline="", encoding="utf-8") as f:
+      w = csv.writer(f)
+      w.writerow(["lat", "lon", "name"])
+      for lat, lon, name in places:
+        w.writerow([lat, lon, name])
+    outdir = os.path.join(self.tmp.name, "index")
+    self.assertEqual(build_index(source, outdir, "csv"), len(places))
+    return outdir
+
+  def brute_force (self, places, lat, lon):
+    lats = np.array([p[0] for p in places], dtype=np.float32)
+    lons = np.array([p[1] for p in places], dtype=np.float32)
+    dist = gazetteer._haversine(lat, lon, lats.astype(np.float64),
+                                lons.astype(np.float64))
+    i = int(np.argmin(dist))
+    return places[i][2], float(dist[i])
+
+  def random_places (self, rnd, n):
+    return [(float(rnd.uniform(-90, 90)), float(rnd.uniform(-180, 180)),
+             f"place {i}") for i in range(n)]
+
+  def test_nearest (self):
+    rnd = np.random.default_rng(42)
+    places = self.random_places(rnd, 2000)
+    g = Gazetteer(self.build(places), max_distance=None)
+    self.assertEqual(len(g), len(places))
+    queries = [(float(rnd.uniform(-90, 90)), float(rnd.uniform(-180, 180)))
+               for _ in range(200)]
+    queries.extend([(89.99, 0), (-89.99, 179.99), (0, -180), (0, 179.99)])
+    for lat, lon in queries:
+      label, dist = g.nearest((lat, lon))
+      expected_label, expected = self.brute_force(places, lat, lon)
+      self.assertAlmostEqual(dist, expected, places=6)
+      if label != expected_label:
+        self.assertAlmostEqual(
+            self.brute_force([p for p in places if p[2] == label],
+                             lat, lon)[1], expected, places=6)
+
+  def test_max_distance (self):
+    outdir = self.build([(48.0, 11.0, "Munich"), (0.0, 0.0, "Null Island")])
+    g = Gazetteer(outdir, max_distance=20)
+    label, dist = g.nearest((48.1, 11.0))
+    self.assertEqual(label, "Munich")
+    self.assertAlmostEqual(dist, 11.1, places=1)
+    self.assertIsNone(g.nearest((48.5, 11.0)))
+    self.assertIsNone(g.nearest((-60.0, 100.0)))
+
+  def test_default_max_distance (self):
+    g = Gazetteer(self.build([(48.0, 11.0, "Munich")]))
+    self.assertEqual(g.max_distance, gazetteer.DEFAULT_MAX_DISTANCE)
+    self.assertIsNone(g.nearest((10.0, -50.0)))
+
+  def test_scan_chunks (self):
+    rnd = np.random.default_rng(7)
+    places = self.random_places(rnd, 500)
+    outdir = self.build(places)
+    queries = [(89.95, 10.0), (-89.95, -120.0), (0.0, 0.0)]
+    for max_distance in [None, 500, 5000]:
+      g = Gazetteer(outdir, max_distance=max_distance)
+      for lat, lon in queries:
+        expected = g._scan(lat, lon)
+        with mock.patch.object(gazetteer, "SCAN_CHUNK", 7):
+          self.assertEqual(g._scan(lat, lon), expected)
+        if max_distance is None:
+          self.assertAlmostEqual(expected[1],
+                                 self.brute_force(places, lat, lon)[1],
+                                 places=6)
+
+  def test_scan_band (self):
+    # Far from all places and close to the pole, the rings do not find
+    # anything and only the band of rows within max_distance is scanned.
+    places = [(89.0, 0.0, "north"), (-89.0, 0.0, "south")]
+    places.extend((0.0, float(lon), f"equator {lon}")
+                  for lon in range(-180, 180))
+    g = Gazetteer(self.build(places), max_distance=200)
+    scanned = []
+    haversine = gazetteer._haversine
+    def record(lat, lon, lats, lons):
+      scanned.append(len(lats))
+      return haversine(lat, lon, lats, lons)
+    with mock.patch.object(gazetteer, "_haversine", side_effect=record):
+      label, _ = g.nearest((89.9, 90.0))
+    self.assertEqual(label, "north")
+    self.assertLessEqual(sum(scanned), 10)
+
+  def test_empty (self):
+    g = Gazetteer(self.build([]), max_distance=None)
+    self.assertEqual(len(g), 0)
+    self.assertIsNone(g.nearest((48.0, 11.0)))
+
+if __name__ == "__main__":
+  unittest.main()
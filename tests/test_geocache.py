@@ -0,0 +1,104 @@
+#    recallery - image metadata indexing and search
+#    Copyright (C) 2025  Daniel Kraft <d@domob.eu>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from recallery.geocache import GeoCache
+
+import os.path
+import tempfile
+import unittest
+from unittest import mock
+
+class GeoCacheTest (unittest.TestCase):
+
+  def setUp (self):
+    self.tmp = tempfile.TemporaryDirectory()
+    self.now = 1_000_000.0
+    patcher = mock.patch("recallery.geocache.time.time",
+                         side_effect=lambda: self.now)
+    patcher.start()
+    self.addCleanup(patcher.stop)
+    self.caches = []
+
+  def tearDown (self):
+    for c in self.caches:
+      c.close()
+    self.tmp.cleanup()
+
+  def cache (self, **kwargs):
+    res = GeoCache(os.path.join(self.tmp.name, "geo.sqlite"), **kwargs)
+    self.caches.append(res)
+    return res
+
+  def test_lookup (self):
+    c = self.cache()
+    self.assertEqual(c.get((48.1, 11.5)), (False, None))
+    c.put((48.1, 11.5), "Munich")
+    c.put((0.0, -30.0), None)
+
+    # Coordinates are quantised, so close points share the entry.
+    self.assertEqual(c.get((48.10002, 11.49998)), (True, "Munich"))
+    self.assertEqual(c.get((48.1002, 11.5)), (False, None))
+    # "No address" is cached as well.
+    self.assertEqual(c.get((0.0, -30.0)), (True, None))
+    self.assertEqual((c.hits, c.misses), (2, 2))
+
+  def test_persistent (self):
+    c = self.cache()
+    c.put((48.1, 11.5), "Munich")
+    c.close()
+    self.assertEqual(self.cache().get((48.1, 11.5)), (True, "Munich"))
+
+  def test_precision (self):
+    self.cache(precision=2).put((48.1, 11.5), "Munich")
+    c = self.cache(precision=3)
+    self.assertEqual(c.get((48.1, 11.5)), (False, None))
+
+  def test_ttl (self):
+    c = self.cache(ttl=100)
+    c.put((1.0, 1.0), "old")
+    self.now += 60
+    c.put((2.0, 2.0), "new")
+
+    self.now += 50
+    # Using an entry does not extend its lifetime.
+    self.assertEqual(c.get((1.0, 1.0)), (False, None))
+    self.assertEqual(c.get((2.0, 2.0)), (True, "new"))
+
+    # Expired entries are removed when the cache is opened, so that they
+    # are gone also when looked up with a longer ttl.
+    c.close()
+    self.cache(ttl=100).close()
+    c = self.cache(ttl=1000)
+    self.assertEqual(c.get((2.0, 2.0)), (True, "new"))
+    self.assertEqual(c.get((1.0, 1.0)), (False, None))
+
+  def test_lru_eviction (self):
+    c = self.cache(max_entries=3)
+    for i in range(3):
+      c.put((i, 0.0), f"place {i}")
+      self.now += 1
+
+    # Using the oldest entry makes the second one least recently used.
+    self.assertEqual(c.get((0, 0.0)), (True, "place 0"))
+    self.now += 1
+    c.put((3, 0.0), "place 3")
+
+    self.assertEqual(c.get((1, 0.0)), (False, None))
+    for i in [0, 2, 3]:
+      self.assertEqual(c.get((i, 0.0)), (True, f"place {i}"))
+
+if __name__ == "__main__":
+  unittest.main()
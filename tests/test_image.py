@@ -0,0 +1,178 @@
+#    recallery - image metadata indexing and search
+#    Copyright (C) 2025  Daniel Kraft <d@domob.eu>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from recallery.image import XMP_NS, ImageData, ImageFile
+
+import importlib.util
+import io
+import os
+import stat
+import tempfile
+import unittest
+from unittest import mock
+
+from PIL import Image
+
+def _encode (size, fmt="JPEG"):
+  out = io.BytesIO()
+  Image.new("RGB", size, (10, 200, 30)).save(out, format=fmt)
+  return out.getvalue()
+
+class RenditionTest (unittest.TestCase):
+
+  def count_opens (self, fcn):
+    """Calls fcn and returns the number of times an image is opened
+    by PIL meanwhile."""
+    with mock.patch("PIL.Image.open", side_effect=Image.open) as opened:
+      fcn()
+    return opened.call_count
+
+  def test_sizes (self):
+    data = ImageData(_encode((4000, 3000)))
+    self.assertEqual(data.size, (4000, 3000))
+    img = data.rendition(1_000_000)
+    self.assertLessEqual(img.width * img.height, 1_000_000)
+    self.assertAlmostEqual(img.width / img.height, 4 / 3, places=2)
+    self.assertIs(data.rendition(1_000_000), img)
+
+    # Small images are not scaled.
+    self.assertEqual(data.rendition(20_000_000).size, (4000, 3000))
+
+  def test_rendition_jpeg (self):
+    raw = _encode((800, 600))
+    self.assertIs(ImageData(raw).rendition_jpeg(1_000_000), raw)
+
+    png = ImageData(_encode((800, 600), "PNG"))
+    with Image.open(io.BytesIO(png.rendition_jpeg(1_000_000))) as img:
+      self.assertEqual((img.format, img.size), ("JPEG", (800, 600)))
+
+    large = ImageData(_encode((4000, 3000)))
+    with Image.open(io.BytesIO(large.rendition_jpeg(1_000_000))) as img:
+      self.assertLessEqual(img.width * img.height, 1_000_000)
+
+  def test_planned_renditions (self):
+    raw = _encode((4000, 3000))
+
+    def both (data):
+      data.size
+      return self.count_opens(lambda: [data.rendition(1_000_000),
+                                       data.rendition(2_000_000)])
+
+    # Without a plan, each rendition is decoded from the file.
+    self.assertEqual(both(ImageData(raw)), 2)
+
+    # With the larger one planned, the smaller is scaled from it.
+    data = ImageData(raw)
+    data.plan_renditions([1_000_000, 2_000_000])
+    self.assertEqual(both(data), 1)
+    self.assertIsNone(data._decoded)
+
+    # If the full resolution is needed anyway, it is decoded once.
+    data = ImageData(raw)
+    data.plan_renditions([None, 1_000_000, 2_000_000])
+    self.assertEqual(both(data), 1)
+    self.assertEqual(data.decoded.size, (4000, 3000))
+
+def _sidecar (props, other=""):
+  """Returns an XMP sidecar with the given recallery properties, and other
+  (XML attributes) added to the description."""
+  attrs = " ".join(f'recallery:{nm}="{val}"' for nm, val in props.items())
+  return (
+    '<?xpacket begin="" id="W5M0MpCehiHzreSzNTczkc9d"?>'
+    '<x:xmpmeta xmlns:x="adobe:ns:meta/">'
+    '<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">'
+    f'<rdf:Description rdf:about="" xmlns:recallery="{XMP_NS}"'
+    f' xmlns:ed="http://example.com/editor/" {attrs} {other}/>'
+    '</rdf:RDF></x:xmpmeta><?xpacket end="w"?>'
+  )
+
+class SidecarTest (unittest.TestCase):
+
+  def setUp (self):
+    self.tmp = tempfile.TemporaryDirectory()
+    self.addCleanup(self.tmp.cleanup)
+    self.image = os.path.join(self.tmp.name, "a.jpg")
+    self.raw = _encode((64, 48))
+    with open(self.image, "wb") as f:
+      f.write(self.raw)
+    self.sidecar = self.image + ".xmp"
+
+  def write_sidecar (self, content):
+    with open(self.sidecar, "w", encoding="utf-8") as f:
+      f.write(content)
+
+  def set_properties (self, props):
+    with ImageFile(self.image, sidecar=True) as img:
+      with img.metadata_session():
+        for nm, val in props.items():
+          img.set_custom_property(nm, val)
+
+  def get_property (self, nm):
+    with ImageFile(self.image, sidecar=True) as img:
+      return img.get_custom_property(nm)
+
+  def test_read (self):
+    self.write_sidecar(_sidecar({"AICaption": "A cat", "RevgeoLocation": ""}))
+    with ImageFile(self.image, sidecar=True) as img:
+      self.assertEqual(img.sidecar_filename, self.sidecar)
+      self.assertEqual(img.get_custom_property("AICaption"), "A cat")
+      # Empty values mark properties that were processed without result.
+      self.assertIsNone(img.get_custom_property("RevgeoLocation"))
+      self.assertIsNone(img.get_custom_property("DetectedPersons"))
+
+  def test_no_sidecar_for_cleared (self):
+    self.set_properties({"AICaption": None})
+    self.assertEqual(os.listdir(self.tmp.name), ["a.jpg"])
+
+  @unittest.skipIf(importlib.util.find_spec("libxmp") is None,
+                   "libxmp is not available")
+  def test_write (self):
+    self.write_sidecar(_sidecar({"AICaption": "old"}, 'ed:Rating="5"'))
+    os.chmod(self.sidecar, 0o640)
+    # A temporary file of some other writer is left alone.
+    other = self.sidecar + ".tmp"
+    with open(other, "w") as f:
+      f.write("other")
+
+    self.set_properties({"AICaption": "A cat", "RevgeoLocation": None})
+    self.assertEqual(self.get_property("AICaption"), "A cat")
+    self.assertIsNone(self.get_property("RevgeoLocation"))
+
+    # The image is untouched, and only the sidecar was replaced.
+    with open(self.image, "rb") as f:
+      self.assertEqual(f.read(), self.raw)
+    self.assertEqual(sorted(os.listdir(self.tmp.name)),
+                     ["a.jpg", "a.jpg.xmp", "a.jpg.xmp.tmp"])
+    with open(other) as f:
+      self.assertEqual(f.read(), "other")
+
+    # Other data in the sidecar and its permissions are preserved.
+    with open(self.sidecar, encoding="utf-8") as f:
+      self.assertIn("http://example.com/editor/", f.read())
+    self.assertEqual(stat.S_IMODE(os.stat(self.sidecar).st_mode), 0o640)
+
+  @unittest.skipIf(importlib.util.find_spec("libxmp") is None,
+                   "libxmp is not available")
+  def test_failed_write (self):
+    self.write_sidecar(_sidecar({"AICaption": "old"}))
+    with mock.patch("recallery.image.os.replace", side_effect=OSError):
+      with self.assertRaises(OSError):
+        self.set_properties({"AICaption": "A cat"})
+    self.assertEqual(sorted(os.listdir(self.tmp.name)), ["a.jpg", "a.jpg.xmp"])
+    self.assertEqual(self.get_property("AICaption"), "old")
+
+if __name__ == "__main__":
+  unittest.main()
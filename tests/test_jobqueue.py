@@ -0,0 +1,157 @@
+#    recallery - image metadata indexing and search
+#    Copyright (C) 2025  Daniel Kraft <d@domob.eu>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from recallery.jobqueue import JobQueue
+
+import os.path
+import tempfile
+import unittest
+from unittest import mock
+
+LEASE = 60
+
+class JobQueueTest (unittest.TestCase):
+
+  def setUp (self):
+    self.tmp = tempfile.TemporaryDirectory()
+    self.now = 1_000_000.0
+    patcher = mock.patch("recallery.jobqueue.time.time",
+                         side_effect=lambda: self.now)
+    patcher.start()
+    self.addCleanup(patcher.stop)
+    self.queues = []
+
+  def tearDown (self):
+    for q in self.queues:
+      q.close()
+    self.tmp.cleanup()
+
+  def queue (self, **kwargs):
+    res = JobQueue(os.path.join(self.tmp.name, "queue.sqlite"), **kwargs)
+    self.queues.append(res)
+    return res
+
+  def path (self, name):
+    return os.path.join(self.tmp.name, name)
+
+  def test_enqueue (self):
+    q = self.queue()
+    self.assertEqual(q.enqueue([self.path("a"), self.path("b")]), 2)
+    self.assertEqual(q.enqueue([self.path("a")]), 0)
+    self.assertEqual(q.counts(), {"pending": 2})
+
+  def test_modules_done (self):
+    q = self.queue()
+    q.enqueue([self.path("a"), self.path("b")])
+
+    self.assertEqual(q.claim("w1", 1, LEASE, ["x", "y"]), [self.path("a")])
+    self.assertEqual(q.claim("w2", 10, LEASE, ["x", "y"]), [self.path("b")])
+    self.assertEqual(q.claim("w3", 10, LEASE, ["x", "y"]), [])
+
+    self.assertFalse(q.module_done("w2", self.path("a"), ["x", "y"]))
+    self.assertFalse(q.module_done("w1", self.path("a"), ["x"]))
+    self.assertTrue(q.module_done("w1", self.path("a"), ["y"]))
+    self.assertEqual(q.counts(), {"done": 1, "running": 1})
+
+  def test_lease_expiry (self):
+    q = self.queue()
+    q.enqueue([self.path("a")])
+    self.assertEqual(q.claim("w1", 10, LEASE, ["x"]), [self.path("a")])
+
+    self.now += LEASE - 1
+    self.assertEqual(q.claim("w2", 10, LEASE, ["x"]), [])
+    self.now += 2
+    self.assertEqual(q.claim("w2", 10, LEASE, ["x"]), [self.path("a")])
+
+    # The previous owner has lost the job.
+    self.assertFalse(q.module_done("w1", self.path("a"), ["x"]))
+    q.fail("w1", self.path("a"), "error")
+    self.assertEqual(q.counts(), {"running": 1})
+    self.assertTrue(q.module_done("w2", self.path("a"), ["x"]))
+
+  def test_renew (self):
+    q = self.queue()
+    q.enqueue([self.path("a")])
+    q.claim("w1", 10, LEASE, ["x"])
+
+    self.now += LEASE - 1
+    q.renew("w1", [self.path("a")], LEASE)
+    q.renew("w2", [self.path("a")], 10 * LEASE)
+    self.now += LEASE - 1
+    self.assertEqual(q.claim("w2", 10, LEASE, ["x"]), [])
+    self.now += 2
+    self.assertEqual(q.claim("w2", 10, LEASE, ["x"]), [self.path("a")])
+
+  def test_fail_and_retry (self):
+    q = self.queue(max_attempts=2)
+    q.enqueue([self.path("a")])
+
+    q.claim("w1", 10, LEASE, ["x"])
+    q.fail("w1", self.path("a"), "first")
+    self.assertEqual(q.counts(), {"pending": 1})
+    self.assertEqual(q.failures(), [])
+
+    self.assertEqual(q.claim("w2", 10, LEASE, ["x"]), [self.path("a")])
+    q.fail("w2", self.path("a"), "second")
+    self.assertEqual(q.counts(), {"failed": 1})
+    self.assertEqual(q.failures(), [(self.path("a"), "second")])
+    self.assertEqual(q.claim("w3", 10, LEASE, ["x"]), [])
+
+  def test_lease_expires_too_often (self):
+    q = self.queue(max_attempts=2)
+    q.enqueue([self.path("a")])
+
+    for owner in ["w1", "w2"]:
+      self.assertEqual(q.claim(owner, 10, LEASE, ["x"]), [self.path("a")])
+      self.now += LEASE + 1
+
+    self.assertEqual(q.claim("w3", 10, LEASE, ["x"]), [])
+    self.assertEqual(q.failures(), [(self.path("a"), "lease expired")])
+
+  def test_release (self):
+    q = self.queue(max_attempts=1)
+    q.enqueue([self.path("a")])
+
+    q.claim("w1", 10, LEASE, ["x"])
+    q.release("w2", [self.path("a")])
+    self.assertEqual(q.counts(), {"running": 1})
+    q.release("w1", [self.path("a")])
+    self.assertEqual(q.counts(), {"pending": 1})
+
+    # The released claim did not count as attempt.
+    self.assertEqual(q.claim("w1", 10, LEASE, ["x"]), [self.path("a")])
+
+  def test_reset (self):
+    q = self.queue(max_attempts=1)
+    q.enqueue([self.path("a"), self.path("b"), self.path("c")])
+
+    q.claim("w1", 3, LEASE, ["x", "y"])
+    q.module_done("w1", self.path("a"), ["x", "y"])
+    q.fail("w1", self.path("b"), "error")
+    self.assertEqual(q.counts(), {"done": 1, "failed": 1, "running": 1})
+
+    # Running jobs are not reset.
+    paths = [self.path("a"), self.path("b"), self.path("c")]
+    self.assertEqual(q.enqueue(paths, reset=True), 2)
+    self.assertEqual(q.counts(), {"pending": 2, "running": 1})
+
+    # The completed modules of the reset job are forgotten.
+    self.assertEqual(q.claim("w2", 10, LEASE, ["x", "y"]),
+                     [self.path("a"), self.path("b")])
+    self.assertFalse(q.module_done("w2", self.path("a"), ["x"]))
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,180 @@
+#    recallery - image metadata indexing and search
+#    Copyright (C) 2025  Daniel Kraft <d@domob.eu>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from recallery.ollamapool import EndpointPool
+
+import concurrent.futures
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import threading
+import time
+import unittest
+
+from ollama import ResponseError
+
+class StubOllama:
+  """Stand-in for an Ollama server that answers /api/chat with the given
+  HTTP status after a delay, and records the number of requests and the
+  maximum number of them running at the same time."""
+
+  def __init__ (self, status=200, delay=0.0):
+    self.status = status
+    self.delay = delay
+    self.requests = 0
+    self.running = 0
+    self.max_running = 0
+    lock = threading.Lock()
+    stub = self
+
+    class Handler (BaseHTTPRequestHandler):
+      def log_message (self, *args):
+        pass
+
+      def do_POST (self):
+        length = int(self.headers.get("Content-Length", 0))
+        self.rfile.read(length)
+        with lock:
+          stub.requests += 1
+          stub.running += 1
+          stub.max_running = max(stub.max_running, stub.running)
+        try:
+          time.sleep(stub.delay)
+        finally:
+          with lock:
+            stub.running -= 1
+
+        if stub.status == 200:
+          body = json.dumps({
+            "model": "test",
+            "created_at": "2025-01-01T00:00:00Z",
+            "message": {"role": "assistant", "content": stub.url},
+            "done": True,
+          })
+        else:
+          body = json.dumps({"error": "stub failure"})
+        body = body.encode("utf-8")
+        self.send_response(stub.status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    self._httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    self._httpd.daemon_threads = True
+    host, port = self._httpd.server_address
+    self.url = f"http://{host}:{port}"
+    self._thread = threading.Thread(target=self._httpd.serve_forever,
+                                    daemon=True)
+    self._thread.start()
+
+  def close (self):
+    self._httpd.shutdown()
+    self._httpd.server_close()
+
+def _chat (pool):
+  res = pool.chat(model="test",
+                  messages=[{"role": "user", "content": "hello"}])
+  return res["message"]["content"]
+
+class EndpointPoolTest (unittest.TestCase):
+
+  def setUp (self):
+    self.servers = []
+    self.pools = []
+
+  def tearDown (self):
+    for pool in self.pools:
+      pool.close()
+    for server in self.servers:
+      server.close()
+
+  def server (self, **kwargs):
+    res = StubOllama(**kwargs)
+    self.servers.append(res)
+    return res
+
+  def pool (self, servers, per_host=1):
+    res = EndpointPool([s.url for s in servers], per_host)
+    self.pools.append(res)
+    return res
+
+  def test_retries_on_other_endpoint (self):
+    bad = self.server(status=500)
+    good = self.server()
+    # The failing endpoint is first, so it is tried first.
+    pool = self.pool([bad, good])
+
+    self.assertEqual(_chat(pool), good.url)
+    self.assertEqual(bad.requests, 1)
+    self.assertEqual(good.requests, 1)
+
+  def test_failed_endpoint_is_avoided (self):
+    bad = self.server(status=500)
+    good = self.server()
+    pool = self.pool([bad, good])
+
+    for _ in range(5):
+      self.assertEqual(_chat(pool), good.url)
+    # Within the backoff, only the first request went to the bad one.
+    self.assertEqual(bad.requests, 1)
+    self.assertEqual(good.requests, 5)
+
+  def test_all_endpoints_failing (self):
+    servers = [self.server(status=500), self.server(status=500)]
+    pool = self.pool(servers)
+
+    with self.assertRaises(Exception):
+      _chat(pool)
+    self.assertEqual([s.requests for s in servers], [1, 1])
+
+  def test_unreachable_endpoint (self):
+    down = self.server()
+    down.close()
+    self.servers.remove(down)
+    good = self.server()
+    pool = self.pool([down, good])
+
+    self.assertEqual(_chat(pool), good.url)
+    self.assertEqual(good.requests, 1)
+
+  def test_client_error_is_not_retried (self):
+    bad = self.server(status=404)
+    good = self.server()
+    pool = self.pool([bad, good])
+
+    for _ in range(2):
+      with self.assertRaises(ResponseError) as ctx:
+        _chat(pool)
+      self.assertEqual(ctx.exception.status_code, 404)
+    # The endpoint is not avoided either.
+    self.assertEqual(bad.requests, 2)
+    self.assertEqual(good.requests, 0)
+
+  def test_slot_limit_per_host (self):
+    servers = [self.server(delay=0.2), self.server(delay=0.2)]
+    pool = self.pool(servers, per_host=2)
+
+    with concurrent.futures.ThreadPoolExecutor(12) as executor:
+      results = list(executor.map(lambda _: _chat(pool), range(12)))
+
+    self.assertEqual(len(results), 12)
+    for s in servers:
+      self.assertLessEqual(s.max_running, 2)
+      self.assertGreater(s.requests, 0)
+    self.assertEqual(sum(s.requests for s in servers), 12)
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,205 @@
+#    recallery - image metadata indexing and search
+#    Copyright (C) 2025  Daniel Kraft <d@domob.eu>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from recallery import preview
+
+from PIL import Image
+
+import io
+import os.path
+import struct
+import tempfile
+import unittest
+
+# Sizes of the fake EXIF thumbnail and full preview.  The full preview
+# is above MIN_PREVIEW_PIXELS and the thumbnail below it.
+THUMB_SIZE = (160, 120)
+FULL_SIZE = (1200, 900)
+
+GPS_LATITUDE_REF = 1
+GPS_LATITUDE = 2
+
+def _jpeg (size):
+  out = io.BytesIO()
+  Image.new("RGB", size, (200, 100, 50)).save(out, format="JPEG")
+  return out.getvalue()
+
+class TiffBuilder:
+  """Builds a little-endian TIFF structure.  Blobs and IFDs are appended
+  in order, so that referenced IFDs have to be added before the IFDs
+  pointing to them, and the first IFD is set at the end."""
+
+  def __init__ (self):
+    self.data = bytearray(b"II*\x00\x00\x00\x00\x00")
+
+  def blob (self, data):
+    res = len(self.data)
+    self.data += data
+    if len(self.data) % 2:
+      self.data += b"\x00"
+    return res
+
+  def ifd (self, entries):
+    """Adds an IFD with the given entries (tag, type, values) and returns
+    its offset.  Values are a list of ints for integer types, a list of
+    (num, denom) for rationals, and a str for ASCII."""
+
+    encoded = []
+    for tag, typ, values in sorted(entries):
+      if typ == 2:
+        raw = values.encode("ascii") + b"\x00"
+        count = len(raw)
+      elif typ == 5:
+        raw = b"".join(struct.pack("<II", *v) for v in values)
+        count = len(values)
+      else:
+        fmt = {3: "H", 4: "I", 7: "B"}[typ]
+        raw = struct.pack(f"<{len(values)}{fmt}", *values)
+        count = len(values)
+      encoded.append((tag, typ, count, raw))
+
+    # The out-of-line values are stored before the IFD itself.
+    for i, (tag, typ, count, raw) in enumerate(encoded):
+      if len(raw) > 4:
+        raw = struct.pack("<I", self.blob(raw))
+      encoded[i] = (tag, typ, count, raw.ljust(4, b"\x00"))
+
+    res = self.blob(b"")
+    self.data += struct.pack("<H", len(encoded))
+    for tag, typ, count, raw in encoded:
+      self.data += struct.pack("<HHI", tag, typ, count) + raw
+    self.data += struct.pack("<I", 0)
+    return res
+
+  def finish (self, first_ifd):
+    struct.pack_into("<I", self.data, 4, first_ifd)
+    return bytes(self.data)
+
+def _gps_ifd (tiff):
+  return tiff.ifd([
+    (GPS_LATITUDE_REF, 2, "N"),
+    (GPS_LATITUDE, 5, [(47, 1), (30, 1), (1530, 100)]),
+  ])
+
+EXPECTED_GPS = {GPS_LATITUDE_REF: "N", GPS_LATITUDE: (47.0, 30.0, 15.3)}
+
+class PreviewTest (unittest.TestCase):
+
+  def setUp (self):
+    self.tmp = tempfile.TemporaryDirectory()
+
+  def tearDown (self):
+    self.tmp.cleanup()
+
+  def write (self, name, data):
+    res = os.path.join(self.tmp.name, name)
+    with open(res, "wb") as f:
+      f.write(data)
+    return res
+
+  def assertPreviewSize (self, fn, size):
+    data = preview.extract_preview(fn)
+    self.assertIsNotNone(data)
+    with Image.open(io.BytesIO(data)) as img:
+      self.assertEqual(img.size, size)
+
+  def test_has_preview (self):
+    self.assertTrue(preview.has_preview("foo/bar.NEF"))
+    self.assertTrue(preview.has_preview("bar.heic"))
+    self.assertFalse(preview.has_preview("bar.jpg"))
+
+  def test_tiff_raw (self):
+    tiff = TiffBuilder()
+    thumb = _jpeg(THUMB_SIZE)
+    full = _jpeg(FULL_SIZE)
+    thumb_pos = tiff.blob(thumb)
+    full_pos = tiff.blob(full)
+    # The raw data is lossless JPEG, which has to be skipped even though
+    # it is larger.
+    raw = (b"\xff\xd8\xff\xc3\x00\x0b\x08\x10\x00\x20\x00\x01\x01\x11\x00"
+           b"\xff\xda\x00\x02" + b"\x00" * 64 + b"\xff\xd9")
+    raw_pos = tiff.blob(raw)
+    sub_full = tiff.ifd([(0x111, 4, [full_pos]), (0x117, 4, [len(full)])])
+    sub_raw = tiff.ifd([(0x111, 4, [raw_pos]), (0x117, 4, [len(raw)])])
+    gps = _gps_ifd(tiff)
+    ifd0 = tiff.ifd([
+      (0x14a, 4, [sub_full, sub_raw]),
+      (0x201, 4, [thumb_pos]),
+      (0x202, 4, [len(thumb)]),
+      (0x8825, 4, [gps]),
+    ])
+    fn = self.write("a.dng", tiff.finish(ifd0))
+
+    self.assertPreviewSize(fn, FULL_SIZE)
+    self.assertEqual(preview.read_gps(fn), EXPECTED_GPS)
+
+  def test_maker_note_preview (self):
+    # Only the thumbnail is referenced from the TIFF structure, while the
+    # full preview is somewhere else in the file (as in the maker notes).
+    tiff = TiffBuilder()
+    thumb = _jpeg(THUMB_SIZE)
+    thumb_pos = tiff.blob(thumb)
+    tiff.blob(b"\x00" * 16 + _jpeg(FULL_SIZE))
+    ifd0 = tiff.ifd([(0x201, 4, [thumb_pos]), (0x202, 4, [len(thumb)])])
+    fn = self.write("a.orf", tiff.finish(ifd0))
+
+    self.assertPreviewSize(fn, FULL_SIZE)
+    self.assertIsNone(preview.read_gps(fn))
+
+  def test_raf (self):
+    full = _jpeg(FULL_SIZE)
+    header = b"FUJIFILMCCD-RAW 0201FF383501".ljust(84, b"\x00")
+    header += struct.pack(">II", 160, len(full))
+    data = header.ljust(160, b"\x00") + full + b"\x00" * 100
+    fn = self.write("a.raf", data)
+
+    self.assertPreviewSize(fn, FULL_SIZE)
+
+  def test_cr3 (self):
+    gps = TiffBuilder()
+    cmt4 = gps.finish(_gps_ifd(gps))
+    data = (b"\x00\x00\x00\x18ftypcrx " + b"\x00" * 12
+            + b"\x00\x00\x00\x00CMT4" + cmt4
+            + b"\x00" * 32 + _jpeg(THUMB_SIZE)
+            + b"\x00" * 32 + _jpeg(FULL_SIZE) + b"\x00" * 32)
+    fn = self.write("a.cr3", data)
+
+    self.assertPreviewSize(fn, FULL_SIZE)
+    self.assertEqual(preview.read_gps(fn), EXPECTED_GPS)
+
+  def test_heif_gps (self):
+    tiff = TiffBuilder()
+    ifd0 = tiff.ifd([(0x8825, 4, [_gps_ifd(tiff)])])
+    data = (b"\x00\x00\x00\x18ftypheic" + b"\x00" * 12
+            + b"\x00\x00\x00\x06Exif\x00\x00" + tiff.finish(ifd0))
+    fn = self.write("a.heic", data)
+
+    self.assertEqual(preview.read_gps(fn), EXPECTED_GPS)
+
+  def test_empty_and_invalid (self):
+    cases = {
+      "empty.orf": b"",
+      "garbage.nef": b"II" + b"\xff" * 100,
+      "truncated.cr2": TiffBuilder().finish(1000),
+    }
+    for name, data in cases.items():
+      with self.subTest(name):
+        fn = self.write(name, data)
+        self.assertIsNone(preview.extract_preview(fn))
+        self.assertIsNone(preview.read_gps(fn))
+
+if __name__ == "__main__":
+  unittest.main()
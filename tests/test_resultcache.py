@@ -0,0 +1,90 @@
+#    recallery - image metadata indexing and search
+#    Copyright (C) 2025  Daniel Kraft <d@domob.eu>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from recallery.resultcache import ResultCache
+
+import os.path
+import tempfile
+import unittest
+from unittest import mock
+
+class ResultCacheTest (unittest.TestCase):
+
+  def setUp (self):
+    self.tmp = tempfile.TemporaryDirectory()
+    self.now = 1_000_000.0
+    patcher = mock.patch("recallery.resultcache.time.time",
+                         side_effect=self.clock)
+    patcher.start()
+    self.addCleanup(patcher.stop)
+    self.caches = []
+
+  def tearDown (self):
+    for c in self.caches:
+      c.close()
+    self.tmp.cleanup()
+
+  def clock (self):
+    self.now += 1
+    return self.now
+
+  def cache (self, **kwargs):
+    res = ResultCache(os.path.join(self.tmp.name, "cache.sqlite"), **kwargs)
+    self.caches.append(res)
+    return res
+
+  def test_get_put (self):
+    c = self.cache()
+    key = c.make_key("hash", "module")
+    self.assertNotEqual(key, c.make_key("hash", "other"))
+    self.assertNotEqual(key, c.make_key("other", "module"))
+
+    self.assertEqual(c.get(key), (False, None))
+    c.put(key, None)
+    self.assertEqual(c.get(key), (True, None))
+    c.put(key, "value")
+    self.assertEqual(c.get(key), (True, "value"))
+    self.assertEqual((c.hits, c.misses), (2, 1))
+
+  def test_eviction (self):
+    # Each entry has a key of one byte and a value of nine bytes.
+    c = self.cache(max_bytes=30)
+    for k in "abc":
+      c.put(k, k * 9)
+    c.get("a")
+    c.put("d", "d" * 9)
+
+    self.assertEqual(c.get("b"), (False, None))
+    for k in "acd":
+      self.assertEqual(c.get(k), (True, k * 9))
+
+    # Replacing an entry does not count its old size.
+    c.put("a", "A" * 9)
+    for k in "acd":
+      self.assertTrue(c.get(k)[0])
+
+  def test_shared_database (self):
+    # Two processes writing to the same cache keep the total size bounded.
+    first = self.cache(max_bytes=30)
+    second = self.cache(max_bytes=30)
+    for k in "abcdef":
+      (first if k in "ace" else second).put(k, k * 9)
+
+    found = [k for k in "abcdef" if first.get(k)[0]]
+    self.assertEqual(found, ["d", "e", "f"])
+
+if __name__ == "__main__":
+  unittest.main()
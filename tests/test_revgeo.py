@@ -0,0 +1,76 @@
+#    recallery - image metadata indexing and search
+#    Copyright (C) 2025  Daniel Kraft <d@domob.eu>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from recallery.revgeo import GeocodingQueue
+
+import unittest
+
+class FlakyGeocoder:
+  """Geocoder that fails for the first lookups."""
+
+  def __init__ (self, failures):
+    self.failures = failures
+    self.calls = 0
+
+  def lookup (self, coords):
+    self.calls += 1
+    if self.calls <= self.failures:
+      raise RuntimeError("server down")
+    return f"{coords[0]:.3f},{coords[1]:.3f}"
+
+class BrokenCache:
+
+  def get (self, coords):
+    return False, None
+
+  def put (self, coords, address):
+    raise RuntimeError("database is locked")
+
+class GeocodingQueueTest (unittest.TestCase):
+
+  def test_shared (self):
+    geocoder = FlakyGeocoder(0)
+    q = GeocodingQueue(geocoder, 0.1)
+    first = q.submit((48.0, 11.0)).result(timeout=5)
+    self.assertEqual(q.submit((48.0001, 11.0)).result(timeout=5), first)
+    self.assertEqual(geocoder.calls, 1)
+    self.assertEqual(q.shared, 1)
+
+  def test_failure_not_shared (self):
+    geocoder = FlakyGeocoder(1)
+    q = GeocodingQueue(geocoder, 0.1)
+    with self.assertRaises(RuntimeError):
+      q.submit((48.0, 11.0)).result(timeout=5)
+    self.assertEqual(len(q._finished), 0)
+    self.assertEqual(q._cells, {})
+
+    self.assertEqual(q.submit((48.0001, 11.0)).result(timeout=5),
+                     "48.000,11.000")
+    self.assertEqual(geocoder.calls, 2)
+    self.assertEqual(q.shared, 0)
+
+  def test_cache_failure (self):
+    q = GeocodingQueue(FlakyGeocoder(0), 0.1, BrokenCache())
+    with self.assertRaises(RuntimeError):
+      q.submit((48.0, 11.0)).result(timeout=5)
+    self.assertEqual(len(q._finished), 0)
+
+    # The background thread is still running.
+    with self.assertRaises(RuntimeError):
+      q.submit((48.0, 11.0)).result(timeout=5)
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,133 @@
+#    recallery - image metadata indexing and search
+#    Copyright (C) 2025  Daniel Kraft <d@domob.eu>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from recallery.scan import Manifest, iter_files
+
+import os
+import tempfile
+import unittest
+
+class ScanTest (unittest.TestCase):
+
+  def setUp (self):
+    self.tmp = tempfile.TemporaryDirectory()
+    self.manifests = []
+
+  def tearDown (self):
+    for m in self.manifests:
+      m.close()
+    self.tmp.cleanup()
+
+  def manifest (self, **kwargs):
+    res = Manifest(os.path.join(self.tmp.name, "manifest.sqlite"), **kwargs)
+    self.manifests.append(res)
+    return res
+
+  def write (self, name, data=b"image data"):
+    res = os.path.join(self.tmp.name, name)
+    os.makedirs(os.path.dirname(res), exist_ok=True)
+    with open(res, "wb") as f:
+      f.write(data)
+    return res
+
+  def touch (self, path):
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000_000))
+
+  def test_iter_files (self):
+    a = self.write("photos/b/a.JPG")
+    b = self.write("photos/a/b.png")
+    self.write("photos/a/notes.txt")
+    other = os.path.join(self.tmp.name, "other.txt")
+    self.assertEqual(list(iter_files([os.path.join(self.tmp.name, "photos"),
+                                      other])),
+                     [b, a, other])
+
+  def test_modules (self):
+    fn = self.write("a.jpg")
+    m = self.manifest()
+    self.assertFalse(m.is_current(fn, ["A"]))
+
+    m.record(fn, ["A", "B"])
+    self.assertTrue(m.is_current(fn, ["A"]))
+    self.assertTrue(m.is_current(fn, ["B", "A"]))
+    self.assertFalse(m.is_current(fn, ["A", "C"]))
+
+    m.remove(fn)
+    self.assertFalse(m.is_current(fn, ["A"]))
+
+  def test_changes (self):
+    fn = self.write("a.jpg")
+    m = self.manifest()
+    m.record(fn, ["A"])
+
+    self.touch(fn)
+    self.assertFalse(m.is_current(fn, ["A"]))
+
+    m.record(fn, ["A"])
+    self.write("a.jpg", b"other data")
+    self.assertFalse(m.is_current(fn, ["A"]))
+
+    os.remove(fn)
+    self.assertFalse(m.is_current(fn, ["A"]))
+
+  def test_hash_fallback (self):
+    fn = self.write("a.jpg")
+    m = self.manifest(use_hash=True)
+    m.record(fn, ["A"])
+
+    # A touched file with the same content is still current, and its
+    # new stat data is recorded (so that it is not hashed again).
+    self.touch(fn)
+    self.assertTrue(m.is_current(fn, ["A"]))
+    m.close()
+    self.assertTrue(self.manifest(use_hash=False).is_current(fn, ["A"]))
+
+    # Same size, but a different content.
+    self.write("a.jpg", b"IMAGE DATA")
+    self.assertFalse(self.manifest(use_hash=True).is_current(fn, ["A"]))
+
+  def test_sidecar (self):
+    fn = self.write("a.jpg")
+    m = self.manifest()
+    m.record(fn, ["A"])
+
+    sidecar = self.write("a.jpg.xmp", b"<xmp/>")
+    self.assertFalse(m.is_current(fn, ["A"]))
+    m.record(fn, ["A"])
+    self.assertTrue(m.is_current(fn, ["A"]))
+
+    self.touch(sidecar)
+    self.assertFalse(m.is_current(fn, ["A"]))
+    m.refresh(fn)
+    self.assertTrue(m.is_current(fn, ["A"]))
+
+    os.remove(sidecar)
+    self.assertFalse(m.is_current(fn, ["A"]))
+
+  def test_relative_paths (self):
+    fn = self.write("a.jpg")
+    m = self.manifest()
+    cwd = os.getcwd()
+    try:
+      os.chdir(self.tmp.name)
+      m.record("a.jpg", ["A"])
+    finally:
+      os.chdir(cwd)
+    self.assertTrue(m.is_current(fn, ["A"]))
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,96 @@
+#    recallery - image metadata indexing and search
+#    Copyright (C) 2025  Daniel Kraft <d@domob.eu>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from recallery.search import SearchIndex
+
+import os.path
+import tempfile
+import unittest
+
+class SearchIndexTest (unittest.TestCase):
+
+  def setUp (self):
+    self.tmp = tempfile.TemporaryDirectory()
+    self.index = SearchIndex(os.path.join(self.tmp.name, "index.sqlite"))
+
+  def tearDown (self):
+    self.index.close()
+    self.tmp.cleanup()
+
+  def path (self, name):
+    return os.path.join(self.tmp.name, name)
+
+  def add (self, name, caption=None, location=None, persons=None):
+    self.index.update(self.path(name), {
+      "AICaption": caption,
+      "RevgeoLocation": location,
+      "DetectedPersons": persons,
+    })
+
+  def test_search (self):
+    self.add("a.jpg", caption="A dog on the beach", location="Nice, France")
+    self.add("b.jpg", caption="A cat", persons="Alice, Bob")
+    self.add("c.jpg", caption="Dog and cat", location="Paris, France")
+
+    self.assertEqual(self.index.search("cat alice"), [self.path("b.jpg")])
+    self.assertEqual(sorted(self.index.search("DOG")),
+                     [self.path("a.jpg"), self.path("c.jpg")])
+    self.assertEqual(len(self.index.search("france", limit=1)), 1)
+    self.assertEqual(self.index.search("horse"), [])
+
+  def test_diacritics (self):
+    self.add("a.jpg", location="Zürich, Schweiz")
+    self.assertEqual(self.index.search("zurich"), [self.path("a.jpg")])
+    self.assertEqual(self.index.search("Zürich"), [self.path("a.jpg")])
+
+  def test_special_characters (self):
+    self.add("a.jpg", caption='A "quoted" sign: NOT for sale (near the'
+                              ' road) * AND OR')
+    self.add("b.jpg", caption="Something else")
+
+    # Query syntax of FTS5 is taken literally, and punctuation is ignored.
+    matching = ['quoted', '"quoted"', '"quoted', 'sign:', 'not', 'NOT sale',
+                'near(road)', 'NEAR(sign road)', 'road)*', '^sale', 'AND']
+    for query in matching:
+      with self.subTest(query):
+        self.assertEqual(self.index.search(query), [self.path("a.jpg")])
+
+    # All words must match, also if they look like operators.
+    for query in ["sale OR else", "AICaption:sale", "it's for sale"]:
+      with self.subTest(query):
+        self.assertEqual(self.index.search(query), [])
+
+    for query in ["", "   ", '"', "*", "()", "-"]:
+      with self.subTest(query):
+        self.assertEqual(self.index.search(query), [])
+
+  def test_update_and_remove (self):
+    self.add("a.jpg", caption="A dog")
+    self.add("a.jpg", caption="A cat")
+    self.assertEqual(self.index.search("dog"), [])
+    self.assertEqual(self.index.search("cat"), [self.path("a.jpg")])
+
+    # Clearing all properties removes the file.
+    self.add("a.jpg")
+    self.assertEqual(self.index.search("cat"), [])
+
+    self.add("b.jpg", caption="A cat")
+    self.index.remove(self.path("b.jpg"))
+    self.index.remove(self.path("missing.jpg"))
+    self.assertEqual(self.index.search("cat"), [])
+
+if __name__ == "__main__":
+  unittest.main()
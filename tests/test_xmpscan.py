@@ -0,0 +1,125 @@
+#    recallery - image metadata indexing and search
+#    Copyright (C) 2025  Daniel Kraft <d@domob.eu>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from recallery import xmpscan
+
+import os.path
+import struct
+import tempfile
+import unittest
+
+NS = "http://example.com/test/1.0/"
+
+def _packet (body):
+  """Wraps the rdf:Description attributes and children in body into
+  a full XMP packet."""
+
+  return (
+    '<?xpacket begin="" id="W5M0MpCehiHzreSzNTczkc9d"?>'
+    '<x:xmpmeta xmlns:x="adobe:ns:meta/">'
+    '<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">'
+    f'<rdf:Description rdf:about="" xmlns:t="{NS}" {body}</rdf:Description>'
+    '</rdf:RDF></x:xmpmeta><?xpacket end="w"?>'
+  ).encode("utf-8")
+
+def _segment (code, payload):
+  return bytes([0xff, code]) + struct.pack(">H", len(payload) + 2) + payload
+
+def _jpeg (*segments):
+  """Builds a JPEG file header with the given segments, followed by the
+  start of scan and some fake image data.  The scanner must stop at SOS,
+  so the image data does not matter."""
+
+  res = b"\xff\xd8" + b"".join(segments)
+  return res + _segment(0xda, b"\x00" * 10) + b"\x12\x34" * 100 + b"\xff\xd9"
+
+class ReadPropertiesTest (unittest.TestCase):
+
+  def setUp (self):
+    self.tmp = tempfile.TemporaryDirectory()
+
+  def tearDown (self):
+    self.tmp.cleanup()
+
+  def write (self, name, data):
+    res = os.path.join(self.tmp.name, name)
+    with open(res, "wb") as f:
+      f.write(data)
+    return res
+
+  def test_jpeg (self):
+    packet = _packet('t:foo="bar"><t:baz>qux</t:baz><x:other>1</x:other>')
+    fn = self.write("a.jpg", _jpeg(
+      _segment(0xe0, b"JFIF\x00" + b"\x00" * 9),
+      _segment(0xe1, b"Exif\x00\x00" + b"\x00" * 20),
+      _segment(0xe1, xmpscan.XMP_SIGNATURE + packet),
+    ))
+    self.assertEqual(xmpscan.read_properties(fn, NS),
+                     {"foo": "bar", "baz": "qux"})
+
+  def test_jpeg_fill_bytes_and_standalone_markers (self):
+    packet = _packet('t:foo="bar">')
+    data = b"\xff\xd8\xff\xff\xff\x01" + _segment(0xe1,
+        xmpscan.XMP_SIGNATURE + packet + b" " * 100)
+    data += _segment(0xda, b"") + b"\xff\xd9"
+    fn = self.write("a.jpg", data)
+    self.assertEqual(xmpscan.read_properties(fn, NS), {"foo": "bar"})
+
+  def test_jpeg_without_xmp (self):
+    fn = self.write("a.jpg", _jpeg(_segment(0xe0, b"JFIF\x00")))
+    self.assertEqual(xmpscan.read_properties(fn, NS), {})
+
+  def test_xmp_after_image_data_is_ignored (self):
+    packet = _packet('t:foo="bar">')
+    data = _jpeg() + _segment(0xe1, xmpscan.XMP_SIGNATURE + packet)
+    fn = self.write("a.jpg", data)
+    self.assertEqual(xmpscan.read_properties(fn, NS), {})
+
+  def test_sidecar (self):
+    fn = self.write("a.xmp", _packet('t:foo="bar"><t:baz/>'))
+    self.assertEqual(xmpscan.read_properties(fn, NS),
+                     {"foo": "bar", "baz": ""})
+
+  def test_unsupported (self):
+    cases = {
+      "extended": _jpeg(
+        _segment(0xe1, xmpscan.XMP_SIGNATURE + _packet('t:foo="bar">')),
+        _segment(0xe1, xmpscan.EXTENDED_XMP_SIGNATURE + b"\x00" * 40),
+      ),
+      "truncated": _jpeg(
+        _segment(0xe1, xmpscan.XMP_SIGNATURE + _packet('t:foo="bar">')),
+      )[:40],
+      "not-jpeg": b"\x89PNG\r\n\x1a\n" + b"\x00" * 20,
+      "empty": b"",
+      "invalid-xml": _jpeg(
+        _segment(0xe1, xmpscan.XMP_SIGNATURE + b"<x:xmpmeta"),
+      ),
+      "structured": _jpeg(
+        _segment(0xe1, xmpscan.XMP_SIGNATURE + _packet(
+            '><t:foo><rdf:Bag><rdf:li>x</rdf:li></rdf:Bag></t:foo>')),
+      ),
+      "resource": _jpeg(
+        _segment(0xe1, xmpscan.XMP_SIGNATURE + _packet(
+            '><t:foo rdf:resource="http://example.com/"/>')),
+      ),
+    }
+    for name, data in cases.items():
+      with self.subTest(name):
+        fn = self.write(f"{name}.jpg", data)
+        self.assertIsNone(xmpscan.read_properties(fn, NS))
+
+if __name__ == "__main__":
+  unittest.main()